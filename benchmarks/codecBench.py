@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Compares the encode and decode throughput of the v1 text protocol and the
+# v2 binary protocol for the messages sent during a game: moves, board
+# updates and scoreboards. Decoding splits a stream of frames with
+# frameReader and unpacks the payloads, as the client and server do.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, time
+from argparse import ArgumentParser
+from messageProtocol import *
+from boardView import *
+from sudoku_new import *
+
+SCORES = [('alice', 12), ('bob', -3), ('carol', 7), ('dave', 0)]
+
+
+def encoders(sudoku):
+    # (message, version) -> function returning the encoded frame
+    scoreText = 'Scoreboard: ' + ', '.join('%s %d' % s for s in SCORES)
+    return {
+        ('move', 1): lambda: encodeMessage(PROTOCOL_V1, REQ_PUT_NR, '123', 1),
+        ('move', 2): lambda: encodeMessage(PROTOCOL_V2, REQ_PUT_NR,
+                                           packMove(1, 2, 3), 1),
+        ('board', 1): lambda: encodeMessage(PROTOCOL_V1, REP_NOTIFY,
+                                            sudoku.sudoku_to_string()),
+        ('board', 2): lambda: encodeMessage(PROTOCOL_V2, REP_BOARD,
+                                 packBoard(sudoku.version, sudoku.current)),
+        ('scoreboard', 1): lambda: encodeMessage(PROTOCOL_V1, REP_NOTIFY,
+                                                 scoreText),
+        ('scoreboard', 2): lambda: encodeMessage(PROTOCOL_V2, REP_SCOREBOARD,
+                                                 packScores(SCORES)),
+    }
+
+def decodePayload(message, version, payload):
+    # Unpacks a payload the way the receiving side does. A v2 board is
+    # unpacked and rendered, since the client draws the table itself
+    if version == PROTOCOL_V1:
+        return payload
+    if message == 'move':
+        return unpackMove(payload)
+    if message == 'board':
+        boardVersion, cells = unpackBoard(payload)
+        return boardView(cells, boardVersion).render()
+    return unpackScores(payload)
+
+def measure(message, version, encode, count):
+    # Returns the frame size and the encode/decode rates in messages/s
+    start = time.time()
+    for i in range(count):
+        frame = encode()
+    encodeTime = time.time() - start
+
+    reader = frameReader(None)
+    reader.setVersion(version)
+    stream = frame * count
+    start = time.time()
+    reader.pending += stream
+    frames = reader.split()
+    for f in frames:
+        header, reqId, payload = decodeFrame(version, f)
+        decodePayload(message, version, payload)
+    decodeTime = time.time() - start
+    assert len(frames) == count
+    return {'message': message, 'version': version, 'bytes': len(frame),
+            'encode_per_s': count / encodeTime,
+            'decode_per_s': count / decodeTime}
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Protocol v1/v2 codec benchmark")
+    parser.add_argument('-n', '--count', type=int, default=20000,
+                        help="Messages encoded and decoded per case. "\
+                             "Default 20000.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    sudoku = Sudoku(LEVEL)
+    results = []
+    for (message, version), encode in sorted(encoders(sudoku).items()):
+        r = measure(message, version, encode, args.count)
+        results.append(r)
+        print '%-10s v%d %5d bytes %10.0f enc/s %10.0f dec/s' % (message,
+            version, r['bytes'], r['encode_per_s'], r['decode_per_s'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'count': args.count, 'results': results}, f, indent=2)
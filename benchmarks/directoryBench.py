@@ -0,0 +1,96 @@
+# Times the session directory queries of the lobby with more and more
+# sessions: the first page, a page deep into the directory, a page of the
+# sessions with open spots and a given player count, and a page of a name
+# prefix. Each is answered from the directory index and, for comparison,
+# by filtering and sorting the whole listing. With the index the times
+# should not grow with the number of sessions.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, time, random
+from argparse import ArgumentParser
+from sessionDirectory import directoryIndex, PAGE_SIZE
+
+SIZES = [100, 1000, 10000, 100000]
+
+# (open spots only, max players, cursor, name prefix) of the queries; the
+# deep cursor is filled in per size
+QUERIES = [('first', (False, 0, '', '')),
+           ('deep', (False, 0, None, '')),
+           ('open4', (True, 4, '', '')),
+           ('prefix', (False, 0, '', 'g7'))]
+
+
+def fill(index, sessions, seed):
+    # Adds 'sessions' sessions of 2 to 6 players, a third of them full.
+    # Returns the listing as the server had it
+    rnd = random.Random(seed)
+    listing = []
+    for i in range(sessions):
+        name = 'g%x' % rnd.getrandbits(32)
+        maxPlayers = rnd.randint(2, 6)
+        free = 0 if rnd.random() < 0.33 else rnd.randint(1, maxPlayers - 1)
+        index.put(name, free, maxPlayers)
+        listing.append((name, free, maxPlayers))
+    return listing
+
+def scan(listing, openOnly, players, pageSize, cursor, prefix):
+    # The query answered by going through the whole listing
+    page = sorted(e for e in listing if e[0] > cursor and
+                  e[0].startswith(prefix) and (e[1] > 0 or not openOnly) and
+                  (not players or e[2] == players))
+    return page[:pageSize], page[pageSize-1][0] if len(page) > pageSize \
+                                                else ''
+
+def timeQuery(f, args, count):
+    # Mean time of a query in microseconds, and its result
+    start = time.time()
+    for i in range(count):
+        r = f(*args)
+    return (time.time() - start) / count * 1e6, r
+
+def measure(size, count, seed):
+    index = directoryIndex()
+    listing = fill(index, size, seed)
+    names = sorted(e[0] for e in listing)
+    result = {'sessions': size}
+    for name, (openOnly, players, cursor, prefix) in QUERIES:
+        if cursor == None:
+            cursor = names[len(names) * 3 / 4]
+        args = (openOnly, players, PAGE_SIZE, cursor, prefix)
+        indexed, r1 = timeQuery(index.query, args, count)
+        scanned, r2 = timeQuery(scan, (listing,) + args,
+                                max(1, count * 100 / size))
+        assert r1 == r2, name
+        result[name + '_index_us'] = indexed
+        result[name + '_scan_us'] = scanned
+    return result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Session directory query benchmark")
+    parser.add_argument('-n', '--count', type=int, default=2000,
+                        help="Queries timed per size and query. Default "\
+                             "2000.")
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES,
+                        help="Session counts to measure at. Default %s."
+                             % ' '.join(map(str, SIZES)))
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed of the sessions made up. Default 1.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    results = []
+    print '%8s %-8s %12s %12s' % ('sessions', 'query', 'index us', 'scan us')
+    for size in args.sizes:
+        r = measure(size, args.count, args.seed)
+        results.append(r)
+        for name, query in QUERIES:
+            print '%8d %-8s %12.2f %12.2f' % (size, name,
+                r[name + '_index_us'], r[name + '_scan_us'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'count': args.count, 'page_size': PAGE_SIZE,
+                       'results': results}, f, indent=2)
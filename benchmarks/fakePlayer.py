@@ -0,0 +1,54 @@
+# The player the benchmarks put in the real server and sessions instead of
+# a clientHandler. It counts the frames sent to it instead of writing them.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from messageProtocol import *
+
+
+class fakePlayer(object):
+    # The parts of a clientHandler the sessions, the matcher and the
+    # server use
+    version = PROTOCOL_V2
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.score = 0
+        self.session = None
+        self.frames = 0
+        # The results of the player's own moves, for the benchmarks that
+        # check the scores
+        self.rights = 0
+        self.wrongs = 0
+        self.moves = 0
+
+    def __repr__(self):
+        return self.nickname
+
+    def getNickname(self):
+        return self.nickname
+
+    def getScoreNickname(self):
+        return self.nickname + ' ' + str(self.score)
+
+    def incScore(self):
+        self.score += 1
+
+    def decScore(self):
+        self.score -= 1
+
+    def send_frames(self, frames):
+        self.frames += len(frames)
+        return True
+
+    def send_notification(self, message):
+        self.frames += 1
+
+    def send_specific(self, header, message, reqId=0):
+        self.frames += 1
+
+    def send_board(self, sudoku, header=REP_NOTIFY):
+        self.frames += 1
+
+    def send_scoreboard(self, session):
+        self.frames += 1
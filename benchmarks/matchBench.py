@@ -0,0 +1,82 @@
+# Queues players for matchmaking at a steady arrival rate, each wanting a
+# random player count, and lets the server's matcher form the sessions.
+# Reports the sessions formed and the percentiles of the time the players
+# waited in the queues, for a few matching intervals. The server, matcher
+# and sessions are the real ones, the players only count the frames sent
+# to them.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, time, random, logging
+from argparse import ArgumentParser
+from serverMain import serverClass
+from sudoku_new import *
+from fakePlayer import fakePlayer
+
+INTERVALS = [0.05, 0.2, 0.5]
+
+
+def measure(interval, players, rate, sizes, seed):
+    # Queues 'players' players at 'rate' per second and waits until the
+    # matcher has formed the sessions. Returns the matcher stats
+    rnd = random.Random(seed)
+    rate = float(rate)
+    # every session gets a pooled puzzle, none is generated while matching
+    server = serverClass(poolSize=players, matchInterval=interval)
+    for i in range(players / min(sizes) + 1):
+        server.puzzlePool.put(LEVEL, make_sudoku(LEVEL))
+    server.matcher.start()
+    start = time.time()
+    for i in range(players):
+        p = fakePlayer('p%d' % i)
+        server.addClient(p)
+        server.addToLobby([p])
+        server.matcher.enqueue(p, rnd.choice(sizes), 0)
+        time.sleep(max(0, start + (i + 1) / rate - time.time()))
+    # the players left over cannot fill a session
+    while server.matcher.waiting and time.time() < start + players / rate \
+          + 2 * interval + 1:
+        time.sleep(interval)
+    server.matcher.stop()
+    stats = server.matcher.getStats()
+    stats['interval'] = interval
+    stats['sessions'] = len(server.getSessions())
+    return stats
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Matchmaking wait time benchmark")
+    parser.add_argument('-p', '--players', type=int, default=400,
+                        help="Players queued per interval. Default 400.")
+    parser.add_argument('-r', '--rate', type=float, default=200.0,
+                        help="Players arriving per second. Default 200.")
+    parser.add_argument('-s', '--sizes', type=int, nargs='+',
+                        default=[2, 3, 4],
+                        help="Player counts wanted, picked at random. "\
+                             "Default 2 3 4.")
+    parser.add_argument('-i', '--intervals', type=float, nargs='+',
+                        default=INTERVALS,
+                        help="Matching intervals to measure. Default %s."
+                             % ' '.join(map(str, INTERVALS)))
+    parser.add_argument('--seed', type=int, default=1,
+                        help="Seed of the player counts. Default 1.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+    # the sessions log every join
+    logging.getLogger().setLevel(logging.WARN)
+
+    results = []
+    print '%8s %8s %8s %8s %10s %10s %10s %10s' % ('interval', 'matched',
+        'waiting', 'sessions', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms')
+    for interval in args.intervals:
+        r = measure(interval, args.players, args.rate, args.sizes, args.seed)
+        results.append(r)
+        print '%8.2f %8d %8d %8d %10.1f %10.1f %10.1f %10.1f' % (interval,
+            r['matched'], r['waiting'], r['sessions'], r['wait_p50'] * 1e3,
+            r['wait_p90'] * 1e3, r['wait_p99'] * 1e3, r['wait_max'] * 1e3)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'players': args.players, 'rate': args.rate,
+                       'sizes': args.sizes, 'results': results}, f, indent=2)
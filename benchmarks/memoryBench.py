@@ -0,0 +1,57 @@
+# Compares the memory used by the bytearray backed Sudoku class with the
+# old numpy backed SudokuNumpy class. Every class is measured in its own
+# process, as the growth of the resident set size while creating N boards.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, resource
+from multiprocessing import Process, Queue
+from argparse import ArgumentParser
+from sudoku_new import *
+
+
+def measure(cls, puzzle, count, results):
+    # Runs in a child process: creates 'count' boards from the same puzzle
+    # and reports the peak RSS growth per board in bytes
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    boards = [cls(None, (puzzle[0].copy(), puzzle[1].copy()))
+              for i in range(count)]
+    after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux
+    results.put((after - before) * 1024.0 / count)
+
+def shallowSize(board):
+    # Size of the board object and the objects it holds, its view included
+    # (the view draws the board's own cells)
+    size = sys.getsizeof(board)
+    if hasattr(board, '__dict__'):
+        size += sys.getsizeof(board.__dict__)
+    if hasattr(board, 'view'):
+        size += sys.getsizeof(board.view)
+    return size + sys.getsizeof(board.current) + sys.getsizeof(board.solved)
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Sudoku board memory benchmark")
+    parser.add_argument('-n', '--count', type=int, default=10000,
+                        help="Boards created per class. Default 10000.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    puzzle = make_sudoku(LEVEL)
+    report = {}
+    for cls in [SudokuNumpy, Sudoku]:
+        results = Queue()
+        p = Process(target=measure, args=(cls, puzzle, args.count, results))
+        p.start()
+        perBoard = results.get()
+        p.join()
+        report[cls.__name__] = {
+            'count': args.count,
+            'object_bytes': shallowSize(cls(None, puzzle)),
+            'rss_bytes_per_board': perBoard}
+        print '%-12s %6d bytes per object, %8.1f bytes RSS per board' \
+              % (cls.__name__, report[cls.__name__]['object_bytes'], perBoard)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
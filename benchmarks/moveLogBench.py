@@ -0,0 +1,135 @@
+# Plays moves (a wrong number, then the right one, into every empty cell)
+# in sessions of two players, without a move log, with the log synced in
+# batches every interval, and with every move synced at once. Reports the
+# time per move and what the log adds to it, and fails if the batched log
+# adds more than the budget. Then replays the logs of the sessions still
+# running, as on a restart, and checks the boards and scores. The server
+# and sessions are the real ones, the players only count the frames sent
+# to them.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, time, logging, shutil, tempfile
+from argparse import ArgumentParser
+from serverMain import serverClass
+from sessionClass import sessionClass
+from moveLog import replay, logName, encodeCells
+from sudoku_new import *
+from fakePlayer import fakePlayer
+
+INTERVALS = [0.01, 0.05, 0.2]
+
+
+def play(puzzles, moves, path, interval):
+    # Plays 'moves' moves, a new session whenever one is over. Returns the
+    # seconds the moves took, the move log stats and the sessions running
+    server = serverClass(moveLogPath=path, logSync=interval)
+    if path:
+        server.moveLog.start()
+    sessions = []
+    elapsed = 0.0
+    played = 0
+    while played < moves:
+        puzzle = puzzles[len(sessions) % len(puzzles)]
+        sess = sessionClass('s%d' % len(sessions), 2, server, LEVEL,
+                            (puzzle[0].copy(), puzzle[1]))
+        server.addSession(sess)
+        sessions.append(sess)
+        players = [fakePlayer('p%d' % i) for i in range(2)]
+        for p in players:
+            sess.addMe(p)
+        cells = [i for i in range(81) if not sess.sudoku.current[i]]
+        start = time.time()
+        for n, i in enumerate(cells):
+            if played >= moves:
+                break
+            x, y, right = i % 9 + 1, i / 9 + 1, sess.sudoku.solved[i]
+            sess.putNumber(x, y, right % 9 + 1, players[n % 2])
+            sess.putNumber(x, y, right, players[n % 2])
+            played += 2
+        elapsed += time.time() - start
+    stats = None
+    if path:
+        server.moveLog.stop()
+        stats = server.moveLog.getStats()
+    return elapsed, stats, [s for s in sessions if not s.closed]
+
+def check(path, sessions):
+    # Replays the logs of the running sessions and compares them
+    start = time.time()
+    for sess in sessions:
+        with open(os.path.join(path, logName(sess.sessName)), 'rb') as f:
+            state = replay(f)
+        assert state['board'] == encodeCells(sess.sudoku.current), \
+               sess.sessName
+        assert state['players'] == sess.getScores(), sess.sessName
+    return time.time() - start
+
+def measure(puzzles, moves, interval):
+    # Times the moves with the log synced every 'interval' seconds (None
+    # for no log)
+    path = tempfile.mkdtemp() if interval != None else None
+    try:
+        elapsed, stats, running = play(puzzles, moves, path, interval)
+        result = {'interval': interval, 'move_us': elapsed / moves * 1e6}
+        if path:
+            result.update(stats)
+            result['replay_s'] = check(path, running)
+        return result
+    finally:
+        if path:
+            shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Move log overhead benchmark")
+    parser.add_argument('-n', '--moves', type=int, default=20000,
+                        help="Moves played per setting. Default 20000.")
+    parser.add_argument('-l', '--level', type=int, default=40,
+                        help="Empty cells of the puzzles. Default 40.")
+    parser.add_argument('-i', '--intervals', type=float, nargs='+',
+                        default=INTERVALS,
+                        help="Sync intervals of the batched log. Default %s."
+                             % ' '.join(map(str, INTERVALS)))
+    parser.add_argument('--sync-moves', type=int, default=500,
+                        help="Moves played with every move synced (0 to "\
+                             "skip it). Default 500.")
+    parser.add_argument('-b', '--budget', type=float, default=50.0,
+                        help="Microseconds the batched log may add to a "\
+                             "move. Default 50.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+    # the sessions log every move
+    logging.getLogger().setLevel(logging.WARN)
+
+    puzzles = [make_sudoku(args.level) for i in range(8)]
+    base = measure(puzzles, args.moves, None)
+    results = [base]
+    for interval in args.intervals:
+        results.append(measure(puzzles, args.moves, interval))
+    if args.sync_moves:
+        results.append(measure(puzzles, args.sync_moves, 0))
+    print '%10s %10s %12s %10s %10s %12s' % ('sync', 'move us',
+        'overhead us', 'records', 'fsyncs', 'replay ms')
+    over = False
+    for r in results:
+        r['overhead_us'] = r['move_us'] - base['move_us']
+        if r['interval'] == None:
+            print '%10s %10.1f' % ('no log', r['move_us'])
+            continue
+        print '%10s %10.1f %12.1f %10d %10d %12.2f' % (r['interval'] or
+            'each move', r['move_us'], r['overhead_us'], r['records'],
+            r['syncs'], r['replay_s'] * 1e3)
+        if r['interval'] and r['overhead_us'] > args.budget:
+            over = True
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'moves': args.moves, 'level': args.level,
+                       'budget_us': args.budget, 'results': results}, f,
+                      indent=2)
+    if over:
+        print 'The batched move log adds more than %.0f us per move' \
+              % args.budget
+        sys.exit(1)
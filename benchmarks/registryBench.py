@@ -0,0 +1,105 @@
+# Times the server registry operations behind a login and a session join
+# with more and more clients connected: a login adds the client, puts it in
+# the lobby and claims its nickname, a join looks the session up by name
+# and takes the client out of the lobby, leaving removes the client. With
+# the hash based registries the times should not grow with the number of
+# clients and sessions.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, time
+from threading import Lock
+from argparse import ArgumentParser
+from serverMain import serverClass
+
+SIZES = [10, 100, 1000, 10000, 100000]
+
+
+class fakeClient(object):
+    # The parts of a clientHandler the registries use
+    def __init__(self):
+        self.nickname = None
+        self.session = None
+
+class fakeSession(object):
+    # The parts of a sessionClass the registries use, the server holds its
+    # lock while adding it
+    def __init__(self, sessName):
+        self.sessName = sessName
+        self.lock = Lock()
+
+
+def fill(server, clients, sessions):
+    # Connects 'clients' clients, half of them in the lobby, and creates
+    # 'sessions' sessions. As on the server, clients join the lobby before
+    # they have a nickname
+    for i in range(clients):
+        c = fakeClient()
+        server.addClient(c)
+        if i % 2 == 0:
+            server.addToLobby([c])
+        server.claimNickname(c, 'player%d' % i)
+    for i in range(sessions):
+        server.addSession(fakeSession('session%d' % i))
+
+def percentile(times, p):
+    return sorted(times)[int(len(times) * p / 100.0)]
+
+def measure(size, count):
+    # Returns the login, join and leave times in microseconds on a server
+    # with 'size' clients and size / 4 sessions
+    server = serverClass()
+    fill(server, size, max(1, size / 4))
+    sessNames = server.getSessNames()
+    times = {'login': [], 'join': [], 'leave': []}
+    for i in range(count):
+        c = fakeClient()
+        start = time.time()
+        server.addClient(c)
+        server.addToLobby([c])
+        ok = server.claimNickname(c, 'new%d' % i)
+        times['login'].append(time.time() - start)
+        assert ok
+
+        start = time.time()
+        sess = server.getSession(sessNames[i % len(sessNames)])
+        server.removeFromLobby(c)
+        times['join'].append(time.time() - start)
+        assert sess != None
+
+        start = time.time()
+        server.removeClient(c)
+        times['leave'].append(time.time() - start)
+    result = {'clients': size, 'sessions': len(sessNames)}
+    for op, t in times.items():
+        result[op + '_mean_us'] = sum(t) / len(t) * 1e6
+        result[op + '_p99_us'] = percentile(t, 99) * 1e6
+    return result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Server registry benchmark")
+    parser.add_argument('-n', '--count', type=int, default=5000,
+                        help="Logins, joins and leaves timed per size. "\
+                             "Default 5000.")
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=SIZES,
+                        help="Connected client counts to measure at. "\
+                             "Default %s." % ' '.join(map(str, SIZES)))
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+
+    results = []
+    print '%8s %8s %18s %18s %18s' % ('clients', 'sessions', 'login us',
+                                      'join us', 'leave us')
+    for size in args.sizes:
+        r = measure(size, args.count)
+        results.append(r)
+        print '%8d %8d %8.2f (p99 %5.2f) %8.2f (p99 %5.2f) %8.2f (p99 %5.2f)'\
+              % (size, r['sessions'], r['login_mean_us'], r['login_p99_us'],
+                 r['join_mean_us'], r['join_p99_us'], r['leave_mean_us'],
+                 r['leave_p99_us'])
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'count': args.count, 'results': results}, f, indent=2)
@@ -0,0 +1,155 @@
+# Benchmarks the sudoku generator, solvers and validators on seeded boards.
+# Every case runs in its own process and reports its run time, the number
+# of calls made to each sudoku_new function and the peak resident set
+# size. The results can be written as JSON and compared with an earlier
+# run to catch regressions.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, time, random, resource, cProfile, pstats, platform
+from multiprocessing import Process, Queue
+from argparse import ArgumentParser
+import sudoku_new
+from sudoku_new import *
+
+# Solver backends, all with the (board, multiple, solvable) contract
+BACKENDS = {
+    'bitmask': solve_sudoku,
+    'old': solve_sudoku_old,
+}
+
+
+def seeded(seed):
+    # Seeds both random generators used by sudoku_new
+    random.seed(seed)
+    np.random.seed(seed)
+
+def makeCase(name, level, seed, backend=None):
+    # Returns the function a case runs. Boards are generated before the
+    # measurement starts, so only the benchmarked function is measured
+    seeded(seed)
+    if name == 'make_sudoku':
+        return lambda: make_sudoku(level)
+    puzzle, solution = make_sudoku(level)
+    if name == 'solve_sudoku':
+        solve = BACKENDS[backend]
+        return lambda: solve(puzzle.copy())
+    if name == 'count_solutions':
+        return lambda: count_solutions(puzzle)
+    if name == 'check_sudoku':
+        return lambda: [check_sudoku(b) for b in (puzzle, solution) * 500]
+    if name == 'check_sudoku_batch':
+        boards = np.array([puzzle, solution] * 500)
+        return lambda: check_sudoku_batch(boards)
+    raise ValueError('Unknown benchmark %s' % name)
+
+def countCalls(run):
+    # Runs the case under the profiler and returns the number of calls to
+    # each sudoku_new function, recursive calls included
+    profiler = cProfile.Profile()
+    profiler.runcall(run)
+    stats = pstats.Stats(profiler).stats
+    calls = {}
+    for (path, line, func), (cc, nc, tt, ct, callers) in stats.items():
+        if os.path.basename(path).startswith('sudoku_new'):
+            calls[func] = calls.get(func, 0) + nc
+    return calls
+
+def runCase(case, repeat, results):
+    # Runs in a child process. The case is timed 'repeat' times without the
+    # profiler, the calls are counted in one extra profiled run
+    run = makeCase(case['name'], case['level'], case['seed'],
+                   case.get('backend'))
+    # ru_maxrss is in kilobytes on Linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    times = []
+    for i in range(repeat):
+        seeded(case['seed'])
+        start = time.time()
+        run()
+        times.append(time.time() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    seeded(case['seed'])
+    calls = countCalls(run)
+    results.put(dict(case, seconds=min(times), mean_seconds=sum(times)/repeat,
+                     calls=calls, peak_rss_kb=peak,
+                     peak_rss_growth_kb=peak - before))
+
+def cases(levels, seeds, backends):
+    # Lists the benchmark cases
+    out = []
+    for level in levels:
+        for seed in seeds:
+            out.append({'name': 'make_sudoku', 'level': level, 'seed': seed})
+            for backend in backends:
+                out.append({'name': 'solve_sudoku', 'backend': backend,
+                            'level': level, 'seed': seed})
+            for name in ['count_solutions', 'check_sudoku',
+                         'check_sudoku_batch']:
+                out.append({'name': name, 'level': level, 'seed': seed})
+    return out
+
+def caseKey(case):
+    return '%s/%s/level=%d/seed=%d' % (case['name'],
+        case.get('backend', '-'), case['level'], case['seed'])
+
+def compare(results, baseline, tolerance):
+    # Returns the cases that got slower than the baseline by more than
+    # 'tolerance' (0.2 is 20%)
+    old = dict((caseKey(c), c) for c in baseline['cases'])
+    slower = []
+    for case in results:
+        before = old.get(caseKey(case))
+        if before and case['seconds'] > before['seconds'] * (1 + tolerance):
+            slower.append((caseKey(case), before['seconds'], case['seconds']))
+    return slower
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Sudoku solver and generator "\
+                                        "benchmarks")
+    parser.add_argument('-l', '--levels', type=int, nargs='+',
+                        default=[LEVEL, 20, 40, 70],
+                        help="Numbers of removed cells. Default %d 20 40 70."
+                             % LEVEL)
+    parser.add_argument('-s', '--seeds', type=int, nargs='+',
+                        default=[1, 2, 3], help="Seeds. Default 1 2 3.")
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS.keys(),
+                        default=sorted(BACKENDS.keys()),
+                        help="Solver backends to compare. Default all.")
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help="Timed runs per case. Default 3.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    parser.add_argument('--baseline',
+                        help="JSON results of an earlier run to compare with.")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="Allowed slow down against the baseline. "\
+                             "Default 0.2 (20%%).")
+    args = parser.parse_args()
+
+    results = []
+    for case in cases(args.levels, args.seeds, args.backends):
+        q = Queue()
+        p = Process(target=runCase, args=(case, args.repeat, q))
+        p.start()
+        result = q.get()
+        p.join()
+        results.append(result)
+        print '%-48s %10.5f s %8d calls %8d kB peak (+%d kB)' % (
+            caseKey(result), result['seconds'],
+            sum(result['calls'].values()), result['peak_rss_kb'],
+            result['peak_rss_growth_kb'])
+
+    report = {'python': platform.python_version(),
+              'numpy': np.__version__, 'cases': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            slower = compare(results, json.load(f), args.tolerance)
+        for key, before, after in slower:
+            print 'Slower: %s %.5f s -> %.5f s' % (key, before, after)
+        if slower:
+            sys.exit(1)
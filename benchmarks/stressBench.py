@@ -0,0 +1,158 @@
+# Stress test of the session locking. Players join sessions from many
+# threads at once, more of them than there are spots, and the players that
+# got in fire moves at their boards until the games are over. Afterwards
+# every session is checked: no session took more players than it has
+# spots, every empty cell was filled exactly once with the solution, and
+# every player's score matches the moves it made. Reports the move
+# throughput under contention. The server and sessions are the real ones,
+# the players count the frames sent to them instead of writing them.
+
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+sys.path.insert(1, os.path.join(sys.path[0], '..', 'server'))
+import json, time, random, logging
+from threading import Thread
+from argparse import ArgumentParser
+from serverMain import serverClass
+from sessionClass import sessionClass
+from sudoku_new import *
+from fakePlayer import fakePlayer
+
+
+def join(server, player, names, joined):
+    # Tries the sessions in random order until one takes the player
+    for name in random.sample(names, len(names)):
+        sess = server.getSession(name)
+        if sess != None and sess.addMe(player):
+            joined.append((player, sess))
+            return
+
+def play(player, sess, wrongRate):
+    # Puts numbers at the empty cells of the board until the game is over.
+    # A move is wrong with the given probability
+    sudoku = sess.sudoku
+    while player.session is sess:
+        empty = [i for i in range(81) if sudoku.current[i] == 0]
+        if not empty:
+            break
+        i = random.choice(empty)
+        number = sudoku.solved[i]
+        if random.random() < wrongRate:
+            number = number % 9 + 1
+        before = player.score
+        sess.putNumber(i % 9 + 1, i // 9 + 1, number, player)
+        player.moves += 1
+        if player.score > before:
+            player.rights += 1
+        elif player.score < before:
+            player.wrongs += 1
+
+def runRound(server, sessions, players, extra, wrongRate, empties):
+    # Plays one round: creates the sessions, lets players race for the
+    # spots and plays the games. Returns the moves, the time spent
+    # playing and the problems found
+    names = []
+    for i in range(sessions):
+        server.puzzlePool.put(LEVEL, make_sudoku(empties))
+        sess = sessionClass('stress%d' % i, players, server)
+        server.addSession(sess)
+        names.append(sess.sessName)
+    sessList = list(server.getSessions())
+    empty = dict((s.sessName, list(s.sudoku.current).count(0))
+                 for s in sessList)
+    versions = dict((s.sessName, s.sudoku.version) for s in sessList)
+
+    candidates = [fakePlayer('p%d' % i)
+                  for i in range(sessions * players + extra)]
+    for p in candidates:
+        server.addClient(p)
+    server.addToLobby(candidates)
+    joined = []
+    threads = [Thread(target=join, args=(server, p, names, joined))
+               for p in candidates]
+    map(lambda t: t.start(), threads)
+    map(lambda t: t.join(), threads)
+
+    start = time.time()
+    threads = [Thread(target=play, args=(p, s, wrongRate))
+               for p, s in joined]
+    map(lambda t: t.start(), threads)
+    map(lambda t: t.join(), threads)
+    elapsed = time.time() - start
+
+    problems = []
+    if len(joined) != sessions * players:
+        problems.append('%d players joined %d spots'
+                        % (len(joined), sessions * players))
+    for s in sessList:
+        mine = [p for p, sess in joined if sess is s]
+        rights = sum(p.rights for p in mine)
+        if len(mine) > s.maxClients:
+            problems.append('%s took %d players' % (s.sessName, len(mine)))
+        if not s.closed or s.clients or server.hasSession(s.sessName):
+            problems.append('%s not closed' % s.sessName)
+        if s.sudoku.current != s.sudoku.solved:
+            problems.append('%s board differs from the solution'
+                            % s.sessName)
+        if rights != empty[s.sessName]:
+            problems.append('%s: %d right moves for %d empty cells'
+                            % (s.sessName, rights, empty[s.sessName]))
+        if s.sudoku.version - versions[s.sessName] != rights:
+            problems.append('%s: board version off' % s.sessName)
+        for p in mine:
+            if p.score != p.rights - p.wrongs:
+                problems.append('%s: score %d for %d right, %d wrong moves'
+                                % (p.nickname, p.score, p.rights, p.wrongs))
+    for p in candidates:
+        server.removeMe(p)
+    moves = sum(p.moves for p, s in joined)
+    return moves, elapsed, problems
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Session concurrency stress test")
+    parser.add_argument('-s', '--sessions', type=int, default=8,
+                        help="Sessions played at once. Default 8.")
+    parser.add_argument('-p', '--players', type=int, default=4,
+                        help="Players per session. Default 4.")
+    parser.add_argument('-x', '--extra', type=int, default=8,
+                        help="Players more than there are spots, racing "\
+                             "for them. Default 8.")
+    parser.add_argument('-e', '--empties', type=int, default=50,
+                        help="Empty cells per board. Default 50.")
+    parser.add_argument('-w', '--wrong-rate', type=float, default=0.3,
+                        help="Share of wrong moves. Default 0.3.")
+    parser.add_argument('-r', '--rounds', type=int, default=5,
+                        help="Rounds played. Default 5.")
+    parser.add_argument('-i', '--check-interval', type=int, default=1,
+                        help="Bytecodes between thread switches, low "\
+                             "values provoke races. Default 1.")
+    parser.add_argument('-o', '--output',
+                        help="Write the results as JSON to this file.")
+    args = parser.parse_args()
+    # the sessions log every move
+    logging.getLogger().setLevel(logging.WARN)
+    sys.setcheckinterval(args.check_interval)
+
+    server = serverClass(poolSize=args.sessions)
+    results = []
+    failed = False
+    for r in range(args.rounds):
+        moves, elapsed, problems = runRound(server, args.sessions,
+            args.players, args.extra, args.wrong_rate, args.empties)
+        results.append({'round': r, 'moves': moves, 'seconds': elapsed,
+                        'moves_per_s': moves / elapsed,
+                        'problems': problems})
+        print 'round %d: %6d moves in %.2f s, %8.0f moves/s, %s' % (r,
+            moves, elapsed, moves / elapsed,
+            '; '.join(problems) if problems else 'consistent')
+        failed = failed or bool(problems)
+    moves = sum(r['moves'] for r in results)
+    seconds = sum(r['seconds'] for r in results)
+    print 'total: %d moves by %d players in %.2f s, %.0f moves/s' % (moves,
+        args.sessions * args.players, seconds, moves / seconds)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'sessions': args.sessions, 'players': args.players,
+                       'results': results}, f, indent=2)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+# Draws sudoku boards as the text table designed in 'sudoku_design.txt'.
+# Shared by the server's Sudoku class and the client, which keeps its own
+# copy of the board. All boards draw from one format string of the design,
+# a view holds only the cells and a version number counting the changes.
+
+# The board design from 'Sudoku_design.txt', the cells are marked with '*'.
+DESIGN = """   X 1-2-3   4-5-6   7-8-9
+  Y╔═══════╦═══════╦═══════╗
+  1║ * * * ║ * * * ║ * * * ║
+  2║ * * * ║ * * * ║ * * * ║
+  3║ * * * ║ * * * ║ * * * ║
+   ╠═══════╬═══════╬═══════╣
+  4║ * * * ║ * * * ║ * * * ║
+  5║ * * * ║ * * * ║ * * * ║
+  6║ * * * ║ * * * ║ * * * ║
+   ╠═══════╬═══════╬═══════╣
+  7║ * * * ║ * * * ║ * * * ║
+  8║ * * * ║ * * * ║ * * * ║
+  9║ * * * ║ * * * ║ * * * ║
+   ╚═══════╩═══════╩═══════╝"""
+# The design as a format string with a %c per cell, and the characters
+# drawn for the cell values as a translation table.
+DESIGN_FORMAT = DESIGN.replace('*', '%c')
+DESIGN_CHARS = bytearray(range(256))
+DESIGN_CHARS[:10] = '.123456789'
+
+
+class boardView(object):
+    __slots__ = ('cells','version')
+
+    def __init__(self, cells, version=0):
+        # cells is a bytearray of 81 cells (0 = empty) row by row, it is
+        # used as is, not copied
+        self.cells = cells
+        self.version = version
+
+    def set_cell(self, i, value):
+        # Sets cell i (0..80)
+        self.cells[i] = value
+        self.version += 1
+
+    def render(self):
+        # Returns the table, the cells formatted into the shared design
+        return DESIGN_FORMAT % tuple(self.cells.translate(DESIGN_CHARS))
+
+    def percent_filled(self):
+        # Returns how much of the board is filled, in percent
+        return 100 * (81 - self.cells.count(chr(0))) // 81
@@ -13,6 +13,7 @@ logging.basicConfig(filename=logfile,\
 LOG = logging.getLogger()
 
 from threading import Thread, Condition, Lock, currentThread
+from itertools import count
 from clientIO import *
 
 from socket import AF_INET, SOCK_STREAM, socket, SHUT_RD
@@ -21,6 +22,11 @@ from socket import error as soc_err
 import os,sys,inspect
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from messageProtocol import *
+from boardView import *
+
+# Query of the directory pages the server sends unasked: the first page
+# of all sessions (open spots only, max players, cursor, name prefix)
+FIRST_PAGE = (False, 0, '', '')
 
 class Client():
     # Client can be in these states
@@ -37,7 +43,9 @@ class Client():
         __gm_states.NEED_NAME : 'What\'s your nickname?',
         __gm_states.NOTCONNECTED : 'What\'s the server\'s IP address?',
         __gm_states.SERVER_REFUSED_NAME : 'That name is taken, try another one.',
-        __gm_states.NEED_SESSION : '\nWant to [c]reate a new session or [j]oin an existing one?',
+        __gm_states.NEED_SESSION : '\nWant to [c]reate a new session, [j]oin an existing one or ' + \
+                                   'get [m]atched with other players?\n' + \
+                                   '([l]ist the sessions by filter, see the [n]ext page of sessions)',
         __gm_states.WAIT_FOR_PLAYERS : 'Waiting for other players...',
         __gm_states.NEED_PUTNUMBER : '\nEnter column, row, number to fill a spot.\n' + \
                                      'For example, \'213\' puts \'3\' at (x=2, y=1).'
@@ -46,7 +54,12 @@ class Client():
     def __init__(self,io):
         # Network related
         self.__send_lock = Lock()   # Only one entity can send out at a time
+        self.__write_lock = Lock()  # Only one frame written at a time
 	self.__s = None
+        self.__reader = None
+        # Protocol version agreed with the server, last request id (v2)
+        self.__version = PROTOCOL_V1
+        self.__req_id = 0
         # Here we collect the received responses and notify the waiting
         # entities
         self.__rcv_sync_msgs_lock = Condition()  # To wait/notify on received
@@ -62,7 +75,18 @@ class Client():
 
         # Stores the server approved name
         self.__my_name = None
-        self.__client_sudoku_copy = ''
+        self.__client_sudoku_copy = None   # boardView of the board (v2)
+        self.__scores = []                 # [nickname, score] pairs (v2)
+        # The page of the session directory shown (v2): session name ->
+        # (free spots, max players), the directory version, the query it
+        # answers and the cursor of the next page
+        self.__directory = None
+        self.__directory_version = 0
+        self.__dir_query = FIRST_PAGE
+        self.__dir_next = ''
+        # Directory queries sent, by request id
+        self.__dir_queries = {}
+        self.__dir_req_ids = count(1)
 
         # Networking thread is created after the player has choosed a name
         self.network_thread = None
@@ -78,6 +102,7 @@ class Client():
         # Send request and wait for response
         with self.__send_lock:
             req = header + HEADER_SEP + payload
+            self.__req_id = self.__req_id % 0xFFFF + 1
             if self.__session_send(req):
                 with self.__rcv_sync_msgs_lock:
                     while len(self.__rcv_sync_msgs) <= 0:
@@ -105,18 +130,12 @@ class Client():
 
     def __session_rcv(self):
         # Receive the block of data till next block separator
-        m,b = '',''
+        m = ''
         try:
-            b = self.__s.recv(1)
-            m += b
-            while len(b) > 0 and not (b.endswith(MSG_TERMCHR)):
-                b = self.__s.recv(1)
-                m += b
-            if len(b) <= 0:
+            m = self.__reader.readFrame()
+            if len(m) <= 0:
                 logging.debug( 'Socket receive interrupted'  )
                 self.__s.close()
-                m = ''
-            m = m[:-1]
         except KeyboardInterrupt:
             self.__s.close()
             logging.info( 'Ctrl+C issued, terminating ...' )
@@ -131,12 +150,21 @@ class Client():
             m = ''
         return m
 
-    def __session_send(self,msg):
-        # Sends the data with message end char
-        m = msg + MSG_TERMCHR
+    def __session_send(self,msg,req_id=None):
+        # Sends the 'header:payload' message framed in the agreed version
+        header, payload = msg[:1], msg[2:]
+        # (only a move of three digits is packed, anything else goes as
+        # text for the server to refuse)
+        if self.__version >= PROTOCOL_V2 and header == REQ_PUT_NR and \
+           len(payload) == 3 and payload.isdigit():
+            payload = packMove(*map(int, payload))
+        if req_id == None:
+            req_id = self.__req_id
+        m = encodeMessage(self.__version, header, payload, req_id)
         r = False
         try:
-            self.__s.sendall(m)
+            with self.__write_lock:
+                self.__s.sendall(m)
             r = True
         except KeyboardInterrupt:
             self.__s.close()
@@ -150,6 +178,110 @@ class Client():
             logging.info( 'Disconnected' )
         return r
 
+    def __decode_frame(self,frame):
+        # Turns a v2 frame into a v1 style message. Boards are unpacked to
+        # the local copy and rendered, scoreboards become notifications
+        header, req_id, payload = decodeFrame(self.__version, frame)
+        if header in [REP_TABLE, REP_BOARD]:
+            board_version, cells = unpackBoard(payload)
+            self.__client_sudoku_copy = boardView(cells, board_version)
+            if header == REP_TABLE:
+                return REP_TABLE + HEADER_SEP + \
+                       self.__client_sudoku_copy.render()
+            return REP_NOTIFY + HEADER_SEP + self.__board_to_string()
+        if header == REP_SCOREBOARD:
+            self.__scores = map(list, unpackScores(payload))
+            return REP_NOTIFY + HEADER_SEP + self.__scores_to_string()
+        if header == REP_DELTA:
+            return self.__apply_delta(payload)
+        if header == REP_DIRECTORY:
+            return self.__apply_page(req_id, payload)
+        if header == REP_DIR_DELTA:
+            return self.__apply_directory_delta(payload)
+        if header == REP_PING:
+            # Heartbeat, tells the server the client is still there
+            self.__session_send(REQ_PONG + HEADER_SEP + payload, 0)
+            return ''
+        return header + HEADER_SEP + payload
+
+    def __apply_delta(self,payload):
+        # Applies a move to the local board copy and scores. If an update
+        # was missed (board version gap) asks the server for a snapshot
+        board_version, cell, value, score_change, mover = unpackDelta(payload)
+        board = self.__client_sudoku_copy
+        if board == None or board_version != board.version + (value > 0):
+            logging.info('Board version gap, asking for a snapshot')
+            self.__session_send(REQ_BOARD + HEADER_SEP, 0)
+            return ''
+        if value:
+            board.set_cell(cell, value)
+        for score in self.__scores:
+            if score[0] == mover:
+                score[1] += score_change
+        return REP_NOTIFY + HEADER_SEP + self.__scores_to_string() + '\n' + \
+               self.__board_to_string()
+
+    def __query_directory(self,open_only,players,cursor,prefix):
+        # Asks the server for a page of the session directory, the page
+        # is shown when it arrives
+        req_id = next(self.__dir_req_ids) % 0xFFFF + 1
+        self.__dir_queries[req_id] = (open_only, players, cursor, prefix)
+        self.__session_send(REQ_DIRECTORY + HEADER_SEP + \
+                            packQuery(open_only, players, 0, cursor, prefix),
+                            req_id)
+
+    def __apply_page(self,req_id,payload):
+        # Replaces the shown page of the session directory
+        self.__dir_query = self.__dir_queries.pop(req_id, FIRST_PAGE)
+        self.__directory_version, self.__dir_next, entries = \
+                                  unpackPage(payload)
+        self.__directory = dict((e[0], e[1:]) for e in entries)
+        return self.__directory_notification()
+
+    def __apply_directory_delta(self,payload):
+        # Applies session directory changes to the shown page. If an
+        # update was missed asks the server for the page again
+        directory_version, changes = unpackDirectory(payload)
+        if self.__directory == None:
+            return ''
+        if directory_version != self.__directory_version + 1:
+            logging.info('Session directory gap, asking for the page again')
+            self.__query_directory(*self.__dir_query)
+            return ''
+        self.__directory_version = directory_version
+        for op, name, free, max_players in changes:
+            if op != DIR_REMOVE and self.__on_page(name, free, max_players):
+                self.__directory[name] = (free, max_players)
+            else:
+                self.__directory.pop(name, None)
+        return self.__directory_notification()
+
+    def __on_page(self,name,free,max_players):
+        # Whether a session belongs on the shown page: it matches the
+        # query and sorts before the next page
+        open_only, players, cursor, prefix = self.__dir_query
+        return name > cursor and name.startswith(prefix) and \
+               (free > 0 or not open_only) and \
+               (players == 0 or max_players == players) and \
+               (not self.__dir_next or name <= self.__dir_next)
+
+    def __directory_notification(self):
+        # The lobby listing of the shown page
+        listing = directoryToString([(name,) + e for name, e in
+                                     sorted(self.__directory.items())])
+        if self.__dir_next:
+            listing += '\nMore sessions on the [n]ext page.'
+        return REP_NOTIFY + HEADER_SEP + listing
+
+    def __board_to_string(self):
+        # Local board copy and its progress
+        return self.__client_sudoku_copy.render() + '\nProgress: %d%% filled' \
+               % self.__client_sudoku_copy.percent_filled()
+
+    def __scores_to_string(self):
+        return 'Scoreboard: ' + ', '.join(map(lambda x: '%s %d' % tuple(x),
+                                              self.__scores))
+
     def __protocol_rcv(self,message):
         # Process received messages.
         # Server notifications, request/responses and game end
@@ -163,6 +295,11 @@ class Client():
             payload = message[2:]
             logging.debug('Server notification received: %s' % payload)
             self.__async_notification(payload)
+        elif message.startswith(REP_VERSION + HEADER_SEP):
+            # Switch before reading on, the server sends in the new version
+            self.__version = int(message[2:])
+            self.__reader.setVersion(self.__version)
+            self.__sync_response(message)
         elif message[:2] in map(lambda x: x+HEADER_SEP,  [REP_CURRENT_SESSIONS,
                                                           REP_PUT_NR,
                                                           REP_WAITING_PLAYERS,
@@ -202,6 +339,12 @@ class Client():
             elif self.__gm_state == self.__gm_states.SERVER_REFUSED_NAME:
                 self.send_server_my_name_get_ack()
 
+    def negotiate_version(self):
+        # Asks the server for the newest protocol version, old servers
+        # refuse and the client stays on v1
+        rsp = self.__sync_request(REQ_VERSION,str(PROTOCOL_VERSION))
+        logging.info('Using protocol version %d (%s)' % (self.__version,rsp))
+
     def send_server_my_name_get_ack(self):
         # Ask server for name verification
         try:
@@ -211,6 +354,13 @@ class Client():
                 self.__state_change(self.__gm_states.SERVER_REFUSED_NAME)
             elif header == REP_CURRENT_SESSIONS:
                 self.__state_change(self.__gm_states.NEED_SESSION)
+            # The server recovered a session this name played in
+            elif header == REP_WAITING_PLAYERS:
+                self.__io.output_sync('>>> Back in your session.')
+                self.__state_change(self.__gm_states.WAIT_FOR_PLAYERS)
+            elif header == REP_TABLE:
+                self.__io.output_sync('>>> Game resumed! \n\n%s' %rsp[2:])
+                self.__state_change(self.__gm_states.NEED_PUTNUMBER)
         except Exception as e:
             self.__io.output_sync('Name verification by client failed %s'%str(e))
 
@@ -221,12 +371,14 @@ class Client():
         srv_addr = (ip,7777)
         try:
             self.__s.connect(srv_addr)
+            self.__reader = frameReader(self.__s)
             logging.info('Connected to Game server at %s:%d' % srv_addr)
 
             self.network_thread = \
 		Thread(name='NetworkThread',target=self.network_loop)
             self.network_thread.start()
 
+            self.negotiate_version()
             self.send_server_my_name_get_ack()
         except soc_err as e:
             logging.error('Can not connect to game server at %s:%d'\
@@ -237,14 +389,20 @@ class Client():
         # Asks the player if to create a new session or join an existing one
         # guides the player through the process while checking if the input is
         # valid. Then creates/connects to the session.
-        while create_sess not in ['c','j']:
+        while create_sess not in ['c','j','l','n','m']:
 	    try:
                 create_sess = self.__get_user_input()
             except KeyboardInterrupt:
 		return False
             if create_sess == "Q": return False
-            if create_sess not in ['c','j']:
-                self.__io.output_sync('Error, enter either \'c\' or \'j\'.')
+            if create_sess not in ['c','j','l','n','m']:
+                self.__io.output_sync('Error, enter \'c\', \'j\', \'m\', \'l\' or \'n\'.')
+        if create_sess == 'l':
+            return self.list_sessions()
+        if create_sess == 'n':
+            return self.next_sessions()
+        if create_sess == 'm':
+            return self.find_match()
         if create_sess == 'c':
             p_count = "0"
             while int(p_count) < 2:
@@ -295,6 +453,81 @@ class Client():
             self.__io.output_sync('Analysing sess join/create msg fail %s' %str(e))
 	return True
 
+    def find_match(self):
+        # Asks the player for the number of players and the difficulty,
+        # and queues them to be matched into a session with other players
+        p_count = 0
+        while p_count < 2:
+            self.__io.output_sync('How many people are playing?')
+            try:
+                p_count = self.__get_user_input()
+                if p_count == None or p_count == "Q": return False
+                p_count = int(p_count)
+                if p_count < 2:
+                    self.__io.output_sync('Need a minimum of two players!')
+            except KeyboardInterrupt:
+                return False
+            except ValueError:
+                p_count = 0
+                self.__io.output_sync('Please enter a number.')
+        level = None
+        while level == None:
+            self.__io.output_sync('How difficult? Number of empty cells, ' + \
+                                  '0 for the server\'s default.')
+            try:
+                level = self.__get_user_input()
+                if level == None or level == "Q": return False
+                level = int(level)
+            except KeyboardInterrupt:
+                return False
+            except ValueError:
+                level = None
+                self.__io.output_sync('Please enter a number.')
+        rsp = self.__sync_request(REQ_MATCH,'%d%s%d' % (p_count,FIELD_SEP,level))
+        try:
+            header,msg = rsp.split(HEADER_SEP)
+            if header == REP_NOT_OK:
+                self.__io.output_sync('Error finding a match: %s' %msg)
+            elif header == REP_WAITING_PLAYERS:
+                self.__state_change(self.__gm_states.WAIT_FOR_PLAYERS)
+        except Exception as e:
+            self.__io.output_sync('Analysing matchmaking msg fail %s' %str(e))
+        return True
+
+    def list_sessions(self):
+        # Asks the player for the filters and shows the first page of the
+        # sessions matching them
+        if self.__version < PROTOCOL_V2:
+            self.__io.output_sync('The server cannot list sessions by filter.')
+            return True
+        self.__io.output_sync('List [o]pen sessions only, of how many players, ' + \
+                              'named starting with?\n' + \
+                              'For example \'o 4 ab\', empty for all sessions.')
+        try:
+            words = self.__get_user_input()
+        except KeyboardInterrupt:
+            return False
+        if words == None or words == "Q": return False
+        open_only, players, prefix = False, 0, ''
+        for w in words.split():
+            if w == 'o':
+                open_only = True
+            elif w.isdigit():
+                players = min(int(w), 0xFFFF)
+            else:
+                prefix = w
+        self.__query_directory(open_only, players, '', prefix)
+        return True
+
+    def next_sessions(self):
+        # Shows the page of sessions after the one shown
+        if not self.__dir_next:
+            self.__io.output_sync('No more sessions.')
+        else:
+            open_only, players, cursor, prefix = self.__dir_query
+            self.__query_directory(open_only, players, self.__dir_next, prefix)
+        return True
+
     def waiting_for_players(self):
         # loop till the server notifies all the clients have connected
         # to the game session
@@ -321,13 +554,15 @@ class Client():
             return
 	try:
             ints = list(s)
-            for nr in [int(ints[0]),int(ints[1]),int(ints[2])]:
+            nrs = [int(ints[0]),int(ints[1]),int(ints[2])]
+            for nr in nrs:
                 if nr not in range(1,10):
                     self.__io.output_sync('Not proper input - numbers not 1...9')
                     return
 	except ValueError:
             self.__io.output_sync('Not proper input - cant find three integers')
-        rsp = self.__sync_request(REQ_PUT_NR,s)
+            return
+        rsp = self.__sync_request(REQ_PUT_NR,'%d%d%d' % tuple(nrs))
         if rsp.startswith(REP_PUT_NR+HEADER_SEP):
             self.__io.output_sync('%s' %rsp[2:])
         else:
@@ -393,6 +628,8 @@ class Client():
             m = self.__session_rcv()
             if len(m) <= 0:
                 break
+            if self.__version >= PROTOCOL_V2:
+                m = self.__decode_frame(m)
             self.__protocol_rcv(m)
 
 
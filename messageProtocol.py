@@ -1,8 +1,20 @@
+import struct, binascii, errno
+from socket import error as soc_err
+from collections import deque
+
 # requests
 REQ_NICKNAME = 'a'          #REQchr:nickname(str)+term
 REQ_JOIN_EXIST_SESS = 'b'   #REQchr:sessName(str)+term
 REQ_JOIN_NEW_SESS = 'c'     #REQchr:sessName(str)|maxPlayerNr(int)+term
 REQ_PUT_NR = 'd'            #REQchr:xyz(int)+term
+REQ_VERSION = 'v'           #REQchr:highestVersion(int)+term, always in v1
+REQ_BOARD = 'e'             #v2 only: asks for a board snapshot (REP_BOARD)
+REQ_PONG = 'f'              #v2 only: answers REP_PING, payload echoed
+REQ_DIRECTORY = 'g'         #v2 only: asks for a page of the session
+                            #directory, openSpotsOnly(B)+maxPlayers(H)+
+                            #pageSize(H)+cursorLen(H)+cursor+namePrefix
+REQ_MATCH = 'h'             #REQchr:playerCount(int)|level(int)+term,
+                            #level 0 for the server's default
 
 ##REQ_DICT = {
 ##    REQ_NICKNAME: 'Client wants to connect with nickname'
@@ -14,14 +26,26 @@ REQ_PUT_NR = 'd'            #REQchr:xyz(int)+term
 
 # replies
 REP_CURRENT_SESSIONS = '0'  #REPnr:[sessName-currentPlayerNr/maxPlayerNr, ...]+term
+REP_BOARD = '1'             #v2 only: board update, payload as REP_TABLE
 REP_WAITING_PLAYERS = '2'   #REPnr:[nickname...]+term
 REP_PUT_NR = '3'            #REPnr:msg=Success/cell full/wrong+term
 REP_SCORES_GAME_OVER = '4'  #REPnr:[nickname|score, ...]+term
 
 REP_TABLE = '5'             #REPnr:sudokuTable(81 int)+term
+                            #v2: boardVersion(I)+packed cells (41 bytes)
 
 REP_NOTIFY = '6'            #REPnr:NotifyMsg+term
+REP_VERSION = '7'           #REPnr:agreedVersion(int)+term, always in v1
+REP_SCOREBOARD = '8'        #v2 only: [nameLen(B)+nickname+score(i), ...]
+REP_DELTA = 'D'             #v2 only: boardVersion(I)+cell(B)+value(B)+
+                            #scoreChange(b)+mover nickname
 REP_NOT_OK = '9'            #REPnr:ErrorMsg+term
+REP_PING = 'P'              #v2 only: heartbeat, the client sends REQ_PONG
+REP_DIRECTORY = 'S'         #v2 only: page of the session directory,
+                            #directoryVersion(I)+nextCursorLen(H)+
+                            #nextCursor+sessions as in REP_DIR_DELTA (added)
+REP_DIR_DELTA = 'U'         #v2 only: directoryVersion(I)+[op(B)+
+                            #freeSpots(H)+maxPlayers(H)+nameLen(H)+name...]
 
 ##REP_DICT = {
 ##    REP_CURRENT_SESSIONS: 'Sessions available on server'
@@ -40,3 +64,237 @@ FIELD_SEP = '|'
 MSG_TERMCHR = '#'
 
 
+# Protocol versions. v1 is the text protocol above. In v2 every frame has
+# a fixed binary header: type (the REQ/REP char), request id and payload
+# length, followed by the payload. Replies carry the id of the request,
+# notifications id 0. Moves, boards and scoreboards have binary payloads,
+# other payloads are the v1 text. A client asks for v2 by sending
+# REQ_VERSION before its nickname, both sides switch after REP_VERSION.
+# Old servers answer REP_NOT_OK and the client stays on v1.
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+PROTOCOL_VERSION = PROTOCOL_V2  # highest version supported
+
+V2_HEADER = struct.Struct('!cHI')
+V2_MOVE = struct.Struct('!BBB')
+V2_BOARD = struct.Struct('!I')
+V2_SCORE = struct.Struct('!i')
+V2_DELTA = struct.Struct('!IBBb')
+V2_DIRECTORY = struct.Struct('!I')
+V2_DIR_ENTRY = struct.Struct('!BHHH')
+V2_DIR_QUERY = struct.Struct('!BHHH')
+V2_DIR_PAGE = struct.Struct('!IH')
+
+# Session directory changes
+DIR_ADD = 0
+DIR_UPDATE = 1
+DIR_REMOVE = 2
+
+def encodeMessage(version, header, payload, reqId=0):
+    # Returns the frame of a message in the given protocol version
+    if version >= PROTOCOL_V2:
+        return V2_HEADER.pack(header, reqId, len(payload)) + payload
+    return header + HEADER_SEP + payload + MSG_TERMCHR
+
+def decodeFrame(version, frame):
+    # Returns (header, request id, payload) of a frame from frameReader
+    if version >= PROTOCOL_V2:
+        header, reqId, length = V2_HEADER.unpack_from(frame)
+        return header, reqId, frame[V2_HEADER.size:]
+    return frame[:1], 0, frame[2:]
+
+def packMove(x, y, number):
+    return V2_MOVE.pack(x, y, number)
+
+def unpackMove(payload):
+    return V2_MOVE.unpack(payload)
+
+# Cell values to hex digits and back, cells are packed through hex strings
+HEX_DIGITS = bytearray(range(256))
+HEX_DIGITS[:16] = '0123456789abcdef'
+FROM_HEX = bytearray(range(256))
+for i, c in enumerate('0123456789abcdef'):
+    FROM_HEX[ord(c)] = i
+
+def packCells(cells):
+    # Packs 81 cells (0..9) to 41 bytes, two cells per byte
+    return binascii.unhexlify(str(bytearray(cells).translate(HEX_DIGITS)) + '0')
+
+def unpackCells(packed):
+    # Unpacks 41 bytes to a bytearray of 81 cells
+    return bytearray(binascii.hexlify(packed)).translate(FROM_HEX)[:81]
+
+def packBoard(boardVersion, cells):
+    return V2_BOARD.pack(boardVersion) + packCells(cells)
+
+def unpackBoard(payload):
+    # Returns (board version, cells)
+    return V2_BOARD.unpack_from(payload)[0], \
+           unpackCells(payload[V2_BOARD.size:])
+
+def packDelta(boardVersion, cell, value, scoreChange, mover):
+    # A move: the cell (0..80) and its new value (0 if the cell did not
+    # change), the mover's score change and the board version after it
+    return V2_DELTA.pack(boardVersion, cell, value, scoreChange) + mover
+
+def unpackDelta(payload):
+    # Returns (board version, cell, value, score change, mover)
+    return V2_DELTA.unpack_from(payload) + (payload[V2_DELTA.size:],)
+
+def packScores(scores):
+    # Packs [(nickname, score), ...]
+    return ''.join(chr(len(n)) + n + V2_SCORE.pack(s) for n, s in scores)
+
+def unpackScores(payload):
+    scores, i = [], 0
+    while i < len(payload):
+        n = ord(payload[i])
+        scores.append((payload[i+1:i+1+n],
+                       V2_SCORE.unpack_from(payload, i+1+n)[0]))
+        i += 1 + n + V2_SCORE.size
+    return scores
+
+def packDirEntries(changes):
+    # Packs [(op, session name, free spots, max players), ...]
+    return ''.join(V2_DIR_ENTRY.pack(op, free, maxPlayers, len(name)) + name
+                   for op, name, free, maxPlayers in changes)
+
+def unpackDirEntries(payload, i):
+    # Unpacks the directory changes from offset i on
+    changes = []
+    while i < len(payload):
+        op, free, maxPlayers, n = V2_DIR_ENTRY.unpack_from(payload, i)
+        i += V2_DIR_ENTRY.size
+        changes.append((op, payload[i:i+n], free, maxPlayers))
+        i += n
+    return changes
+
+def packDirectory(directoryVersion, changes):
+    return V2_DIRECTORY.pack(directoryVersion) + packDirEntries(changes)
+
+def unpackDirectory(payload):
+    # Returns (directory version, [(op, name, free, max players), ...])
+    return V2_DIRECTORY.unpack_from(payload)[0], \
+           unpackDirEntries(payload, V2_DIRECTORY.size)
+
+def packQuery(openOnly, players, pageSize, cursor, prefix):
+    # A directory query: the sessions named after 'cursor' starting with
+    # 'prefix', only those with open spots and 'players' max players if
+    # set (0 for any). A page size of 0 leaves it to the server
+    return V2_DIR_QUERY.pack(openOnly, players, pageSize, len(cursor)) + \
+           cursor + prefix
+
+def unpackQuery(payload):
+    # Returns (open spots only, max players, page size, cursor, prefix)
+    openOnly, players, pageSize, n = V2_DIR_QUERY.unpack_from(payload)
+    i = V2_DIR_QUERY.size
+    return bool(openOnly), players, pageSize, payload[i:i+n], payload[i+n:]
+
+def packPage(directoryVersion, nextCursor, entries):
+    # A page of [(session name, free spots, max players), ...] in name
+    # order. The next page is queried from 'nextCursor', '' if this is
+    # the last page
+    return V2_DIR_PAGE.pack(directoryVersion, len(nextCursor)) + \
+           nextCursor + packDirEntries([(DIR_ADD,) + e for e in entries])
+
+def unpackPage(payload):
+    # Returns (directory version, next cursor, [(name, free, max), ...])
+    directoryVersion, n = V2_DIR_PAGE.unpack_from(payload)
+    i = V2_DIR_PAGE.size
+    return directoryVersion, payload[i:i+n], \
+           [e[1:] for e in unpackDirEntries(payload, i+n)]
+
+def directoryToString(entries):
+    # The lobby listing of [(session name, free spots, max players), ...]
+    if len(entries)==0:
+        return 'No sessions available. Create one!'
+    return 'Available sessions: %s' % ''.join(
+        '\n    %s (%d/%d spots available)' % e for e in entries)
+
+# Framing: reads messages from a socket in large chunks instead of one
+# byte at a time. Complete frames are split off the received data, an
+# incomplete frame is kept until the rest of it arrives.
+RECV_BUFSIZE = 4096
+# Largest frame a peer may send, room for the biggest board, scoreboard or
+# directory message (a v1 listing of some 20000 sessions). A peer sending
+# a bigger one is disconnected instead of being buffered
+MAX_FRAME_SIZE = 1 << 20
+
+class frameReader(object):
+    def __init__(self, soc, bufSize=RECV_BUFSIZE):
+        self.soc = soc
+        # Reused receive buffer, the data of the incomplete frame and the
+        # frames received but not yet read
+        self.buf = bytearray(bufSize)
+        self.view = memoryview(self.buf)
+        self.pending = bytearray()
+        self.scanned = 0
+        self.frames = deque()
+        self.version = PROTOCOL_V1
+
+    def setVersion(self, version):
+        # Switches the framing, data already received is split again
+        self.version = version
+        self.scanned = 0
+        self.frames.extend(self.split())
+
+    def readFrames(self):
+        # One recv call. Returns the frames it completed (maybe none),
+        # or None if the peer closed the connection. Socket errors, and
+        # frames over MAX_FRAME_SIZE, are left to the caller
+        n = self.soc.recv_into(self.buf)
+        if n <= 0:
+            return None
+        self.pending += self.view[:n]
+        return self.split()
+
+    def split(self):
+        # Splits the complete frames off the pending data
+        if self.version >= PROTOCOL_V2:
+            return self.splitV2()
+        frames = []
+        start = 0
+        end = self.pending.find(MSG_TERMCHR, self.scanned)
+        while end >= 0:
+            frames.append(str(self.pending[start:end]))
+            start = end + 1
+            end = self.pending.find(MSG_TERMCHR, start)
+        del self.pending[:start]
+        self.scanned = len(self.pending)
+        if self.scanned > MAX_FRAME_SIZE:
+            self.tooLarge(self.scanned)
+        return frames
+
+    def splitV2(self):
+        # Splits the complete length prefixed frames off the pending data
+        frames = []
+        start = 0
+        while len(self.pending) - start >= V2_HEADER.size:
+            header, reqId, length = V2_HEADER.unpack_from(
+                buffer(self.pending), start)
+            if length > MAX_FRAME_SIZE:
+                self.tooLarge(length)
+            end = start + V2_HEADER.size + length
+            if end > len(self.pending):
+                break
+            frames.append(str(self.pending[start:end]))
+            start = end
+        del self.pending[:start]
+        return frames
+
+    def tooLarge(self, size):
+        # The peer is disconnected like on a socket error
+        self.pending = bytearray()
+        self.scanned = 0
+        raise soc_err(errno.EMSGSIZE, 'Frame of %d bytes, at most %d '\
+                      'allowed' % (size, MAX_FRAME_SIZE))
+
+    def readFrame(self):
+        # Returns the next frame (in v1 without the terminating char), or
+        # '' if the peer closed the connection
+        while not self.frames:
+            frames = self.readFrames()
+            if frames is None:
+                return ''
+            self.frames.extend(frames)
+        return self.frames.popleft()
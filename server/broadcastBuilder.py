@@ -0,0 +1,103 @@
+# Builds the frames a session sends to its players. A broadcastBuilder
+# collects the events of one move (notifications, the move delta, game
+# over) and encodes them once per protocol version, so every player gets
+# all of them in a single write.
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from messageProtocol import *
+
+# The game state a frame carries in full. A client's outbound queue can
+# drop such a frame once a newer one with the same state is queued
+STATE_BOARD = 'board'
+STATE_SCORES = 'scores'
+
+
+def encodeBoard(version, sudoku, header=REP_NOTIFY):
+    # The sudoku board, as the designed table in v1 and as packed cells in
+    # v2 (REP_BOARD unless it is the REP_TABLE reply)
+    if version >= PROTOCOL_V2:
+        if header != REP_TABLE:
+            header = REP_BOARD
+        return encodeMessage(version, header,
+                             packBoard(sudoku.version, sudoku.current))
+    return encodeMessage(version, header, sudoku.sudoku_to_string())
+
+def encodeScoreboard(version, session):
+    # The session's scores and, in v1, the board progress
+    if version >= PROTOCOL_V2:
+        return encodeMessage(version, REP_SCOREBOARD,
+                             packScores(session.getScores()))
+    return encodeMessage(version, REP_NOTIFY, 'Scoreboard: ' + \
+        session.getScoresNicknames() + '\nProgress: ' + \
+        session.sudoku.progress_to_string() + '\n')
+
+def encodeMove(version, session, mover, cell, value, scoreChange):
+    # The result of a move. v2 clients get a delta they apply to their own
+    # board copy, v1 clients the scoreboard and the whole board
+    if version >= PROTOCOL_V2:
+        return encodeMessage(version, REP_DELTA,
+            packDelta(session.sudoku.version, cell, value, scoreChange,
+                      mover.nickname))
+    return encodeScoreboard(version, session) + \
+           encodeBoard(version, session.sudoku)
+
+def boardState(header=REP_NOTIFY):
+    # The REP_TABLE reply starts the game, it is never dropped
+    return None if header == REP_TABLE else STATE_BOARD
+
+def moveState(version):
+    # v2 deltas are small and build on each other, the v1 board replaces
+    # the earlier ones
+    return None if version >= PROTOCOL_V2 else STATE_BOARD
+
+
+class broadcastBuilder(object):
+    def __init__(self, session):
+        self.session = session
+        # (header, payload) or ('move', (mover, cell, value, scoreChange))
+        self.events = []
+        # protocol version -> ([(frame, state), ...], frame count)
+        self.encoded = {}
+        # Frames, bytes and writes of the last send()
+        self.frames = 0
+        self.bytes = 0
+        self.writes = 0
+
+    def notify(self, msg):
+        self.specific(REP_NOTIFY, msg)
+
+    def specific(self, header, msg):
+        self.events.append((header, msg))
+
+    def move(self, mover, cell, value, scoreChange):
+        self.events.append(('move', (mover, cell, value, scoreChange)))
+
+    def encode(self, version):
+        # Encodes all events for a protocol version, once per version
+        if version not in self.encoded:
+            out = []
+            frames = 0
+            for header, payload in self.events:
+                if header == 'move':
+                    out.append((encodeMove(version, self.session, *payload),
+                                moveState(version)))
+                    # v1 sends the scoreboard and the board
+                    frames += 1 if version >= PROTOCOL_V2 else 2
+                else:
+                    out.append((encodeMessage(version, header, payload),
+                                None))
+                    frames += 1
+            self.encoded[version] = (out, frames)
+        return self.encoded[version]
+
+    def send(self, clients):
+        # Queues the events for each client at once, the client's writer
+        # writes them together. Returns the number of clients queued for
+        out = 0
+        for c in clients:
+            data, frames = self.encode(c.version)
+            self.writes += 1
+            self.frames += frames
+            self.bytes += sum(len(f) for f, state in data)
+            out += bool(c.send_frames(data))
+        return out
@@ -13,13 +13,21 @@ import sessionClass as sc
 from serverMain import *
 from threading import Thread, Lock, currentThread
 
-from socket import AF_INET, SOCK_STREAM, socket
+from socket import AF_INET, SOCK_STREAM, SHUT_RDWR, socket
 from socket import error as soc_err
+import socket as sockets
 
-import os, sys, inspect
+# send() flag making a single send non-blocking (not on every platform,
+# there the send after select may block)
+MSG_DONTWAIT = getattr(sockets, 'MSG_DONTWAIT', 0)
+
+import os, sys, inspect, time, select, errno
 
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from messageProtocol import *
+from broadcastBuilder import *
+from outboundQueue import *
+from idleReaper import *
 
 
 class clientHandler(Thread):
@@ -32,6 +40,27 @@ class clientHandler(Thread):
         self.session = None
         self.Server = Server
         self.send_lock = Lock()
+        self.reader = frameReader(soc)
+        # Protocol version agreed with the client and the id of the request
+        # being handled (v2 only)
+        self.version = PROTOCOL_V1
+        self.reqId = 0
+        # The directory query being handled (v2 only, see decodeRequest)
+        self.dirQuery = None
+        # Frames waiting to be written by the writer thread
+        self.outbound = outboundQueue(Server.sendQueue, Server.sendHighWater,
+                                      Server.sendMaxBytes, Server.sendOverflow)
+        self.writer = Thread(target=self.write_loop)
+        self.writer.daemon = True
+        # Waits for the socket to take a write (see wait_writable)
+        self.write_poller = None
+        # Set when the connection was moved to another server process
+        self.handedOff = False
+        # When the client last sent something and was last pinged
+        self.lastSeen = time.time()
+        self.lastPing = 0
+        if Server.keepalive > 0:
+            enableKeepalive(soc, Server.keepalive)
 
     def getNickname(self):
         return self.nickname # returns string: client name
@@ -59,7 +88,7 @@ class clientHandler(Thread):
             x, y, number = int(ints[0]), int(ints[1]), int(ints[2])
             for n in [x,y,number]:
                 if n not in range(1,10):
-                    REP, MSG = REP_NOT_OK, "The number must be in [1..9]."
+                    return REP_NOT_OK, "The number must be in [1..9]."
             REP, MSG = self.session.putNumber(x, y, number, self)
         except ValueError:
             REP, MSG = REP_NOT_OK, "Unexpected error: Parsing int failed!"
@@ -69,20 +98,13 @@ class clientHandler(Thread):
         # Handles reading commands from TCP socket reads until
         # message terminating char. Handles socket errors and client
         # premature disconnection
-        m, b = '', ''
+        m = ''
         try:
-            b = self.soc.recv(1)
-            m += b
-            while len(b) > 0 and not (b.endswith(MSG_TERMCHR)):
-                b = self.soc.recv(1)
-                m += b
-
-            if len(b) <= 0:
+            m = self.reader.readFrame()
+            if len(m) <= 0:
                 LOG.info('Client %s:%d disconnected' % \
                          self.soc.getsockname())
                 self.soc.close()
-                m = ''
-            m = m[:-1]
         except KeyboardInterrupt:
             self.soc.close()
             LOG.info('Ctrl+C issued, disconnecting client %s:%d' \
@@ -94,40 +116,81 @@ class clientHandler(Thread):
                          % self.soc.getsockname())
             else:
                 LOG.error('Error: %s' % str(e))
+            self.Server.reaper.readFailed(e)
             self.soc.close()
-            LOG.info('Client %s:%d disconnected' % self.soc.getsockname())
+            LOG.info('Client %s disconnected' % self.nickname)
             m = ''
         return m
 
+    def negotiateVersion(self, payload):
+        # Agrees on the highest protocol version both sides support. The
+        # reply still goes out in v1, the following frames use the new
+        # version
+        try:
+            version = min(int(payload), PROTOCOL_VERSION)
+        except ValueError:
+            return REP_NOT_OK, 'Unable to parse version'
+        if self.nickname != None or version < PROTOCOL_V1:
+            return REP_NOT_OK, 'Cannot change protocol version'
+        self.send_specific(REP_VERSION, str(version))
+        self.version = version
+        self.reader.setVersion(version)
+        LOG.debug('Client %s:%d uses protocol version %d' \
+                  % (self.soc.getsockname() + (version,)))
+        return None, ''
+
+    def decodeRequest(self, frame):
+        # Turns a v2 frame into the v1 style message rcvProtocolMessage
+        # handles, and remembers its request id for the reply. A directory
+        # query has no v1 form, it is kept aside
+        header, self.reqId, payload = decodeFrame(self.version, frame)
+        if header == REQ_PUT_NR and len(payload) == V2_MOVE.size:
+            payload = '%d%d%d' % unpackMove(payload)
+        elif header == REQ_DIRECTORY and len(payload) >= V2_DIR_QUERY.size:
+            self.dirQuery = unpackQuery(payload)
+            payload = ''
+        return header + HEADER_SEP + payload
+
     def joinSession(self, sessName):
         # Tries to join a session by invoking session method.
         # Dependent on outcome returns a string. Upon the string
         # rcvProtocolMessage will take action
-        for sess in self.Server.sessionList:
-            if sessName == sess.sessName:
-                if sess.addMe(self):
-                    self.session = sess
-                    if self.session.gameRunning:
-                        return "Start"
-                    return 'Wait'
-                return "session full"
-        return "No such session"
+        sess = self.Server.getSession(sessName)
+        if sess == None:
+            return "No such session"
+        if sess.addMe(self):
+            self.session = sess
+            if self.session.gameRunning:
+                return "Start"
+            return 'Wait'
+        return "session full"
 
     def createSession(self, sessName, maxPlayerCount):
         # Creates a session and tries to join it.
         # Dependent on outcome returns a string. Upon the string
         # rcvProtocolMessage will take action
-        if sessName in self.Server.getSessNames():
+        if self.Server.hasSession(sessName):
             return REP_NOT_OK, "Session name in use"
         if maxPlayerCount < 2:
             return REP_NOT_OK, "Too few max players specified %d" % maxPlayerCount
         sess = sc.sessionClass(sessName, maxPlayerCount, self.Server)
-        self.Server.sessionList.append(sess)
-        self.session = sess
+        if not self.Server.addSession(sess):
+            return REP_NOT_OK, "Session name in use"
         if sess.addMe(self):
             self.session = sess
             return "OK", ""
-        return REP_NOT_OK, "session full"
+        # joined another session meanwhile (matched)
+        sess.abandon()
+        return REP_NOT_OK, "Leave current session"
+
+    def requestMatch(self, players, level):
+        # Queues the client to be matched into a session. The reply to a
+        # queued client is the same as to one joining a session, the game
+        # starts once the matcher fills the session
+        msg = self.Server.matcher.enqueue(self, players, level)
+        if msg != None:
+            return REP_NOT_OK, msg
+        return REP_WAITING_PLAYERS, ''
 
     def rcvProtocolMessage(self, message):
         # Takes action based on client actions. Checks if such actions
@@ -144,13 +207,22 @@ class clientHandler(Thread):
         payload = message[2:]
         # Client requests nickname - check if available and assemble reply
         if message.startswith(REQ_NICKNAME + HEADER_SEP):
-            if payload not in self.Server.getUsedNicknames():
-                self.nickname = payload
+            if self.Server.claimNickname(self, payload):
                 LOG.debug('Client %s:%d will use name ' \
                           '%s' % (self.soc.getsockname() + (self.nickname,)))
-                REP = REP_CURRENT_SESSIONS
-                MSG = ''
-                self.send_notification(self.Server.sessionList2string())
+                # A player of a session recovered from the move log gets
+                # their seat back, the others go to the lobby
+                sess = self.Server.takeSeat(self.nickname) \
+                       if self.session == None else None
+                msg = sess.resume(self) if sess != None else None
+                if msg == "Start":
+                    REP, MSG = None, ''
+                elif msg == "Wait":
+                    REP, MSG = REP_WAITING_PLAYERS, ''
+                else:
+                    REP = REP_CURRENT_SESSIONS
+                    MSG = ''
+                    self.Server.sessDirectory.subscribe(self)
             else:
                 REP, MSG = REP_NOT_OK, "Name in use"
         # Client wants to join a session - return if full/ok/game starts
@@ -197,6 +269,37 @@ class clientHandler(Thread):
                                   '%s' % (self.soc.getsockname() + (MSG,)))
             except:
                 REP, MSG = REP_NOT_OK, "Unable to parse integer"
+        # Client wants to be matched into a session
+        elif message.startswith(REQ_MATCH + HEADER_SEP):
+            try:
+                if self.nickname == None:
+                    LOG.debug('Name unknown at matchmaking: %s ' % message)
+                    REP, MSG = REP_NOT_OK, "Specify name"
+                elif self.session != None:
+                    LOG.debug('Matchmaking while in session: %s ' % message)
+                    REP, MSG = REP_NOT_OK, "Leave current session"
+                else:
+                    players, level = map(int, payload.split(FIELD_SEP))
+                    REP, MSG = self.requestMatch(players, level)
+            except ValueError:
+                REP, MSG = REP_NOT_OK, "Unable to parse integer"
+        # Client wants to use another protocol version
+        elif message.startswith(REQ_VERSION + HEADER_SEP):
+            REP, MSG = self.negotiateVersion(payload)
+        # Client answers a heartbeat (handleFrame noted it is alive)
+        elif message.startswith(REQ_PONG + HEADER_SEP):
+            REP, MSG = None, ''
+        # Client wants a page of the session directory (v1: the listing)
+        elif message.startswith(REQ_DIRECTORY + HEADER_SEP):
+            if self.dirQuery != None:
+                self.Server.sessDirectory.query(self, *self.dirQuery)
+                self.dirQuery = None
+            else:
+                self.Server.sessDirectory.subscribe(self)
+            REP, MSG = None, ''
+        # Client wants a board snapshot (no reply if not in game)
+        elif message.startswith(REQ_BOARD + HEADER_SEP):
+            REP, MSG = self.send_snapshot()
         # Client wants to interact with sudoku
         elif message.startswith(REQ_PUT_NR + HEADER_SEP):
             if self.session == None:
@@ -212,15 +315,65 @@ class clientHandler(Thread):
         return REP, MSG
 
 
-    def session_send(self, msg):
-        # add message terminating char to the end and send it out\
-        m = msg + MSG_TERMCHR
-        LOG.info('Send to %s : %s' % (self.nickname, m))
+    def session_send(self, msg, reqId=0):
+        # frame the 'header:payload' message in the client's protocol
+        # version and send it out
+        return self.send_frame(encodeMessage(self.version, msg[:1], msg[2:],
+                                             reqId))
+
+    def send_frame(self, m, state=None):
+        # queue a framed message for the writer (see send_frames)
+        return self.send_frames([(m, state)])
+
+    def send_frames(self, frames):
+        # queue [(framed message, state), ...] for the writer. Returns
+        # False if the client is disconnected as a slow consumer
+        for m, state in frames:
+            LOG.info('Send to %s : %s' % (self.nickname,
+                     m if self.version < PROTOCOL_V2 else repr(m)))
+        if self.outbound.put(frames) == QUEUED:
+            return True
+        LOG.warn('Outbound queue of %s full, disconnecting' % self.nickname)
+        self.disconnect()
+        return False
+
+    def disconnect(self):
+        # Shuts the socket down. The reading side sees the connection
+        # closed and removes the client the usual way
+        self.outbound.close()
+        try:
+            self.soc.shutdown(SHUT_RDWR)
+        except soc_err:
+            pass
+
+    def write_loop(self):
+        # Writer thread: writes the queued frames until the queue closes
+        try:
+            while True:
+                frames = self.outbound.get()
+                if frames is None:
+                    break
+                m = ''.join(frames)
+                if not self.write_frame(m):
+                    break
+                self.outbound.wrote(len(frames), len(m))
+        except Exception as e:
+            # without its writer the client would get nothing more
+            LOG.error('Writer of client %s failed: %s' % (self.nickname, e))
+            self.disconnect()
+
+    def write_frame(self, m):
+        # write out a framed message. A client that does not take it
+        # within the send deadline is disconnected
         with self.send_lock:
             r = False
             try:
-                self.soc.sendall(m)
-                r = True
+                if self.Server.sendDeadline > 0:
+                    r = self.send_before(m,
+                                         time.time() + self.Server.sendDeadline)
+                else:
+                    self.soc.sendall(m)
+                    r = True
             except KeyboardInterrupt:
                 self.soc.close()
                 LOG.info('Ctrl+C issued, disconnecting client %s:%d' \
@@ -228,36 +381,111 @@ class clientHandler(Thread):
             except soc_err as e:
                 if e.errno == 107:
                     LOG.warn('Client %s left before server could handle it' \
-                             '' % self.soc.nickname)
+                             '' % self.nickname)
                 else:
                     LOG.error('Error: %s' % str(e))
-                self.soc.close()
-                LOG.info('Client %s:%d disconnected' % self.soc.getsockname())
+                self.disconnect()
+                LOG.info('Client %s disconnected' % self.nickname)
             return r
 
+    def send_before(self, m, deadline):
+        # sends m without blocking past the deadline, False if it was
+        # missed. Socket errors are left to the caller
+        view = memoryview(m)
+        while len(view):
+            timeout = deadline - time.time()
+            if timeout <= 0 or not self.wait_writable(timeout):
+                LOG.warn('Client %s missed the send deadline, disconnecting'
+                         % self.nickname)
+                self.outbound.evicted()
+                self.disconnect()
+                return False
+            try:
+                view = view[self.soc.send(view, MSG_DONTWAIT):]
+            except soc_err as e:
+                if e.errno not in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    raise
+        return True
+
+    def wait_writable(self, timeout):
+        # True if the socket takes a write within timeout seconds. poll
+        # takes any file number (select only those under 1024), select is
+        # left for the platforms without poll
+        if not hasattr(select, 'poll'):
+            return bool(select.select([], [self.soc], [], timeout)[1])
+        if self.write_poller == None:
+            self.write_poller = select.poll()
+            self.write_poller.register(self.soc, select.POLLOUT)
+        return bool(self.write_poller.poll(max(1, int(timeout * 1000))))
+
     def send_notification(self, message):
         # sends nofify message
         return self.session_send(REP_NOTIFY + HEADER_SEP + message)
 
-    def send_specific(self, header, message):
+    def send_specific(self, header, message, reqId=0):
         # allows to send message with any header
-        return self.session_send(header + HEADER_SEP + message)
+        return self.session_send(header + HEADER_SEP + message, reqId)
+
+    def send_board(self, sudoku, header=REP_NOTIFY):
+        # sends the sudoku board (see encodeBoard)
+        return self.send_frame(encodeBoard(self.version, sudoku, header),
+                               boardState(header))
+
+    def send_move(self, session, mover, cell, value, scoreChange):
+        # sends the result of a move (see encodeMove)
+        return self.send_frame(encodeMove(self.version, session, mover, cell,
+                                          value, scoreChange),
+                               moveState(self.version))
+
+    def send_snapshot(self):
+        # sends the board and scores of the running game (REQ_BOARD)
+        session = self.session
+        if session != None:
+            session.send_snapshot(self)
+        return None, ''
+
+    def send_scoreboard(self, session):
+        # sends the session's scores and the board progress
+        return self.send_frame(encodeScoreboard(self.version, session),
+                               STATE_SCORES)
+
+    def handleFrame(self, m):
+        # Handles one received frame and sends the reply. Returns False if
+        # the reply could not be sent
+        LOG.debug('Raw msg: %s' % m)
+        self.lastSeen = time.time()
+        if self.version >= PROTOCOL_V2:
+            m = self.decodeRequest(m)
+        return self.handleRequest(m)
+
+    def handleRequest(self, m):
+        # Handles a v1 style request and sends the reply. A connection
+        # moved to another process is replied to there
+        rsp, msg = self.rcvProtocolMessage(m)
+        if not rsp or self.handedOff:
+            return True
+        return self.send_specific(rsp, msg, self.reqId)
+
+    def close(self):
+        # Client handler closing - remove it from the server and session
+        self.exists = False
+        self.outbound.close()
+        self.Server.countOutbound(self.outbound.getStats())
+        if self.session != None:
+            self.session.removeMe(self)
+        self.Server.removeMe(self)
 
     def run(self):
         # Main client loop
+        self.writer.start()
         while True:
             m = self.rcvMessage()
-            LOG.debug('Raw msg: %s' % m)
             if len(m) <= 0:
                 break
-            rsp, msg = self.rcvProtocolMessage(m)
-            if not rsp:
-                continue
-            if not self.send_specific(rsp, msg):
+            if not self.handleFrame(m):
                 break
-
-        # Client handler closing - remove it from the server and session
-        self.exists = False
-        if self.session != None:
-            self.session.removeMe()
-        self.Server.removeMe()
+            if self.handedOff:
+                # the connection is served by another process now
+                self.soc.close()
+                return
+        self.close()
@@ -0,0 +1,252 @@
+# Single threaded server core. Instead of a clientHandler thread per client
+# one loop waits on the listener and all client sockets (epoll where the
+# platform has it, select otherwise) and handles the frames of whichever
+# sockets are readable. The requests are handled by the same clientHandler
+# code, so lobby, session and move handling stay the same. Instead of a
+# writer thread the loop writes the clients' outbound queues whenever
+# their sockets take more data.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+import select, errno, time
+from clientHandler import *
+
+# Seconds a poll waits before checking if the loop should stop
+POLL_TIMEOUT = 1.0
+READ = select.POLLIN
+WRITE = select.POLLOUT
+
+
+class clientConnection(clientHandler):
+    # A clientHandler driven by the event loop instead of its own threads.
+    # The threads are never started, the loop calls onReadable() whenever
+    # the socket has data and flush() when there is something to write
+    def __init__(self, soc, Server, loop):
+        clientHandler.__init__(self, soc, Server)
+        soc.setblocking(0)
+        self.loop = loop
+        self.fd = soc.fileno()
+        self.events = READ
+        # The frames the socket did not take yet and how many they are
+        self.unsent = ''
+        self.unsentFrames = 0
+        # Since when the socket has not taken everything
+        self.blockedSince = None
+        self.outbound.onPut = lambda: self.loop.dirty.add(self.fd)
+
+    def disconnect(self):
+        # The loop drops the connection
+        clientHandler.disconnect(self)
+        self.loop.failed.add(self.fd)
+
+    def flush(self):
+        # Writes the queued frames until the socket would block. Returns
+        # True if everything was written
+        while True:
+            if not self.unsent:
+                frames = self.outbound.getNowait()
+                if not frames:
+                    self.blockedSince = None
+                    return True
+                self.unsent = ''.join(frames)
+                self.unsentFrames = len(frames)
+            try:
+                n = self.soc.send(self.unsent)
+            except soc_err as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    if self.blockedSince == None:
+                        self.blockedSince = time.time()
+                    return False
+                LOG.error('Error: %s' % str(e))
+                self.disconnect()
+                return True
+            self.unsent = self.unsent[n:]
+            if not self.unsent:
+                self.outbound.wrote(self.unsentFrames, 0)
+            self.outbound.wrote(0, n)
+
+    def onReadable(self):
+        # Reads what the socket has and handles the complete frames.
+        # Returns False once the connection is closed
+        try:
+            frames = self.reader.readFrames()
+        except soc_err as e:
+            if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                return True
+            LOG.error('Error: %s' % str(e))
+            self.Server.reaper.readFailed(e)
+            frames = None
+        if frames is None:
+            LOG.info('Client %s disconnected' % self.nickname)
+            return False
+        # Frames split again by a version switch are queued in the reader
+        self.reader.frames.extend(frames)
+        while self.reader.frames:
+            if not self.handleFrame(self.reader.frames.popleft()):
+                return False
+        return True
+
+
+class selectPoller(object):
+    # The part of the epoll interface the loop uses, on top of select
+    def __init__(self):
+        # file number -> events
+        self.fds = {}
+
+    def register(self, fd, events=READ):
+        self.fds[fd] = events
+
+    def modify(self, fd, events):
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        self.fds.pop(fd, None)
+
+    def poll(self, timeout):
+        readable, writable, x = select.select(self.fds.keys(),
+            [fd for fd, ev in self.fds.items() if ev & WRITE], [], timeout)
+        events = dict((fd, READ) for fd in readable)
+        for fd in writable:
+            events[fd] = events.get(fd, 0) | WRITE
+        return events.items()
+
+    def close(self):
+        self.fds.clear()
+
+
+def makePoller():
+    if hasattr(select, 'epoll'):
+        return select.epoll()
+    return selectPoller()
+
+
+class eventLoop(object):
+    def __init__(self, Server):
+        self.Server = Server
+        self.poller = makePoller()
+        # socket file number -> clientConnection
+        self.connections = {}
+        # connections to drop after a failed send or a full queue, the
+        # ones with frames to write and the ones waiting to be writable
+        self.failed = set()
+        self.dirty = set()
+        self.blocked = set()
+        self.running = False
+
+    def accept(self):
+        # Accepts a client and puts it in the lobby
+        client_socket, client_addr = self.Server.s.accept()
+        c = clientConnection(client_socket, self.Server, self)
+        self.connections[c.fd] = c
+        self.poller.register(c.fd, READ)
+        self.Server.addClient(c)
+        self.Server.addToLobby([c])
+
+    def drop(self, fd):
+        # Closes a connection and removes the client from server and session
+        c = self.connections.pop(fd, None)
+        self.failed.discard(fd)
+        self.blocked.discard(fd)
+        if c == None:
+            return
+        try:
+            self.poller.unregister(fd)
+        except (IOError, OSError, ValueError):
+            pass # already closed
+        c.soc.close()
+        c.close()
+
+    def dropFailed(self):
+        # Drops the connections closed by failed sends. Dropping notifies
+        # the other players, which can fail more sends
+        while self.failed:
+            self.drop(self.failed.pop())
+
+    def flush(self):
+        # Writes the queued frames of the connections that have some and
+        # waits for the sockets that did not take everything to be writable
+        while self.dirty or self.failed:
+            self.dropFailed()
+            dirty, self.dirty = self.dirty, set()
+            for fd in dirty:
+                c = self.connections.get(fd)
+                if c == None or fd in self.failed:
+                    continue
+                try:
+                    flushed = c.flush()
+                except Exception:
+                    # only this client is dropped, the loop goes on
+                    LOG.exception('Writing to client %s failed' % c.nickname)
+                    c.disconnect()
+                    continue
+                if flushed:
+                    events = READ
+                    self.blocked.discard(fd)
+                else:
+                    events = READ | WRITE
+                    self.blocked.add(fd)
+                if events != c.events:
+                    self.poller.modify(fd, events)
+                    c.events = events
+
+    def evictSlow(self):
+        # Disconnects the clients whose sockets have not taken their
+        # frames within the send deadline
+        if self.Server.sendDeadline <= 0:
+            return
+        now = time.time()
+        for fd in list(self.blocked):
+            c = self.connections[fd]
+            if now - c.blockedSince > self.Server.sendDeadline:
+                LOG.warn('Client %s missed the send deadline, disconnecting'
+                         % c.nickname)
+                c.outbound.evicted()
+                c.disconnect()
+        self.dropFailed()
+
+    def onReadable(self, c):
+        # Handles what a client sent. An error handling it drops only this
+        # client, with the traceback logged. Returns False to drop it
+        try:
+            return c.onReadable()
+        except Exception:
+            LOG.exception('Handling client %s failed' % c.nickname)
+            return False
+
+    def run(self):
+        # Serves all clients until stop() or Ctrl+C
+        listener = self.Server.s.fileno()
+        self.poller.register(listener, READ)
+        self.running = True
+        LOG.info('Serving clients from one event loop (%s)' \
+                 % self.poller.__class__.__name__)
+        try:
+            while self.running:
+                timeout = self.Server.seatsTimeout(
+                    self.Server.matcher.timeout(
+                    self.Server.sessDirectory.timeout(POLL_TIMEOUT)))
+                for fd, event in self.poller.poll(max(0, timeout)):
+                    if fd == listener:
+                        self.accept()
+                    elif fd in self.connections and fd not in self.failed:
+                        if event & WRITE:
+                            self.dirty.add(fd)
+                        if event & ~WRITE and \
+                           not self.onReadable(self.connections[fd]):
+                            self.drop(fd)
+                    self.dropFailed()
+                self.Server.reaper.tick(self.connections.values())
+                self.Server.sessDirectory.tick()
+                self.Server.matcher.tick()
+                self.Server.seatsTick()
+                self.flush()
+                self.evictSlow()
+        finally:
+            for fd in self.connections.keys():
+                self.drop(fd)
+            self.poller.close()
+
+    def stop(self):
+        self.running = False
@@ -0,0 +1,122 @@
+# Runs make_sudoku in a pool of worker processes, so that puzzle
+# generation does not compete for the GIL with the clientHandler threads.
+# Jobs wait in one queue per difficulty level and are handed to the
+# workers round robin, at most one job per worker at a time.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+import random
+from collections import deque
+from multiprocessing import Pool, cpu_count
+from threading import Thread, Condition
+from sudoku_new import *
+
+
+def _reseed():
+    # Forked workers inherit the parent's random state, reseed them so
+    # they don't all produce the same puzzles
+    random.seed()
+    np.random.seed()
+
+def _generate(level):
+    # Runs in a worker process. Returns None instead of raising, because
+    # a failed job would otherwise never be reported back
+    try:
+        return make_sudoku(level)
+    except Exception:
+        return None
+
+
+class generatorFarm(object):
+    def __init__(self, workers=None):
+        # Number of worker processes, defaults to the number of cores
+        self.workers = workers or cpu_count()
+        self.pool = None
+        # Waiting jobs per level (callbacks), and jobs being generated
+        self.jobsLock = Condition()
+        self.jobs = {}
+        self.levels = deque()
+        self.inFlight = 0
+        self.running = False
+        self.cancelled = 0
+        self.dispatcher = None
+
+    def start(self):
+        # Starts the worker processes and the dispatcher thread
+        self.pool = Pool(self.workers, initializer=_reseed)
+        self.running = True
+        self.dispatcher = Thread(name='GeneratorFarm', target=self.dispatch)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        LOG.info('Generator farm started with %d workers' % self.workers)
+
+    def submit(self, level, callback):
+        # Queues a puzzle of the given level. callback(level, puzzle) is
+        # called from the pool's result thread when it is ready
+        with self.jobsLock:
+            if not self.running:
+                return False
+            if level not in self.jobs:
+                self.jobs[level] = deque()
+                self.levels.append(level)
+            self.jobs[level].append(callback)
+            self.jobsLock.notify()
+            return True
+
+    def queued(self, level):
+        # Returns the number of jobs waiting for the level
+        with self.jobsLock:
+            return len(self.jobs.get(level, ()))
+
+    def nextJob(self):
+        # Picks the next waiting job, rotating over the levels
+        for i in range(len(self.levels)):
+            level = self.levels[0]
+            self.levels.rotate(-1)
+            if self.jobs[level]:
+                return level, self.jobs[level].popleft()
+        return None
+
+    def dispatch(self):
+        # Dispatcher loop. Keeps every worker busy while there are jobs
+        while True:
+            with self.jobsLock:
+                job = None
+                while self.running:
+                    if self.inFlight < self.workers:
+                        job = self.nextJob()
+                        if job != None:
+                            break
+                    self.jobsLock.wait()
+                if not self.running:
+                    return
+                self.inFlight += 1
+            level, callback = job
+            self.pool.apply_async(_generate, (level,),
+                callback=lambda p, l=level, c=callback: self.done(l, c, p))
+
+    def done(self, level, callback, puzzle):
+        # A worker finished, frees its slot and hands over the puzzle
+        with self.jobsLock:
+            self.inFlight -= 1
+            self.jobsLock.notify()
+        if puzzle is None:
+            LOG.error('Generating a level %d puzzle failed' % level)
+        callback(level, puzzle)
+
+    def shutdown(self):
+        # Cancels the waiting jobs and stops the worker processes
+        with self.jobsLock:
+            if not self.running:
+                return
+            self.running = False
+            self.cancelled += sum(map(len, self.jobs.values()))
+            self.jobs = {}
+            self.levels.clear()
+            self.jobsLock.notifyAll()
+        self.pool.terminate()
+        self.pool.join()
+        LOG.info('Generator farm stopped, %d queued jobs cancelled' \
+                 % self.cancelled)
@@ -0,0 +1,109 @@
+# Finds the connections of clients that went away without closing them
+# (a laptop closed, a NAT mapping timed out). Such clients never send
+# again and their reading side would wait forever, so they stay in the
+# lobby and their sessions. v2 clients that have been silent for a
+# heartbeat interval are pinged and answer with a pong; one that stays
+# silent past the idle timeout is disconnected, which removes it the same
+# way as a client that quits. v1 clients cannot answer pings, their dead
+# connections are found by TCP keepalive instead.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+import os,sys,time,errno
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from threading import Thread, Lock, Event
+from socket import SOL_SOCKET, SO_KEEPALIVE, IPPROTO_TCP
+import socket as sockets
+from messageProtocol import *
+
+# Seconds between the checks of the connections
+REAP_INTERVAL = 1.0
+# Unanswered keepalive probes before the kernel drops a connection
+KEEPALIVE_PROBES = 4
+
+
+def enableKeepalive(soc, idle):
+    # Lets the kernel probe a connection silent for 'idle' seconds, a dead
+    # peer then fails the reads. The timing options are not on every
+    # platform, there the system defaults apply
+    soc.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+    for name, value in [('TCP_KEEPIDLE', idle),
+                        ('TCP_KEEPINTVL', max(1, idle // KEEPALIVE_PROBES)),
+                        ('TCP_KEEPCNT', KEEPALIVE_PROBES)]:
+        if hasattr(sockets, name):
+            soc.setsockopt(IPPROTO_TCP, getattr(sockets, name), int(value))
+
+
+class idleReaper(object):
+    def __init__(self, Server, heartbeat=15.0, idleTimeout=45.0):
+        self.Server = Server
+        # Seconds of silence before a ping and before disconnecting, 0
+        # turns either off
+        self.heartbeat = heartbeat
+        self.idleTimeout = idleTimeout
+        # Counters
+        self.statsLock = Lock()
+        self.pings = 0
+        self.reaped = 0
+        self.keepaliveDrops = 0
+        self.stopped = Event()
+        self.thread = None
+        self.nextCheck = 0
+
+    def start(self):
+        # Checks the server's clients from a thread (threaded core)
+        self.stopped.clear()
+        self.thread = Thread(name='IdleReaper', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(REAP_INTERVAL):
+            self.check(self.Server.getClients(), time.time())
+
+    def tick(self, clients):
+        # Checks the clients at most every REAP_INTERVAL, for a caller
+        # without a reaper thread (the event loop)
+        now = time.time()
+        if now >= self.nextCheck:
+            self.nextCheck = now + REAP_INTERVAL
+            self.check(clients, now)
+
+    def check(self, clients, now):
+        # Pings the v2 clients silent for a heartbeat interval and
+        # disconnects the ones silent past the idle timeout
+        for c in clients:
+            if c.version < PROTOCOL_V2 or c.handedOff or c.outbound.closed:
+                continue
+            idle = now - c.lastSeen
+            if self.idleTimeout > 0 and idle > self.idleTimeout:
+                LOG.warn('Client %s silent for %.0f s, disconnecting'
+                         % (c.nickname, idle))
+                with self.statsLock:
+                    self.reaped += 1
+                c.disconnect()
+            elif self.heartbeat > 0 and \
+                 now - max(c.lastSeen, c.lastPing) >= self.heartbeat:
+                c.lastPing = now
+                with self.statsLock:
+                    self.pings += 1
+                c.send_specific(REP_PING, '')
+
+    def readFailed(self, e):
+        # Counts a connection the kernel dropped after unanswered keepalive
+        # probes, the reads of such a connection fail with ETIMEDOUT
+        if e.errno == errno.ETIMEDOUT:
+            with self.statsLock:
+                self.keepaliveDrops += 1
+
+    def getStats(self):
+        # Returns the pings sent and the connections reclaimed, those
+        # silent past the idle timeout and those dropped by keepalive
+        with self.statsLock:
+            return {'pings': self.pings, 'reaped': self.reaped,
+                    'keepalive_drops': self.keepaliveDrops}
@@ -0,0 +1,211 @@
+# Automatic matchmaking. Instead of typing the name of a session to join,
+# a lobby client asks to be matched and waits in a queue bucket of the
+# player count and difficulty it wants. The matcher goes through the
+# buckets every interval and forms as many full sessions as they have
+# players for. The sessions get pooled puzzles of the bucket's difficulty
+# and start right away. A client leaving the lobby (joining a session
+# itself, disconnecting) leaves its queue. The times the players waited
+# are kept for the wait time percentiles.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+import os,sys,time
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from threading import Thread, Lock, Event
+from collections import OrderedDict, deque
+from sudoku_new import LEVEL
+
+# Wait times kept for the percentiles, the oldest are dropped
+WAIT_SAMPLES = 10000
+
+
+def percentile(values, p):
+    # The p-th percentile of a sorted list, 0 if it is empty
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class matchmaker(object):
+    def __init__(self, Server, interval=0.5, levels=(LEVEL,)):
+        self.Server = Server
+        # Seconds between the matching rounds, the difficulties offered
+        # (the first is the default)
+        self.interval = interval
+        self.levels = levels
+        # (players, level) -> OrderedDict client -> time it was queued, in
+        # queue order, and client -> its bucket
+        self.lock = Lock()
+        self.buckets = {}
+        self.waiting = {}
+        self.stopped = Event()
+        self.thread = None
+        self.nextMatch = 0
+        # Sessions formed so far, numbering their names
+        self.formed = 0
+        # Counters and the wait times of the matched players
+        self.queued = 0
+        self.cancelled = 0
+        self.matched = 0
+        self.waits = deque(maxlen=WAIT_SAMPLES)
+
+    def start(self):
+        # Matches from a thread (threaded core)
+        self.stopped.clear()
+        self.thread = Thread(name='Matchmaker', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.match()
+
+    def timeout(self, limit):
+        # Seconds until the next round is due, at most 'limit'
+        if not self.waiting:
+            return limit
+        return min(limit, self.nextMatch - time.time())
+
+    def tick(self):
+        # Matches if the round is due, for a caller without the thread
+        # (the event loop)
+        now = time.time()
+        if now >= self.nextMatch:
+            self.nextMatch = now + self.interval
+            if self.waiting:
+                self.match()
+
+    def enqueue(self, c, players, level):
+        # Queues a lobby client for a session of 'players' players of the
+        # level (0 for the default). Returns an error message, None if the
+        # client was queued
+        if level == 0:
+            level = self.levels[0]
+        if level not in self.levels:
+            return 'Difficulty must be one of %s' \
+                   % ', '.join(map(str, self.levels))
+        if players < 2:
+            return 'Too few players specified %d' % players
+        self.cancel(c)
+        with self.lock:
+            key = (players, level)
+            self.buckets.setdefault(key, OrderedDict())[c] = time.time()
+            self.waiting[c] = key
+            self.queued += 1
+        LOG.debug('%s queued for %d players, level %d' \
+                  % (c.nickname, players, level))
+        return None
+
+    def cancel(self, c):
+        # Takes a client out of its queue. Returns True if it was queued
+        with self.lock:
+            key = self.waiting.pop(c, None)
+            if key == None:
+                return False
+            bucket = self.buckets[key]
+            del bucket[c]
+            if not bucket:
+                del self.buckets[key]
+            self.cancelled += 1
+            return True
+
+    def match(self):
+        # Forms the sessions the queued players fill, oldest players first
+        groups = []
+        now = time.time()
+        with self.lock:
+            for key, bucket in self.buckets.items():
+                players, level = key
+                while len(bucket) >= players:
+                    group = [bucket.popitem(last=False)
+                             for i in range(players)]
+                    for c, since in group:
+                        del self.waiting[c]
+                    groups.append((players, level, group))
+                if not bucket:
+                    del self.buckets[key]
+        formed = 0
+        for players, level, group in groups:
+            formed += self.startSession(players, level, group, now)
+        if formed:
+            LOG.info('Matchmaker formed %d sessions' % formed)
+
+    def startSession(self, players, level, group, now):
+        # Creates a session for the matched (client, time queued) pairs
+        # and adds them, the game starts with the last of them. Returns
+        # True if all of them were seated
+        sess = self.newSession(players, level)
+        seated = []
+        for c, since in group:
+            # A client that joined a session itself after it was taken out
+            # of the queue is refused
+            if not sess.addMe(c):
+                continue
+            # A client that disconnected meanwhile was removed from the
+            # server before it was checked for a session (see removeMe),
+            # so it is either gone from the session or found here
+            if not self.Server.hasClient(c):
+                sess.removeMe(c)
+                continue
+            seated.append((c, since))
+        if len(seated) < players:
+            # The session would never fill, the others go back to the
+            # lobby and to the front of their queue
+            for c, since in seated:
+                sess.removeMe(c)
+                self.Server.addToLobby([c])
+            self.requeue((players, level), seated)
+            LOG.info('Session %s not filled, %d players queued again'
+                     % (sess.sessName, len(seated)))
+            return False
+        with self.lock:
+            self.matched += players
+            self.waits.extend(now - since for c, since in group)
+        LOG.info('Matched %s into session %s' % (', '.join(c.nickname for
+                 c, since in group), sess.sessName))
+        return True
+
+    def requeue(self, key, group):
+        # Puts matched (client, time queued) pairs back in front of their
+        # queue, unless they left the lobby or queued again meanwhile
+        group = [(c, since) for c, since in group
+                 if self.Server.hasClient(c) and c.session == None]
+        with self.lock:
+            group = [(c, since) for c, since in group
+                     if c not in self.waiting]
+            if not group:
+                return
+            bucket = self.buckets.get(key, OrderedDict())
+            self.buckets[key] = OrderedDict(group + bucket.items())
+            for c, since in group:
+                self.waiting[c] = key
+
+    def newSession(self, players, level):
+        # A session under a name not in use, which this server (its
+        # shard) owns. Imported here, sessionClass imports serverMain
+        from sessionClass import sessionClass
+        sess = sessionClass(None, players, self.Server, level)
+        while True:
+            self.formed += 1
+            sess.sessName = 'match%d' % self.formed
+            if self.Server.ownsSession(sess.sessName) and \
+               self.Server.addSession(sess):
+                return sess
+
+    def getStats(self):
+        # Returns the players queued, matched and cancelled, the ones
+        # waiting now and the wait time percentiles in seconds
+        with self.lock:
+            waits = sorted(self.waits)
+            stats = {'queued': self.queued, 'matched': self.matched,
+                     'cancelled': self.cancelled,
+                     'waiting': len(self.waiting)}
+        for p in [50, 90, 99]:
+            stats['wait_p%d' % p] = percentile(waits, p)
+        stats['wait_max'] = waits[-1] if waits else 0.0
+        return stats
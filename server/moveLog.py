@@ -0,0 +1,292 @@
+# Write-ahead move log. Every session appends what changes its state (a
+# player joining with their score, a move with its score change, a player
+# leaving) to a log file of its own, so the running games survive the
+# server process. The records are written and fsynced by a writer thread
+# every sync interval, all sessions' records of the interval in one batch
+# per file; a crash loses at most the records of the last interval. With
+# a sync interval of 0 every record is fsynced before the move returns.
+#
+# The first record of a log is a snapshot of the session (the puzzle, its
+# solution, the board, the players and their scores). Every so many
+# records the log is compacted: the session's snapshot is written to a new
+# file that replaces the log. A game that ends removes its log.
+#
+# On start the server replays the logs: the snapshot and the records
+# after it, up to a record torn by the crash. The rebuilt sessions keep
+# the seats of their players until they log in again.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+import os,sys,json,binascii
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from threading import Thread, Lock, Event
+from collections import OrderedDict
+from sudoku_new import CELL_CHARS
+
+LOG_SUFFIX = '.log'
+TMP_SUFFIX = '.tmp'
+# Strings are logged byte for byte (nicknames are not always UTF-8)
+ENCODING = 'latin-1'
+
+
+def logName(sessName):
+    # The file name of a session's log, the name may hold any characters
+    return binascii.hexlify(sessName) + LOG_SUFFIX
+
+def encodeCells(cells):
+    # 81 cells (0..9) as a string of digits
+    return str(bytearray(cells).translate(CELL_CHARS))
+
+def decodeCells(digits):
+    return map(int, digits)
+
+def fsyncDir(path):
+    # Makes a file created or renamed in the directory durable. Not every
+    # platform can open a directory, there it is left to the system
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def replay(lines):
+    # Rebuilds the state of a session from its log lines: a snapshot dict
+    # with the board and the players ([nickname, score], ...) as of the
+    # last record. None if the log has no snapshot
+    state = None
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            # torn by the crash, the records after it never made it
+            break
+        op = record[0]
+        if op == 'snapshot':
+            state = record[1]
+            players = OrderedDict((n.encode(ENCODING), s)
+                                  for n, s in state['players'])
+        elif state == None:
+            break
+        elif op == 'join':
+            players[record[1].encode(ENCODING)] = record[2]
+            if len(players) == state['max']:
+                state['running'] = True
+        elif op == 'leave':
+            players.pop(record[1].encode(ENCODING), None)
+        elif op == 'move':
+            nickname, cell, value, scoreChange = record[1:]
+            if value:
+                state['board'] = state['board'][:cell] + str(value) + \
+                                 state['board'][cell+1:]
+            nickname = nickname.encode(ENCODING)
+            if nickname in players:
+                players[nickname] += scoreChange
+    if state != None:
+        state['name'] = state['name'].encode(ENCODING)
+        state['board'] = str(state['board'])
+        state['solution'] = str(state['solution'])
+        state['players'] = players.items()
+    return state
+
+
+class sessionLog(object):
+    # The log of one session. Records are appended under the session's
+    # lock; the writer takes them and writes them out
+    def __init__(self, owner, path):
+        self.owner = owner
+        self.path = path
+        # Guards the records not written yet, the snapshot replacing the
+        # log and the records since the last snapshot
+        self.lock = Lock()
+        self.lines = []
+        self.rewrite = None
+        self.count = 0
+        self.closed = False
+        # Guards the file, only one write (or the removal) at a time
+        self.ioLock = Lock()
+        self.f = None
+
+    def append(self, record):
+        # Logs a record. Returns True when the log is due for compaction
+        line = json.dumps(record, encoding=ENCODING) + '\n'
+        with self.lock:
+            if self.closed:
+                return False
+            self.lines.append(line)
+            self.count += 1
+            due = self.count >= self.owner.compactEvery
+        self.owner.dirty(self)
+        return due
+
+    def compact(self, snapshot):
+        # Replaces the log by the snapshot and the records after it
+        line = json.dumps(['snapshot', snapshot], encoding=ENCODING) + '\n'
+        with self.lock:
+            if self.closed:
+                return
+            self.rewrite = line
+            self.lines = []
+            self.count = 0
+        self.owner.dirty(self)
+
+    def close(self):
+        # The game is over, nothing is left to recover
+        with self.lock:
+            self.closed = True
+            self.lines = []
+            self.rewrite = None
+        with self.ioLock:
+            if self.f != None:
+                self.f.close()
+                self.f = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def write(self):
+        # Writes and fsyncs the waiting records. Returns the records and
+        # bytes written and whether the log was compacted. The records are
+        # taken under the file's lock, so the batches are written in order
+        with self.ioLock:
+            with self.lock:
+                rewrite, lines = self.rewrite, self.lines
+                self.rewrite, self.lines = None, []
+            if self.closed or (rewrite == None and not lines):
+                return 0, 0, False
+            data = ''.join(lines)
+            if rewrite != None:
+                # the new log is complete on disk before it replaces the
+                # old one, a crash leaves one or the other
+                data = rewrite + data
+                tmp = self.path + TMP_SUFFIX
+                with open(tmp, 'wb') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                if self.f != None:
+                    self.f.close()
+                os.rename(tmp, self.path)
+                fsyncDir(self.owner.path)
+                self.f = open(self.path, 'ab')
+            elif self.f != None:
+                # (None if the snapshot could not be written)
+                self.f.write(data)
+                self.f.flush()
+                os.fsync(self.f.fileno())
+        return len(lines) + (rewrite != None), len(data), rewrite != None
+
+
+class moveLog(object):
+    def __init__(self, path, syncInterval=0.05, compactEvery=500):
+        # Directory of the logs, seconds between the batched writes (0 to
+        # fsync every record at once) and records between compactions
+        self.path = path
+        self.syncInterval = syncInterval
+        self.compactEvery = compactEvery
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # The logs with records waiting for the writer
+        self.dirtyLock = Lock()
+        self.dirtyLogs = set()
+        self.stopped = Event()
+        self.thread = None
+        # Counters
+        self.statsLock = Lock()
+        self.records = 0
+        self.bytes = 0
+        self.syncs = 0
+        self.compactions = 0
+        self.recovered = 0
+
+    def start(self):
+        # Writes the logs from a thread, unless every record is synced at
+        # once
+        if self.syncInterval <= 0:
+            return
+        self.stopped.clear()
+        self.thread = Thread(name='MoveLog', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        # Writes what is left
+        self.stopped.set()
+        self.flush()
+
+    def run(self):
+        while not self.stopped.wait(self.syncInterval):
+            self.flush()
+
+    def open(self, sess):
+        # Starts the log of a session with its snapshot. Called with the
+        # session's lock held
+        log = sessionLog(self, os.path.join(self.path,
+                                            logName(sess.sessName)))
+        sess.moveLog = log
+        log.compact(sess.getSnapshot())
+
+    def dirty(self, log):
+        # A log has records to write
+        if self.syncInterval <= 0:
+            self.write(log)
+            return
+        with self.dirtyLock:
+            self.dirtyLogs.add(log)
+
+    def flush(self):
+        # Writes the records of all logs collected since the last flush
+        with self.dirtyLock:
+            logs, self.dirtyLogs = self.dirtyLogs, set()
+        for log in logs:
+            self.write(log)
+
+    def write(self, log):
+        try:
+            records, size, compacted = log.write()
+        except (IOError, OSError) as e:
+            LOG.error('Writing the move log %s failed: %s' % (log.path, e))
+            return
+        if records:
+            with self.statsLock:
+                self.records += records
+                self.bytes += size
+                self.syncs += 1
+                self.compactions += compacted
+
+    def recover(self):
+        # Returns the session snapshots replayed from the logs. Logs that
+        # cannot be replayed are removed, as are compactions cut short
+        states = []
+        for name in sorted(os.listdir(self.path)):
+            path = os.path.join(self.path, name)
+            if name.endswith(TMP_SUFFIX):
+                os.remove(path)
+                continue
+            if not name.endswith(LOG_SUFFIX):
+                continue
+            with open(path, 'rb') as f:
+                state = replay(f)
+            if state == None:
+                LOG.warn('Move log %s has no snapshot, removing it' % name)
+                os.remove(path)
+                continue
+            states.append(state)
+        with self.statsLock:
+            self.recovered = len(states)
+        return states
+
+    def getStats(self):
+        # Returns the records and bytes written, the fsyncs they took, the
+        # compactions and the sessions recovered
+        with self.statsLock:
+            return {'records': self.records, 'bytes': self.bytes,
+                    'syncs': self.syncs, 'compactions': self.compactions,
+                    'recovered': self.recovered}
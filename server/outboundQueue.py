@@ -0,0 +1,176 @@
+# Bounded queue of the frames waiting to be written to one client. Senders
+# only enqueue, the client's writer (its writer thread, or the event loop)
+# writes them out, so a slow reader does not hold up the players sending
+# to it. Past the high-water mark the queue is reported as backed up. When
+# the queue holds too many frames or bytes the client is a slow consumer:
+# the overflow policy either drops the queued board states that newer ones
+# replace, or disconnects the client.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+from threading import Lock, Condition
+from collections import deque
+
+# What put() does with frames that do not fit in the queue
+OVERFLOW_DISCONNECT = 'disconnect'
+OVERFLOW_DROP = 'drop'
+OVERFLOW_POLICIES = [OVERFLOW_DISCONNECT, OVERFLOW_DROP]
+
+# put() results
+QUEUED = 0
+DISCONNECT = 1
+
+# getStats() values that describe the queue right now, not a running total
+CURRENT_STATS = ['depth', 'bytes']
+
+
+def addStats(total, stats, current=True):
+    # Adds the getStats() of a queue to the totals in 'total'. Peaks are
+    # combined with max, the current values only if 'current' is set
+    for k, v in stats.items():
+        if k.startswith('max'):
+            total[k] = max(v, total.get(k, 0))
+        elif current or k not in CURRENT_STATS:
+            total[k] = total.get(k, 0) + v
+    return total
+
+
+class outboundQueue(object):
+    def __init__(self, capacity=256, highWater=64, maxBytes=1 << 20,
+                 overflow=OVERFLOW_DISCONNECT, onPut=None):
+        self.capacity = capacity
+        self.highWater = highWater
+        self.maxBytes = maxBytes
+        self.overflow = overflow
+        # Called after frames were queued (the event loop's writer)
+        self.onPut = onPut
+        self.lock = Lock()
+        self.ready = Condition(self.lock)
+        # (frame, state) pairs. A frame with a state (board, scores) can be
+        # dropped when a newer frame with the same state is queued
+        self.frames = deque()
+        self.bytes = 0
+        self.closed = False
+        self.finishing = False
+        # Counters
+        self.queued = 0
+        self.written = 0
+        self.writtenBytes = 0
+        self.maxDepth = 0
+        self.maxQueuedBytes = 0
+        self.highWaterHits = 0
+        self.dropped = 0
+        self.disconnects = 0
+        self.evictions = 0
+
+    def put(self, frames):
+        # Queues [(frame, state), ...] together. Returns QUEUED, or
+        # DISCONNECT if the client does not keep up and has to go
+        size = sum(len(f) for f, state in frames)
+        with self.lock:
+            if self.closed:
+                return QUEUED
+            if self.overflows(len(frames), size) and \
+               self.overflow == OVERFLOW_DROP:
+                self.dropReplaced(frames)
+            if self.overflows(len(frames), size):
+                self.disconnects += 1
+                self.closed = True
+                self.ready.notify()
+                return DISCONNECT
+            depth = len(self.frames)
+            if depth < self.highWater <= depth + len(frames):
+                self.highWaterHits += 1
+                LOG.warn('Outbound queue over the high-water mark (%d frames)'
+                         % self.highWater)
+            self.frames.extend(frames)
+            self.bytes += size
+            self.queued += len(frames)
+            self.maxDepth = max(self.maxDepth, len(self.frames))
+            self.maxQueuedBytes = max(self.maxQueuedBytes, self.bytes)
+            self.ready.notify()
+        if self.onPut != None:
+            self.onPut()
+        return QUEUED
+
+    def overflows(self, count, size):
+        return len(self.frames) + count > self.capacity or \
+               self.bytes + size > self.maxBytes
+
+    def dropReplaced(self, frames):
+        # Drops the queued frames whose state a newer frame (queued or
+        # about to be) replaces
+        newer = set(state for f, state in frames)
+        kept = deque()
+        for f, state in reversed(self.frames):
+            if state != None and state in newer:
+                self.dropped += 1
+                self.bytes -= len(f)
+                continue
+            newer.add(state)
+            kept.appendleft((f, state))
+        self.frames = kept
+
+    def get(self):
+        # Waits for frames and returns all queued frames, so they can be
+        # written at once. None once the queue is closed
+        with self.lock:
+            while not self.frames and not self.closed and not self.finishing:
+                self.ready.wait()
+            if not self.frames:
+                return None
+            return self.takeAll()
+
+    def getNowait(self):
+        # Returns all queued frames, an empty list if there are none
+        with self.lock:
+            return self.takeAll() or []
+
+    def takeAll(self):
+        if self.closed:
+            return None
+        frames = [f for f, state in self.frames]
+        self.frames.clear()
+        self.bytes = 0
+        return frames
+
+    def wrote(self, frames, size):
+        # Counts frames written out by the writer
+        with self.lock:
+            self.written += frames
+            self.writtenBytes += size
+
+    def evicted(self):
+        # Counts a client disconnected for missing the send deadline
+        with self.lock:
+            self.evictions += 1
+
+    def finish(self):
+        # Stops the writer once the queued frames are written
+        with self.lock:
+            self.finishing = True
+            self.ready.notify()
+
+    def close(self):
+        # Stops the writer, queued frames are discarded
+        with self.lock:
+            self.closed = True
+            self.ready.notify()
+
+    def depth(self):
+        with self.lock:
+            return len(self.frames)
+
+    def getStats(self):
+        # Returns the queue depth and counters
+        with self.lock:
+            return {'depth': len(self.frames), 'maxDepth': self.maxDepth,
+                    'bytes': self.bytes,
+                    'maxQueuedBytes': self.maxQueuedBytes,
+                    'queued': self.queued, 'written': self.written,
+                    'writtenBytes': self.writtenBytes,
+                    'highWaterHits': self.highWaterHits,
+                    'dropped': self.dropped, 'disconnects': self.disconnects,
+                    'evictions': self.evictions}
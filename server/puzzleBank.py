@@ -0,0 +1,157 @@
+# A puzzle bank is a file of puzzles generated offline, so the server can
+# serve them at start-up without generating. The file is memory mapped
+# and records are read straight from the mapping.
+#
+# File layout (big endian):
+#   header  'SDKB', version (H), index entry count (H), record count (I)
+#   index   per difficulty: removed cell count (H), offset of the first
+#           record (I), record count (I)
+#   records givens + solution, 81 cells each packed at 4 bits per cell
+#           (41 bytes each, the last nibble is padding)
+# Records are grouped by difficulty, so a difficulty's records are a
+# contiguous run of fixed-width records.
+import os, sys, mmap, struct, random
+import numpy as np
+from argparse import ArgumentParser
+from sudoku_new import *
+
+BANK_MAGIC = 'SDKB'
+BANK_VERSION = 1
+HEADER = struct.Struct('!4sHHI')
+INDEX_ENTRY = struct.Struct('!HII')
+BOARD_SIZE = 41
+RECORD_SIZE = 2 * BOARD_SIZE
+
+
+def packBoard(board):
+    # Packs 81 cells to 41 bytes, two cells per byte, high nibble first
+    cells = np.zeros(2 * BOARD_SIZE, dtype=np.uint8)
+    cells[:81] = np.asarray(board).flat
+    return ((cells[0::2] << 4) | cells[1::2]).tostring()
+
+def unpackBoard(packed):
+    # Unpacks 41 bytes (any buffer or uint8 array) to a 9x9 board
+    packed = np.frombuffer(packed, dtype=np.uint8)
+    cells = np.empty(2 * BOARD_SIZE, dtype=np.int)
+    cells[0::2] = packed >> 4
+    cells[1::2] = packed & 0x0F
+    return cells[:81].reshape(9, 9)
+
+
+class puzzleBank(object):
+    def __init__(self, path):
+        # Maps the bank file and reads its difficulty index
+        self.path = path
+        self.f = open(path, 'rb')
+        self.mm = mmap.mmap(self.f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, entries, self.records = \
+            HEADER.unpack_from(self.mm, 0)
+        if magic != BANK_MAGIC or version != BANK_VERSION:
+            self.close()
+            raise ValueError('%s is not a version %d puzzle bank' \
+                             % (path, BANK_VERSION))
+        # removed cell count -> (offset of the first record, record count)
+        self.index = {}
+        for i in range(entries):
+            removed, offset, count = INDEX_ENTRY.unpack_from(self.mm,
+                HEADER.size + i * INDEX_ENTRY.size)
+            self.index[removed] = (offset, count)
+
+    def close(self):
+        self.mm.close()
+        self.f.close()
+
+    def levels(self):
+        # Returns the difficulties in the bank
+        return sorted(self.index.keys())
+
+    def count(self, level):
+        # Returns the number of puzzles with 'level' removed cells
+        return self.index.get(level, (0, 0))[1]
+
+    def recordOffset(self, level, n):
+        # Returns the file offset of the n-th puzzle of the level
+        offset, count = self.index[level]
+        if not 0 <= n < count:
+            raise IndexError('Level %d has %d puzzles' % (level, count))
+        return offset + n * RECORD_SIZE
+
+    def load(self, offset):
+        # Returns the (puzzle, solution) pair of the record at the offset.
+        # The packed record is a view into the mapping, only the unpacked
+        # boards are new arrays
+        record = np.frombuffer(self.mm, dtype=np.uint8,
+                               count=RECORD_SIZE, offset=offset)
+        return unpackBoard(record[:BOARD_SIZE]), \
+               unpackBoard(record[BOARD_SIZE:])
+
+    def random(self, level):
+        # Returns a random (puzzle, solution) pair of the level
+        return self.load(self.recordOffset(level,
+                         random.randrange(self.count(level))))
+
+    def readAll(self):
+        # Returns {level: [(puzzle, solution), ...]} of the whole bank
+        return dict((level, [self.load(self.recordOffset(level, n))
+                             for n in range(self.count(level))])
+                    for level in self.levels())
+
+
+def writeBank(path, puzzles):
+    # Writes {level: [(puzzle, solution), ...]} to a new bank file. The
+    # solutions are validated first, all at once
+    levels = sorted(l for l in puzzles if puzzles[l])
+    if levels:
+        solved = np.array([s for l in levels for p, s in puzzles[l]])
+        if not check_sudoku_batch(solved).all() or (solved == 0).any():
+            raise ValueError('Refusing to write an invalid solution')
+    offset = HEADER.size + len(levels) * INDEX_ENTRY.size
+    out = [HEADER.pack(BANK_MAGIC, BANK_VERSION, len(levels),
+                       sum(len(puzzles[l]) for l in levels))]
+    for level in levels:
+        out.append(INDEX_ENTRY.pack(level, offset, len(puzzles[level])))
+        offset += len(puzzles[level]) * RECORD_SIZE
+    for level in levels:
+        for puzzle, solution in puzzles[level]:
+            out.append(packBoard(puzzle) + packBoard(solution))
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(''.join(out))
+    os.rename(tmp, path)
+
+def generatePuzzles(level, n, puzzles):
+    # Adds n make_sudoku(level) puzzles to {removed: [...]}, filed under
+    # the number of cells actually removed
+    for i in range(n):
+        puzzle, solution = make_sudoku(level)
+        removed = int((puzzle == 0).sum())
+        puzzles.setdefault(removed, []).append((puzzle, solution))
+    return puzzles
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description="Build and inspect sudoku puzzle "\
+                                        "banks")
+    parser.add_argument('command', choices=['build', 'append', 'info'],
+                        help="build a new bank, append to a bank or show "\
+                             "its index")
+    parser.add_argument('bank', help="Puzzle bank file")
+    parser.add_argument('-l', '--levels', type=int, nargs='+',
+                        default=[LEVEL],
+                        help="Numbers of removed cells to generate. "\
+                             "Default %d." % LEVEL)
+    parser.add_argument('-n', '--count', type=int, default=100,
+                        help="Puzzles to generate per level. Default 100.")
+    args = parser.parse_args()
+
+    puzzles = {}
+    if args.command in ['append', 'info']:
+        bank = puzzleBank(args.bank)
+        puzzles = bank.readAll()
+        bank.close()
+    if args.command in ['build', 'append']:
+        for level in args.levels:
+            generatePuzzles(level, args.count, puzzles)
+        writeBank(args.bank, puzzles)
+    for level in sorted(puzzles):
+        print 'Level %d: %d puzzles' % (level, len(puzzles[level]))
@@ -0,0 +1,144 @@
+# Keeps a bounded queue of ready sudoku puzzles per difficulty level so
+# that creating a session does not wait for the generator. A background
+# thread refills a queue once it drops under the low-water mark, sessions
+# fall back to generating inline only when the queue is empty. With a
+# generatorFarm the refills are generated in worker processes instead.
+# With a puzzleBank an empty queue is served from the bank before
+# generating inline.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+from threading import Thread, Lock, Event
+from Queue import Queue, Empty, Full
+from sudoku_new import *
+
+
+class puzzlePool(object):
+    def __init__(self, levels=(LEVEL,), capacity=8, lowWater=2, farm=None,
+                 bank=None):
+        # Queues of (puzzle, solution) pairs, one for each difficulty
+        self.capacity = capacity
+        self.lowWater = lowWater
+        self.queuesLock = Lock()
+        self.queues = dict((l, Queue(capacity)) for l in levels)
+        # Optional process pool and the farm jobs not yet returned per level
+        self.farm = farm
+        self.pending = dict((l, 0) for l in levels)
+        # Optional puzzle bank file
+        self.bank = bank
+        # Pool hit/miss counters
+        self.statsLock = Lock()
+        self.hits = 0
+        self.bankHits = 0
+        self.misses = 0
+        # Set whenever a queue might need refilling
+        self.refill = Event()
+        self.running = False
+        self.producer = None
+
+    def start(self):
+        # Starts the producer thread, which fills all queues first
+        if self.farm != None:
+            self.farm.start()
+        self.running = True
+        self.refill.set()
+        self.producer = Thread(name='PuzzlePool', target=self.produce)
+        self.producer.daemon = True
+        self.producer.start()
+
+    def stop(self):
+        # Stops the producer after the puzzle it is working on
+        self.running = False
+        self.refill.set()
+        if self.farm != None:
+            self.farm.shutdown()
+
+    def getQueue(self, level):
+        # Returns the queue for a level, a new level gets its own queue
+        with self.queuesLock:
+            if level not in self.queues:
+                self.queues[level] = Queue(self.capacity)
+                self.pending[level] = 0
+            return self.queues[level]
+
+    def take(self, level):
+        # Returns a (puzzle, solution) pair for the level. Takes a ready one
+        # from the queue if there is one, then tries the bank, otherwise
+        # generates it inline
+        q = self.getQueue(level)
+        try:
+            puzzle = q.get_nowait()
+            with self.statsLock:
+                self.hits += 1
+        except Empty:
+            puzzle = None
+        if puzzle is None and self.bank != None and self.bank.count(level):
+            puzzle = self.bank.random(level)
+            with self.statsLock:
+                self.bankHits += 1
+        if puzzle is None:
+            with self.statsLock:
+                self.misses += 1
+            LOG.debug('Puzzle pool empty for level %d, generating inline' \
+                      % level)
+            puzzle = make_sudoku(level)
+        if q.qsize() < self.lowWater:
+            self.refill.set()
+        return puzzle
+
+    def put(self, level, puzzle):
+        # Adds a ready puzzle to the level's queue, False if it is full
+        try:
+            self.getQueue(level).put_nowait(puzzle)
+            return True
+        except Full:
+            return False
+
+    def getStats(self):
+        # Returns the hit/miss counters and the queue sizes per level
+        with self.queuesLock:
+            sizes = dict((l, q.qsize()) for l, q in self.queues.items())
+        with self.statsLock:
+            return {'hits': self.hits, 'bankHits': self.bankHits,
+                    'misses': self.misses, 'ready': sizes}
+
+    def produce(self):
+        # Producer loop. Waits until a queue drops under the low-water mark
+        # and then fills it up to its capacity
+        while self.running:
+            self.refill.wait()
+            self.refill.clear()
+            with self.queuesLock:
+                levels = self.queues.items()
+            for level, q in levels:
+                if q.qsize() >= self.lowWater:
+                    continue
+                if self.farm != None:
+                    self.submitToFarm(level, q)
+                    continue
+                while self.running and not q.full():
+                    if not self.put(level, make_sudoku(level)):
+                        break
+                LOG.debug('Puzzle pool refilled level %d (%d ready)' \
+                          % (level, q.qsize()))
+
+    def submitToFarm(self, level, q):
+        # Asks the farm for the puzzles missing from the level's queue,
+        # counting the ones it is already generating
+        with self.queuesLock:
+            missing = self.capacity - q.qsize() - self.pending[level]
+            self.pending[level] += max(missing, 0)
+        for i in range(missing):
+            if not self.farm.submit(level, self.farmDone):
+                with self.queuesLock:
+                    self.pending[level] -= missing - i
+                break
+
+    def farmDone(self, level, puzzle):
+        # Called by the farm when a puzzle is ready
+        with self.queuesLock:
+            self.pending[level] -= 1
+        if puzzle != None:
+            self.put(level, puzzle)
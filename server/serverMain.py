@@ -7,12 +7,21 @@ FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
 logging.basicConfig(level=logging.DEBUG,format=FORMAT)
 LOG = logging.getLogger()
 
-import os,sys,inspect
+import os,sys,inspect,time
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
 from messageProtocol import *
 from sessionClass import *
 from clientHandler import *
-from threading import Thread, Lock, currentThread
+from puzzlePool import *
+from generatorFarm import *
+from puzzleBank import *
+from outboundQueue import *
+from idleReaper import *
+from sessionDirectory import *
+from matchmaker import *
+from moveLog import *
+from threading import Thread, Lock, Timer, currentThread
+from collections import OrderedDict
 
 from socket import AF_INET, SOCK_STREAM, socket
 from socket import error as soc_err
@@ -20,100 +29,294 @@ from socket import error as soc_err
 from argparse import ArgumentParser
 
 class serverClass(object):
-    def __init__(self):
+    def __init__(self, poolSize=8, poolLowWater=2, genWorkers=0,
+                 bankPath=None, sendQueue=256, sendHighWater=64,
+                 sendOverflow=OVERFLOW_DISCONNECT, sendMaxBytes=1 << 20,
+                 sendDeadline=10.0, heartbeat=15.0, idleTimeout=45.0,
+                 keepalive=60, lobbyInterval=0.2, matchInterval=0.5,
+                 matchLevels=(LEVEL,), moveLogPath=None, logSync=0.05,
+                 logCompact=500, resumeTimeout=120.0):
         # stores clients not in game session
-        self.lobbyList = []
-        self.lobbyListLock = Lock()
+        self.lobby = set()
+        self.lobbyLock = Lock()
 
-        # stores all the clients connected
-        self.clientListLock = Lock()
-        self.clientList = []
+        # stores all the clients connected and the clients by nickname
+        self.clientsLock = Lock()
+        self.clients = set()
+        self.nicknames = {}
 
-        # stores list of sessions
-        self.sessionListLock = Lock()
-        self.sessionList = []
+        # stores sessions by name, in the order they were created. The
+        # tuple of the sessions is replaced, never changed, so the lobby
+        # listing reads it without the lock (see sessionClass.py for the
+        # locking model)
+        self.sessionsLock = Lock()
+        self.sessions = OrderedDict()
+        self.sessionsView = ()
+        # nickname -> recovered session keeping that player's seat, under
+        # the sessions lock
+        self.seats = {}
 
-    def removeMe(self):
-        # Remove the client from server (and from lobby)
-        caller = currentThread()
+        # ready puzzles for new sessions, filled in the background
+        # (in worker processes if genWorkers > 0). Puzzles from the bank
+        # file are used while the pool is empty
+        farm = generatorFarm(genWorkers) if genWorkers > 0 else None
+        bank = puzzleBank(bankPath) if bankPath else None
+        levels = tuple(sorted(set((LEVEL,) + tuple(matchLevels))))
+        self.puzzlePool = puzzlePool(levels, poolSize, poolLowWater, farm,
+                                     bank)
+
+        # outbound queue settings of the clients, and the queue counters
+        # of the clients that have left
+        self.sendQueue = sendQueue
+        self.sendHighWater = sendHighWater
+        self.sendOverflow = sendOverflow
+        self.sendMaxBytes = sendMaxBytes
+        # seconds a client gets to take a write before it is disconnected
+        self.sendDeadline = sendDeadline
+        self.outboundLock = Lock()
+        self.closedOutbound = {}
+
+        # pings silent v2 clients and disconnects the dead ones, dead v1
+        # connections are found by TCP keepalive after 'keepalive' seconds
+        self.reaper = idleReaper(self, heartbeat, idleTimeout)
+        self.keepalive = keepalive
+
+        # versioned session listing of the lobby, changes within
+        # lobbyInterval seconds go out together
+        self.sessDirectory = sessionDirectory(self, lobbyInterval)
+
+        # queues of the lobby clients waiting to be matched into sessions,
+        # matched every matchInterval seconds
+        self.matcher = matchmaker(self, matchInterval, tuple(matchLevels))
+
+        # write-ahead log of the sessions' moves in moveLogPath, synced
+        # every logSync seconds. The sessions in it are recovered on start
+        # and keep their players' seats for resumeTimeout seconds
+        self.moveLog = moveLog(moveLogPath, logSync, logCompact) \
+                       if moveLogPath else None
+        self.resumeTimeout = resumeTimeout
+        # when the recovered sessions give up the seats left, None if not
+        self.seatsDeadline = None
+
+        # class of the objects serving the connected clients (imported
+        # here, the copy of this module clientHandler imports lacks it)
+        from clientHandler import clientHandler
+        self.handlerClass = clientHandler
+
+    def removeMe(self, caller=None):
+        # Remove the client (by default the calling clientHandler thread)
+        # from server (and from lobby)
+        if caller == None:
+            caller = currentThread()
+        # removed before its session is checked, so the matcher adding it
+        # to a session meanwhile finds it gone (see matchmaker)
+        removed = self.removeClient(caller)
         if caller.session != None:
-            caller.session.removeMe()
-        if caller in self.clientList:
-            self.clientList.remove(caller)
+            caller.session.removeMe(caller)
+        if removed:
             logging.info('%s left game' % caller.getNickname())
-        if caller in self.lobbyList:
-            self.lobbyList.remove(caller)
+        if self.removeFromLobby(caller):
             logging.info('%s left lobby' % caller.getNickname())
 
+    def countOutbound(self, stats):
+        # adds the queue counters of a client that is leaving
+        with self.outboundLock:
+            addStats(self.closedOutbound, stats, False)
+
+    def getOutboundStats(self):
+        # returns the outbound queue counters of all clients so far and
+        # the frames queued right now
+        with self.outboundLock:
+            total = dict(self.closedOutbound)
+        for c in self.getClients():
+            addStats(total, c.outbound.getStats())
+        return total
+
     def removeFromLobby(self,c):
-        # remove the client from lobby
-        with self.lobbyListLock:
-            if c in self.lobbyList:
-                self.lobbyList.remove(c)
+        # remove the client from lobby and its matchmaking queue. Returns
+        # True if it was there
+        with self.lobbyLock:
+            if c in self.lobby:
+                self.lobby.remove(c)
+                removed = True
+            else:
+                removed = False
+        self.matcher.cancel(c)
+        return removed
 
     def addToLobby(self,c_list):
-        # adds the client to lobby. Sends a list of available
+        # adds the client to lobby. Sends the directory of available
         # sessions on the server
         for c in c_list:
             c.session=None
+        with self.lobbyLock:
+            self.lobby.update(c_list)
+        for c in c_list:
             if c.nickname != None:
-                c.send_notification(self.sessionList2string())
-        with self.lobbyListLock:
-            self.lobbyList += c_list
+                self.sessDirectory.subscribe(c)
+
+    def getLobby(self):
+        # returns a list of the clients in the lobby
+        with self.lobbyLock:
+            return list(self.lobby)
 
     def notify_to_lobby_sessions(self):
-        # sends session list to players in the lobby
-        for c in self.lobbyList:
-            c.session=None
-            if c.nickname != None:
-                c.send_notification(self.sessionList2string())
+        # sends the session directory changes to players in the lobby
+        self.sessDirectory.changed()
 
     def getSessions(self):
-        # return list of sessions on server
-        with self.sessionListLock:
-            return self.sessionList
+        # return the sessions on server, without locking
+        return self.sessionsView
+
+    def getDirectoryEntries(self):
+        # returns [(session name, free spots, max players), ...]
+        return map(lambda x: x.getDirEntry(), self.getSessions())
 
     def getSessNames(self):
         # returns a list of session name strings
-        lst = list()
-        for s in self.sessionList:
-            lst.append(s.sessName)
-        return lst
+        return map(lambda x: x.sessName, self.sessionsView)
+
+    def getSession(self, sessName):
+        # returns the session with that name, None if there is none
+        with self.sessionsLock:
+            return self.sessions.get(sessName)
+
+    def hasSession(self, sessName):
+        # returns True if a session has that name
+        return self.getSession(sessName) != None
+
+    def ownsSession(self, sessName):
+        # returns True if a session of that name is created here
+        return True
 
     def getUsedNicknames(self):
         # returns a list of connected clients name strings
-        return map(lambda x: x.nickname, self.clientList)
+        with self.clientsLock:
+            return self.nicknames.keys()
+
+    def claimNickname(self, c, nickname):
+        # gives the nickname to the client unless another client has it.
+        # The client's earlier nickname is freed. Returns True / False
+        # based on succeeding
+        with self.clientsLock:
+            if self.nicknames.get(nickname, c) is not c:
+                return False
+            if self.nicknames.get(c.nickname) is c:
+                del self.nicknames[c.nickname]
+            self.nicknames[nickname] = c
+            c.nickname = nickname
+            return True
 
     def addSession(self,session):
         # adds a session to server's session list if session name
-        # not in use. Returns True / False based on succeeding
-        with self.sessionListLock:
-            if session not in self.sessionList:
-                self.sessionList.append(session)
-                return True
-            return False
-
-    def sessionList2string(self):
-        # returns a string of sessions on server + player count
-        if len(self.getSessions())==0:
-            return 'No sessions available. Create one!'
-        return 'Available sessions: %s' %''.join(map(lambda x: '\n    ' +
-                        x.getSessInfo(),self.getSessions()))
+        # not in use, and starts its move log. The session's lock is held
+        # until the log is started, so no join goes unlogged. Returns
+        # True / False based on succeeding
+        with session.lock:
+            with self.sessionsLock:
+                if session.sessName in self.sessions:
+                    return False
+                self.sessions[session.sessName] = session
+                self.sessionsView = tuple(self.sessions.values())
+            if self.moveLog != None:
+                self.moveLog.open(session)
+        return True
 
     def removeSession(self,sess):
         # remove a session from server
-        with self.sessionListLock:
-            if sess in self.sessionList:
-                self.sessionList.remove(sess)
+        with self.sessionsLock:
+            if self.sessions.get(sess.sessName) is sess:
+                del self.sessions[sess.sessName]
+                self.sessionsView = tuple(self.sessions.values())
+
+    def takeSeat(self, nickname):
+        # returns the recovered session keeping a seat for the nickname,
+        # None if there is none
+        with self.sessionsLock:
+            return self.seats.pop(nickname, None)
+
+    def releaseSeat(self, nickname, sess):
+        # the session no longer keeps a seat for the nickname
+        with self.sessionsLock:
+            if self.seats.get(nickname) is sess:
+                del self.seats[nickname]
+
+    def recoverSessions(self, useTimer=True):
+        # rebuilds the sessions of the move log. Their players keep their
+        # seats until they log in again or resumeTimeout passes, timed by
+        # a thread or by the caller's ticks (the event loop). Imported
+        # here, sessionClass imports this module
+        from sessionClass import sessionClass
+        for state in self.moveLog.recover():
+            sess = sessionClass(state['name'], state['max'], self,
+                                state['level'], (decodeCells(state['board']),
+                                decodeCells(state['solution'])))
+            sess.restore(state['players'], state['running'])
+            if not self.addSession(sess):
+                continue
+            with self.sessionsLock:
+                for nickname, score in state['players']:
+                    self.seats[nickname] = sess
+            LOG.info('Recovered session %s, waiting for %s' % (sess.sessName,
+                     ', '.join(n for n, s in state['players'])))
+        if not self.seats or self.resumeTimeout <= 0:
+            return
+        self.seatsDeadline = time.time() + self.resumeTimeout
+        if useTimer:
+            timer = Timer(self.resumeTimeout, self.expireSeats)
+            timer.daemon = True
+            timer.start()
+
+    def seatsTimeout(self, limit):
+        # seconds until the seats are due to expire, at most 'limit'
+        if self.seatsDeadline == None:
+            return limit
+        return min(limit, self.seatsDeadline - time.time())
+
+    def seatsTick(self):
+        # expires the seats if they are due, for a caller without the
+        # timer (the event loop)
+        if self.seatsDeadline != None and time.time() >= self.seatsDeadline:
+            self.expireSeats()
+
+    def expireSeats(self):
+        # the players of the recovered sessions that did not come back
+        # lose their seats
+        self.seatsDeadline = None
+        map(lambda x: x.expireSeats(), self.getSessions())
 
     def addClient(self,client):
-        # adds a client to the server's client list
-        with self.clientListLock:
-            if client not in self.clientList:
-                self.clientList.append(client)
+        # adds a client to the server's client list, and its nickname if
+        # it has one already (a client moved from another process)
+        with self.clientsLock:
+            if client not in self.clients:
+                self.clients.add(client)
+                if client.nickname != None:
+                    self.nicknames[client.nickname] = client
                 return True
             return False
 
+    def removeClient(self, client):
+        # removes a client and frees its nickname. Returns True if it
+        # was there
+        with self.clientsLock:
+            if client not in self.clients:
+                return False
+            self.clients.remove(client)
+            if self.nicknames.get(client.nickname) is client:
+                del self.nicknames[client.nickname]
+            return True
+
+    def getClients(self):
+        # returns a list of the connected clients
+        with self.clientsLock:
+            return list(self.clients)
+
+    def hasClient(self, client):
+        # returns True if the client is connected
+        with self.clientsLock:
+            return client in self.clients
+
     def listen(self,sock_addr):
         # Creates a listener socket
         self.sock_addr = sock_addr
@@ -122,18 +325,35 @@ class serverClass(object):
         self.s.listen(1)
         LOG.debug( 'Socket %s:%d is in listening state'\
                        '' % self.s.getsockname() )
-    def loop(self):
-        # server's main loop. Creates clientHandler's for each connecter
+    def loop(self, useEventLoop=False):
+        # server's main loop. Creates clientHandler's for each connecter,
+        # or serves all clients from one eventLoop
         LOG.info( 'Falling to serving loop, press Ctrl+C to terminate ...' )
         clients = []
+        client_socket = None
+        self.puzzlePool.start()
+        if self.moveLog != None:
+            # the event loop expires the seats itself
+            self.recoverSessions(not useEventLoop)
+            self.moveLog.start()
+        if not useEventLoop:
+            # the event loop checks the idle clients, sends the lobby
+            # updates and matches itself
+            self.reaper.start()
+            self.sessDirectory.start()
+            self.matcher.start()
 
         try:
-            while 1:
+            if useEventLoop:
+                # imported here, clientHandler imports this module
+                from eventLoop import eventLoop
+                eventLoop(self).run()
+            while not useEventLoop:
                 client_socket = None
                 LOG.info( 'Awaiting new clients ...' )
                 client_socket,client_addr = self.s.accept()
-                c = clientHandler(client_socket, self)
-                self.clientList.append(c)
+                c = self.handlerClass(client_socket, self)
+                self.addClient(c)
                 self.addToLobby([c])
                 c.start()
         except KeyboardInterrupt:
@@ -142,6 +362,19 @@ class serverClass(object):
             if client_socket != None:
                 client_socket.close()
             self.s.close()
+            self.puzzlePool.stop()
+            self.reaper.stop()
+            self.sessDirectory.stop()
+            self.matcher.stop()
+            LOG.info('Puzzle pool stats: %s' % self.puzzlePool.getStats())
+            LOG.info('Outbound queue stats: %s' % self.getOutboundStats())
+            LOG.info('Idle reaper stats: %s' % self.reaper.getStats())
+            LOG.info('Session directory stats: %s' \
+                     % self.sessDirectory.getStats())
+            LOG.info('Matchmaker stats: %s' % self.matcher.getStats())
+            if self.moveLog != None:
+                self.moveLog.stop()
+                LOG.info('Move log stats: %s' % self.moveLog.getStats())
         map(lambda x: x.join(), clients)
 
 if __name__ == '__main__':
@@ -149,8 +382,104 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--server-addr',
                         help="Listening address. Default localhost.",
                         default='127.0.0.1')
+    parser.add_argument('--pool-size', type=int, default=8,
+                        help="Ready puzzles kept per difficulty. Default 8.")
+    parser.add_argument('--pool-low-water', type=int, default=2,
+                        help="Refill the puzzle pool under this many "\
+                             "puzzles. Default 2.")
+    parser.add_argument('--gen-workers', type=int, default=0,
+                        help="Generate puzzles in this many worker "\
+                             "processes. Default 0 (in a server thread).")
+    parser.add_argument('-b', '--bank',
+                        help="Puzzle bank file to serve puzzles from while "\
+                             "the pool is empty.")
+    parser.add_argument('--send-queue', type=int, default=256,
+                        help="Frames queued per client before the overflow "\
+                             "policy applies. Default 256.")
+    parser.add_argument('--send-high-water', type=int, default=64,
+                        help="Queued frames per client reported as a slow "\
+                             "reader. Default 64.")
+    parser.add_argument('--send-max-bytes', type=int, default=1 << 20,
+                        help="Bytes queued per client before the overflow "\
+                             "policy applies. Default 1 MiB.")
+    parser.add_argument('--send-overflow', choices=OVERFLOW_POLICIES,
+                        default=OVERFLOW_DISCONNECT,
+                        help="When a client's queue is full, drop the queued "\
+                             "board states newer ones replace before "\
+                             "disconnecting (drop) or disconnect right away. "\
+                             "Default disconnect.")
+    parser.add_argument('--send-deadline', type=float, default=10.0,
+                        help="Seconds a client gets to take a write before "\
+                             "it is disconnected, 0 for no limit. "\
+                             "Default 10.")
+    parser.add_argument('--heartbeat', type=float, default=15.0,
+                        help="Seconds a v2 client may be silent before it "\
+                             "is pinged, 0 for no pings. Default 15.")
+    parser.add_argument('--idle-timeout', type=float, default=45.0,
+                        help="Seconds a v2 client may be silent before it "\
+                             "is disconnected, 0 for no limit. Default 45.")
+    parser.add_argument('--keepalive', type=int, default=60,
+                        help="Seconds a connection may be silent before TCP "\
+                             "keepalive probes it, 0 for no keepalive. "\
+                             "Default 60.")
+    parser.add_argument('--lobby-interval', type=float, default=0.2,
+                        help="Seconds session changes are collected before "\
+                             "the lobby is updated, 0 to update at once. "\
+                             "Default 0.2.")
+    parser.add_argument('--match-interval', type=float, default=0.5,
+                        help="Seconds between the rounds matching the "\
+                             "queued players into sessions. Default 0.5.")
+    parser.add_argument('--match-levels', type=int, nargs='+',
+                        default=[LEVEL],
+                        help="Difficulties (empty cells) players can be "\
+                             "matched for, the first is the default. "\
+                             "Default %d." % LEVEL)
+    parser.add_argument('--move-log',
+                        help="Log the sessions' moves to this directory and "\
+                             "recover the sessions logged there on start.")
+    parser.add_argument('--log-sync', type=float, default=0.05,
+                        help="Seconds between the move log writes, 0 to "\
+                             "sync every move. Default 0.05.")
+    parser.add_argument('--log-compact', type=int, default=500,
+                        help="Records logged per session before its log is "\
+                             "replaced by a snapshot. Default 500.")
+    parser.add_argument('--resume-timeout', type=float, default=120.0,
+                        help="Seconds the players of recovered sessions "\
+                             "have to log in again before losing their "\
+                             "seats, 0 for no limit. Default 120.")
+    parser.add_argument('--event-loop', action='store_true',
+                        help="Serve all clients from one event loop instead "\
+                             "of a thread per client.")
+    parser.add_argument('--shards', type=int, default=0,
+                        help="Run the sessions in this many worker "\
+                             "processes, a session's shard picked by its "\
+                             "name. Default 0 (one process).")
     args = parser.parse_args()
-    server = serverClass()
+    if args.shards and args.event_loop:
+        parser.error('--shards runs the threaded core only')
+    if args.shards and args.move_log:
+        parser.error('--move-log runs without --shards only')
+    config = {'poolSize': args.pool_size, 'poolLowWater': args.pool_low_water,
+              'genWorkers': args.gen_workers, 'bankPath': args.bank,
+              'sendQueue': args.send_queue,
+              'sendHighWater': args.send_high_water,
+              'sendOverflow': args.send_overflow,
+              'sendMaxBytes': args.send_max_bytes,
+              'sendDeadline': args.send_deadline,
+              'heartbeat': args.heartbeat, 'idleTimeout': args.idle_timeout,
+              'keepalive': args.keepalive,
+              'lobbyInterval': args.lobby_interval,
+              'matchInterval': args.match_interval,
+              'matchLevels': args.match_levels,
+              'moveLogPath': args.move_log, 'logSync': args.log_sync,
+              'logCompact': args.log_compact,
+              'resumeTimeout': args.resume_timeout}
+    if args.shards > 0:
+        # shardedServer subclasses serverClass, so it is imported here
+        from shardedServer import frontServer
+        server = frontServer(args.shards, **config)
+    else:
+        server = serverClass(**config)
     server.listen((args.server_addr,7777))
-    server.loop()
+    server.loop(args.event_loop)
     LOG.info('Terminating ...')
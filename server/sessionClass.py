@@ -1,6 +1,25 @@
 # Allows clientHandlers to interact with Sudoku instance
 # Keeps track of game status and notifies clients about
 # changes. sessionClass objects are created by clientHandlers
+#
+# Locking model:
+# - Each session has one lock, 'lock', guarding its board, its player
+#   list, the players' scores and whether the game runs or is closed.
+#   Moves, joins, leaves and board snapshots of a session take it, so
+#   they happen one at a time and see each other's results; different
+#   sessions do not wait for each other.
+# - The server's registries (clients and nicknames, lobby, sessions,
+#   matchmaking queues) have a lock each, held only for the registry
+#   update itself.
+# - Locks are taken in this order only: session lock, then the session
+#   directory lock, then a server registry lock, then a client's outbound
+#   queue lock. Sending only
+#   queues frames, so it is done while holding the session lock and
+#   never waits for a socket. Move log records are appended under the
+#   session lock too (see moveLog), so they are in the session's order.
+# - The session listing sent to the lobby is read without locks: the
+#   server replaces its tuple of sessions on every change instead of
+#   changing it, and getDirEntry() reads the player count as it is.
 import logging
 FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
 logging.basicConfig(level=logging.DEBUG,format=FORMAT)
@@ -12,80 +31,239 @@ from messageProtocol import *
 from clientHandler import *
 from serverMain import *
 from threading import Thread, Lock, currentThread
+from collections import OrderedDict
 from sudoku_new import *
+from broadcastBuilder import *
+from moveLog import encodeCells
 
 
 class sessionClass():
-    def __init__(self, sessName, maxClients, Server):
+    def __init__(self, sessName, maxClients, Server, level=LEVEL,
+                 puzzle=None):
         # Server object and session name
         self.Server = Server
         self.sessName = sessName
-        # Initiates a sudoku instance
-        self.sudoku = Sudoku(LEVEL)
-        self.tableLock = Lock()
+        # Initiates a sudoku instance of the difficulty (cells removed)
+        # from the server's puzzle pool, or of the (board, solution) of a
+        # recovered session
+        self.level = level
+        if puzzle == None:
+            puzzle = Server.puzzlePool.take(level)
+        self.sudoku = Sudoku(level, puzzle)
+        # Guards the board, clients, scores and game state (see above)
+        self.lock = Lock()
         # Holds game session clients
         self.clients = []
         self.maxClients = maxClients
         self.gameRunning = False
-        self.clientsLock = Lock()
+        # Set once the session is removed from the server
+        self.closed = False
+        # Players of a recovered session that have not logged in again,
+        # nickname -> score. They keep their seats
+        self.absent = OrderedDict()
+        # The session's move log, None if the server keeps none
+        self.moveLog = None
+        # Frames, bytes and writes sent for moves
+        self.statsLock = Lock()
+        self.moves = 0
+        self.moveFrames = 0
+        self.moveBytes = 0
+        self.moveWrites = 0
+
+    def joined(self):
+        # players that have joined the session
+        return filter(lambda x: x.session!=None, self.clients)
 
     def notify_update(self,msg):
         # can be used to send a message with notify header
-        joined = filter(lambda x: x.session!=None, self.clients)
-        map(lambda x: x.send_notification(msg), joined)
+        map(lambda x: x.send_notification(msg), self.joined())
 
     def send_specific_update(self,header,msg):
         # can be used to send a message with specific header
         joined = filter(lambda x: x.session!=None, self.clients)
-        print joined
         map(lambda x: x.send_specific(header, msg), joined)
 
-    def getSessInfo(self):
-        # Returs a string of session name + player count
-        return self.sessName+' ('\
-               +str(self.maxClients - len(self.clients))+'/'\
-               +str(self.maxClients) + ' spots available)'
+    def send_board_update(self, header=REP_NOTIFY):
+        # sends the sudoku board to every player
+        joined = filter(lambda x: x.session!=None, self.clients)
+        map(lambda x: x.send_board(self.sudoku, header), joined)
+
+    def send_scoreboard_update(self):
+        # sends the scores to every player
+        joined = filter(lambda x: x.session!=None, self.clients)
+        map(lambda x: x.send_scoreboard(self), joined)
+
+    def send_broadcast(self, broadcast):
+        # sends the events of a move to every player, one write each
+        broadcast.send(self.joined())
+        with self.statsLock:
+            self.moves += 1
+            self.moveFrames += broadcast.frames
+            self.moveBytes += broadcast.bytes
+            self.moveWrites += broadcast.writes
+        LOG.debug('Move broadcast: %d frames, %d bytes in %d writes' \
+                  % (broadcast.frames, broadcast.bytes, broadcast.writes))
+
+    def getBroadcastStats(self):
+        # Returns the move broadcast counters
+        with self.statsLock:
+            return {'moves': self.moves, 'frames': self.moveFrames,
+                    'bytes': self.moveBytes, 'writes': self.moveWrites}
+
+    def getDirEntry(self):
+        # Returns (session name, free spots, max players)
+        return (self.sessName, self.maxClients - len(self.clients) -
+                len(self.absent), self.maxClients)
+
+    def log(self, record):
+        # Appends a record to the move log, replacing the log by a snapshot
+        # every so often. Called with the lock held
+        if self.moveLog != None and self.moveLog.append(record):
+            self.moveLog.compact(self.getSnapshot())
+
+    def getSnapshot(self):
+        # The session's state as the move log keeps it. Called with the
+        # lock held (or before the session is shared)
+        return {'name': self.sessName, 'max': self.maxClients,
+                'level': self.level, 'running': self.gameRunning,
+                'board': encodeCells(self.sudoku.current),
+                'solution': encodeCells(self.sudoku.solved),
+                'players': self.getScores() + self.absent.items()}
+
+    def restore(self, players, running):
+        # Sets the state of a recovered session: the players keep their
+        # scores and seats until they log in again
+        self.absent = OrderedDict(players)
+        self.gameRunning = running
 
     def addMe(self, c):
         # Adds a player to the session and removes them from server lobby
         # Notifies others about the added player and if the session gets
-        # full, starts the game.
-        with self.clientsLock:
-            if len(self.clients) < self.maxClients:
+        # full, starts the game. A player already in a session is refused
+        with self.lock:
+            if not self.closed and c.session == None and \
+               len(self.clients) + len(self.absent) < self.maxClients:
                 self.clients.append(c)
                 c.session = self
+                self.log(['join', c.nickname, c.score])
                 self.notify_update('\n'+c.nickname+' joined the lobby.')
                 self.notify_update('Lobby status: %d/%d players joined.\n' \
                                     % (len(self.clients), self.maxClients))
                 self.Server.removeFromLobby(c)
-                if len(self.clients) == self.maxClients:
-                    self.gameRunning = True
-                    self.send_specific_update(
-                        REP_TABLE,self.sudoku.sudoku_to_string())
+                self.startIfFull()
                 self.Server.notify_to_lobby_sessions()
                 return True
             return False
 
-    def removeMe(self):
-        # Removes the player from the session. Notifies others
+    def abandon(self):
+        # Closes the session if nobody is in it, for a session its creator
+        # could not join
+        with self.lock:
+            if not self.closed and not self.clients and not self.absent:
+                self.close()
+
+    def startIfFull(self):
+        # Starts the game (sends everyone the board) once all players are
+        # in. Called with the lock held, returns True if it did
+        if len(self.clients) < self.maxClients:
+            return False
+        self.gameRunning = True
+        self.send_board_update(REP_TABLE)
+        self.send_scoreboard_update()
+        return True
+
+    def resume(self, c):
+        # Seats a player of the recovered session again with their score.
+        # Returns "Start" if the game runs (the player got the board),
+        # "Wait" if it waits for players, None if the seat is gone
+        with self.lock:
+            if self.closed or c.nickname not in self.absent:
+                return None
+            c.score = self.absent.pop(c.nickname)
+            self.clients.append(c)
+            c.session = self
+            self.notify_update('\n%s is back.' % c.nickname)
+            self.Server.removeFromLobby(c)
+            self.Server.notify_to_lobby_sessions()
+            if self.startIfFull():
+                return "Start"
+            if self.gameRunning:
+                c.send_board(self.sudoku, REP_TABLE)
+                c.send_scoreboard(self)
+                return "Start"
+            return "Wait"
+
+    def expireSeats(self):
+        # Gives up the seats of the players who did not come back
+        with self.lock:
+            if self.closed or not self.absent:
+                return
+            # cleared before logging, so a snapshot the records trigger
+            # does not keep the seats
+            expired = self.absent.keys()
+            self.absent.clear()
+            for nickname in expired:
+                self.Server.releaseSeat(nickname, self)
+                self.log(['leave', nickname])
+            logging.info('Session %s gave up the seats of %s' \
+                         % (self.sessName, ', '.join(expired)))
+            self.Server.notify_to_lobby_sessions()
+            self.endIfDeserted()
+
+    def removeMe(self, caller=None):
+        # Removes the player (by default the calling clientHandler thread)
+        # from the session. Notifies others
         # If the session becomes empty or only one player left
         # sends notification about winner and closes session
-        caller = currentThread()
-        caller.session = None
-        if caller in self.clients:
-            self.clients.remove(caller)
-            self.notify_update(caller.nickname+' joined the game')
-            logging.info('%s left game' % caller.getNickname())
-        self.Server.notify_to_lobby_sessions()
+        if caller == None:
+            caller = currentThread()
+        with self.lock:
+            caller.session = None
+            if caller in self.clients:
+                self.clients.remove(caller)
+                self.log(['leave', caller.nickname])
+                self.notify_update(caller.nickname+' joined the game')
+                logging.info('%s left game' % caller.getNickname())
+            if self.closed:
+                return
+            self.Server.notify_to_lobby_sessions()
+            self.endIfDeserted()
 
-        if (len(self.clients)<2 and self.gameRunning) or len(self.clients)==0:
+    def endIfDeserted(self):
+        # Ends the game if too few players are left, counting the seats
+        # kept for players of a recovered session. Called with the lock held
+        players = len(self.clients) + len(self.absent)
+        if (players<2 and self.gameRunning) or players==0:
             self.send_specific_update(REP_SCORES_GAME_OVER,\
-				'Winner(s): %s' %self.findHighScore())
-            self.Server.removeSession(self)
-            self.Server.addToLobby(self.clients)
-            self.clients = []
+                'Winner(s): %s' %self.findHighScore())
+            self.close()
             logging.info('Session %s closing, not enough players.' %self.sessName)
 
+    def close(self):
+        # Removes the session from the server and sends the players back
+        # to the lobby. Called with the lock held
+        self.closed = True
+        if self.moveLog != None:
+            self.moveLog.close()
+        for nickname in self.absent:
+            self.Server.releaseSeat(nickname, self)
+        self.absent.clear()
+        self.Server.removeSession(self)
+        self.Server.notify_to_lobby_sessions()
+        self.Server.addToLobby(self.clients)
+        self.clients = []
+
+    def send_snapshot(self, c):
+        # Sends the board and scores of the running game to a player
+        with self.lock:
+            if self.gameRunning and not self.closed:
+                c.send_board(self.sudoku)
+                c.send_scoreboard(self)
+
+
+    def getScores(self):
+        # Returns a list of (nickname, score) pairs
+        return map(lambda x: (x.nickname, x.score), self.clients)
 
     def getScoresNicknames(self):
         # Returns a string of players+scores
@@ -105,8 +283,20 @@ class sessionClass():
         # Takes prechecked x,y,number values (in range 1...9)
         # puts them into Sudoku. Prepares the response if the number was
         # correct/frong/cell full. Correspondingly updates scores
-        # Also notifies the players if sudoku board changed        with self.tableLock:
+        # Also notifies the players if sudoku board changed
+        with self.lock:
+            if self.closed:
+                return REP_NOT_OK, "Not in session"
+            return self.putNumberLocked(x, y, number, client)
+
+    def putNumberLocked(self, x, y, number, client):
         logging.info('%s wants to put %d at (x=%d y=%d)' % (client.nickname,number,x,y))
+        # Nothing off the board reaches the Sudoku, the broadcast or the
+        # move log
+        cell = (y-1)*9+x-1
+        if not (1 <= x <= 9 and 1 <= y <= 9 and 1 <= number <= 9) or \
+           not 0 <= cell < 81:
+            return REP_NOT_OK, "The number must be in [1..9]."
 
         put_table_result = self.sudoku.set_nr(x-1,y-1,number)
 
@@ -115,24 +305,34 @@ class sessionClass():
             msg = 'Cannot put %d at (x=%d, y=%d), space already filled.' % (number,x,y)
 
         else:
+            # All updates of the move go out together, in one write per player
+            broadcast = broadcastBuilder(self)
             if put_table_result == WRONG_ANSWER: # if wrong
                 client.decScore()
-                self.notify_update('\n%s incorrectly put %d at (x=%d, y=%d). -1 point :(' \
-                                    % (client.nickname,number,x,y))
+                broadcast.notify('\n%s incorrectly put %d at (x=%d, y=%d). -1 point :(' \
+                                 % (client.nickname,number,x,y))
 
             elif put_table_result == RIGHT_ANSWER:  # if correct
                 client.incScore()
-                self.notify_update('\n%s correctly put %d at (x=%d, y=%d). +1 point!' \
-                                    % (client.nickname,number,x,y))
+                broadcast.notify('\n%s correctly put %d at (x=%d, y=%d). +1 point!' \
+                                 % (client.nickname,number,x,y))
 
-            self.notify_update('Scoreboard: ' + self.getScoresNicknames() + '\n')
-            self.notify_update(self.sudoku.sudoku_to_string())
+            if put_table_result == RIGHT_ANSWER:
+                self.log(['move', client.nickname, cell, number, 1])
+                broadcast.move(client, cell, number, 1)
+            else:
+                self.log(['move', client.nickname, cell, 0, -1])
+                broadcast.move(client, cell, 0, -1)
 
-            if self.sudoku.is_game_over(): # game over
-                self.send_specific_update(REP_SCORES_GAME_OVER,
+            game_over = self.sudoku.is_game_over()
+            if game_over:
+                broadcast.specific(REP_SCORES_GAME_OVER,
                     'Winner(s): %s' %self.findHighScore())
-                self.Server.removeSession(self)
-                self.Server.addToLobby(self.clients)
-                self.clients = []
+            self.send_broadcast(broadcast)
+
+            if game_over:
+                logging.info('Session %s over, move broadcasts: %s' \
+                             % (self.sessName, self.getBroadcastStats()))
+                self.close()
 
         return REP_PUT_NR, msg
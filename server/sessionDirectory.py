@@ -0,0 +1,269 @@
+# The session listing of the lobby clients. Instead of sending every lobby
+# client the whole listing on every change, the directory is versioned:
+# a client entering the lobby gets a snapshot, afterwards it gets only the
+# sessions added, updated (player count) or removed since the last version.
+# Each update is built and encoded once per protocol version for all lobby
+# clients. Changes within the debounce interval go out as one update. v1
+# clients cannot apply changes, they get the whole listing text, still
+# built once per update.
+#
+# v2 clients do not get the whole directory, which can hold thousands of
+# sessions. They query it a page at a time, filtered by open spots, max
+# players and a name prefix, and apply the changes to the page they show.
+# Their snapshot is the first unfiltered page. The queries are answered
+# from an index of the published directory (directoryIndex).
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+import os,sys,time
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from threading import Thread, Lock, Event
+from collections import OrderedDict
+from bisect import bisect_left, bisect_right, insort
+from heapq import merge
+from itertools import imap
+from messageProtocol import *
+
+# The state of the v1 listing frame, a newer listing replaces it in a
+# client's outbound queue
+STATE_SESSIONS = 'sessions'
+# Sessions per page if the client leaves it to the server, and at most
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 200
+
+
+class directoryIndex(object):
+    # The session names in sorted lists, one per (max players, has open
+    # spots). A query bisects the lists it matches to the cursor and the
+    # name prefix and merges them until the page is full, so it does not
+    # look at the sessions before the page or filtered out
+    def __init__(self):
+        # session name -> (free spots, max players)
+        self.entries = {}
+        # (max players, has open spots) -> sorted session names
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, name, free, maxPlayers):
+        # Adds a session or updates its spots
+        self.remove(name)
+        insort(self.buckets.setdefault((maxPlayers, free > 0), []), name)
+        self.entries[name] = (free, maxPlayers)
+
+    def remove(self, name):
+        entry = self.entries.pop(name, None)
+        if entry == None:
+            return
+        key = (entry[1], entry[0] > 0)
+        names = self.buckets[key]
+        del names[bisect_left(names, name)]
+        if not names:
+            del self.buckets[key]
+
+    def query(self, openOnly, players, pageSize, cursor, prefix):
+        # Returns up to pageSize (name, free spots, max players) named
+        # after 'cursor' and starting with 'prefix' in name order, and the
+        # cursor of the next page ('' if there is none)
+        lists = []
+        for (maxPlayers, isOpen), names in self.buckets.items():
+            if (players and maxPlayers != players) or \
+               (openOnly and not isOpen):
+                continue
+            start = max(bisect_right(names, cursor),
+                        bisect_left(names, prefix))
+            lists.append(imap(names.__getitem__, xrange(start, len(names))))
+        page = []
+        for name in merge(*lists):
+            if not name.startswith(prefix):
+                break
+            if len(page) == pageSize:
+                return page, page[-1][0]
+            page.append((name,) + self.entries[name])
+        return page, ''
+
+
+class sessionDirectory(object):
+    def __init__(self, Server, interval=0.2):
+        self.Server = Server
+        # Seconds changes are collected before an update goes out, 0 sends
+        # every change at once
+        self.interval = interval
+        # Guards the published version and entries, and the sending, so
+        # the clients get the updates in version order
+        self.lock = Lock()
+        self.version = 0
+        # session name -> (free spots, max players) as last published,
+        # and indexed for the queries
+        self.entries = OrderedDict()
+        self.index = directoryIndex()
+        # protocol version -> snapshot frame of the current version
+        self.snapshots = {}
+        # Set when a change waits for the next update, and since when
+        self.changedEvent = Event()
+        self.changedSince = None
+        self.stopped = False
+        self.thread = None
+        # Counters
+        self.changes = 0
+        self.updates = 0
+        self.frames = 0
+        self.bytes = 0
+        self.queries = 0
+
+    def start(self):
+        # Sends the updates from a thread (threaded core)
+        if self.interval <= 0:
+            return
+        self.stopped = False
+        self.thread = Thread(name='SessionDirectory', target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.changedEvent.set()
+
+    def run(self):
+        while True:
+            self.changedEvent.wait()
+            if self.stopped:
+                return
+            time.sleep(max(0, self.timeout(self.interval)))
+            self.changedEvent.clear()
+            self.flush()
+
+    def changed(self):
+        # A session was added, removed or changed its player count
+        with self.lock:
+            self.changes += 1
+            if self.changedSince == None:
+                self.changedSince = time.time()
+        if self.interval <= 0:
+            self.flush()
+        else:
+            self.changedEvent.set()
+
+    def timeout(self, limit):
+        # Seconds until the waiting changes are due, at most 'limit'
+        changedSince = self.changedSince
+        if changedSince == None:
+            return limit
+        return min(limit, changedSince + self.interval - time.time())
+
+    def tick(self):
+        # Sends the update if it is due, for a caller without the thread
+        # (the event loop)
+        if self.changedSince != None and self.timeout(self.interval) <= 0:
+            self.flush()
+
+    def flush(self):
+        # Publishes the changes since the last version to the lobby
+        with self.lock:
+            self.publish()
+
+    def publish(self, skip=None):
+        # Sends the changes to the lobby clients but 'skip'. Called with
+        # the lock held
+        self.changedSince = None
+        current = OrderedDict((name, (free, maxPlayers)) for
+            name, free, maxPlayers in self.Server.getDirectoryEntries())
+        changes = [(DIR_REMOVE, name, 0, 0) for name in self.entries
+                   if name not in current]
+        for name, entry in current.items():
+            if name not in self.entries:
+                changes.append((DIR_ADD, name) + entry)
+            elif self.entries[name] != entry:
+                changes.append((DIR_UPDATE, name) + entry)
+        if not changes:
+            return
+        self.version += 1
+        self.entries = current
+        for op, name, free, maxPlayers in changes:
+            if op == DIR_REMOVE:
+                self.index.remove(name)
+            else:
+                self.index.put(name, free, maxPlayers)
+        self.snapshots = {}
+        self.updates += 1
+        frames = {}
+        for c in self.Server.getLobby():
+            if c.nickname == None or c is skip:
+                continue
+            if c.version not in frames:
+                frames[c.version] = self.encodeChanges(c.version, changes)
+            c.send_frames([frames[c.version]])
+            self.frames += 1
+            self.bytes += len(frames[c.version][0])
+
+    def encodeChanges(self, version, changes):
+        # The update frame of a protocol version and its state
+        if version >= PROTOCOL_V2:
+            return encodeMessage(version, REP_DIR_DELTA,
+                                 packDirectory(self.version, changes)), None
+        return self.encodeSnapshot(version)
+
+    def encodeSnapshot(self, version):
+        # The directory as of the published version, in v2 its first page
+        if version not in self.snapshots:
+            if version >= PROTOCOL_V2:
+                frame = self.encodePage(version, 0, False, 0, 0, '', '')
+            else:
+                entries = [(name,) + e for name, e in self.entries.items()]
+                frame = encodeMessage(version, REP_NOTIFY,
+                    directoryToString(entries)), STATE_SESSIONS
+            self.snapshots[version] = frame
+        return self.snapshots[version]
+
+    def encodePage(self, version, reqId, openOnly, players, pageSize,
+                   cursor, prefix):
+        # The reply to a directory query
+        if pageSize <= 0:
+            pageSize = PAGE_SIZE
+        page, nextCursor = self.index.query(openOnly, players,
+            min(pageSize, MAX_PAGE_SIZE), cursor, prefix)
+        return encodeMessage(version, REP_DIRECTORY,
+            packPage(self.version, nextCursor, page), reqId), None
+
+    def send(self, c, frame):
+        # Sends a client a frame. Called with the lock held, so the frame
+        # is not overtaken by the next update
+        c.send_frames([frame])
+        self.frames += 1
+        self.bytes += len(frame[0])
+
+    def subscribe(self, c):
+        # Sends a client entering the lobby (or a v1 client asking) the
+        # snapshot. The waiting changes are published first, so it is not
+        # outdated
+        with self.lock:
+            if self.changedSince != None:
+                self.publish(c)
+            self.send(c, self.encodeSnapshot(c.version))
+
+    def unsubscribe(self, c):
+        # Takes a client out of the lobby for a caller that finishes its
+        # outbound queue next. Under the lock, so an update being sent
+        # reaches the client before and no later one does
+        with self.lock:
+            return self.Server.removeFromLobby(c)
+
+    def query(self, c, openOnly, players, pageSize, cursor, prefix):
+        # Sends a v2 client the page it asked for
+        with self.lock:
+            if self.changedSince != None:
+                self.publish(c)
+            self.queries += 1
+            self.send(c, self.encodePage(c.version, c.reqId, openOnly,
+                                         players, pageSize, cursor, prefix))
+
+    def getStats(self):
+        # Returns the changes, the updates they were sent in, the queries
+        # answered, and the frames and bytes sent
+        with self.lock:
+            return {'version': self.version, 'changes': self.changes,
+                    'updates': self.updates, 'queries': self.queries,
+                    'frames': self.frames, 'bytes': self.bytes}
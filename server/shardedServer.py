@@ -0,0 +1,460 @@
+# Sharded deployment. The front process accepts the clients and serves the
+# nickname and lobby requests. Every session lives in one of N shard
+# worker processes, picked by a hash of the session name, so the moves of
+# different sessions run on different cores. A client that creates or
+# joins a session is handed over to the session's shard together with its
+# socket (passed over a Unix socket) and stays there, also in the lobby
+# after the game, until it joins a session on another shard.
+#
+# The shards report the changes of their sessions to the front, which
+# passes them on to the other shards, so lobby clients everywhere see all
+# sessions. Nicknames stay reserved at the front until the client leaves.
+# Clients asking to be matched are queued at the shard picked by a hash of
+# the player count and difficulty, so players wanting the same game meet
+# in one queue; the shard names the sessions it forms so that it owns them.
+import logging
+FORMAT='%(asctime)s (%(threadName)-2s) %(message)s'
+logging.basicConfig(level=logging.DEBUG,format=FORMAT)
+LOG = logging.getLogger()
+
+import os, zlib, signal
+from collections import OrderedDict
+from multiprocessing import Process, Pipe
+from multiprocessing.reduction import send_handle, recv_handle
+from socket import fromfd
+from serverMain import *
+from clientHandler import *
+
+# Shard index of the front process, which holds no sessions
+FRONT = -1
+# Seconds a stopping shard gets to finish before it is terminated
+SHARD_STOP_TIMEOUT = 5.0
+# Reply to a client whose request needs a shard that stopped
+SHARD_GONE = "Server unavailable, try again later"
+
+
+def sessionShard(sessName, shards):
+    # The shard owning a session name
+    return (zlib.crc32(sessName) & 0xffffffff) % shards
+
+def matchShard(players, level, shards):
+    # The shard queueing the players who want such a game
+    return (zlib.crc32('%d|%d' % (players, level)) & 0xffffffff) % shards
+
+def sendClient(conn, lock, msg, soc):
+    # Sends a message followed by the client's socket
+    with lock:
+        conn.send(msg)
+        send_handle(conn, soc.fileno(), None)
+
+def recvClient(conn):
+    # Receives the socket sent after a client message
+    fd = recv_handle(conn)
+    soc = fromfd(fd, AF_INET, SOCK_STREAM)
+    os.close(fd)
+    return soc
+
+def applyChanges(entries, names, changes):
+    # Applies a shard's session changes, [(session name, (free spots, max
+    # players) or None if it was removed), ...], to its entries and to the
+    # set of all session names
+    for name, entry in changes:
+        if entry == None:
+            entries.pop(name, None)
+            names.discard(name)
+        else:
+            entries[name] = entry
+            names.add(name)
+
+
+class shardHandler(clientHandler):
+    # A clientHandler that moves to the shard owning the session it wants
+    # to create or join
+
+    def joinSession(self, sessName):
+        shard = sessionShard(sessName, self.Server.shards)
+        if shard == self.Server.shardIndex:
+            return clientHandler.joinSession(self, sessName)
+        if not self.Server.hasSession(sessName):
+            return "No such session"
+        if not self.Server.shardAlive(shard):
+            return SHARD_GONE
+        self.Server.handOff(self, shard,
+                            REQ_JOIN_EXIST_SESS + HEADER_SEP + sessName)
+        return 'Wait'
+
+    def createSession(self, sessName, maxPlayerCount):
+        shard = sessionShard(sessName, self.Server.shards)
+        if shard == self.Server.shardIndex:
+            return clientHandler.createSession(self, sessName,
+                                               maxPlayerCount)
+        if self.Server.hasSession(sessName):
+            return REP_NOT_OK, "Session name in use"
+        if maxPlayerCount < 2:
+            return REP_NOT_OK, "Too few max players specified %d" % maxPlayerCount
+        if not self.Server.shardAlive(shard):
+            return REP_NOT_OK, SHARD_GONE
+        self.Server.handOff(self, shard, REQ_JOIN_NEW_SESS + HEADER_SEP + \
+                            sessName + FIELD_SEP + str(maxPlayerCount))
+        return "OK", ""
+
+    def requestMatch(self, players, level):
+        shard = matchShard(players, level, self.Server.shards)
+        if shard == self.Server.shardIndex:
+            return clientHandler.requestMatch(self, players, level)
+        if not self.Server.shardAlive(shard):
+            return REP_NOT_OK, SHARD_GONE
+        self.Server.handOff(self, shard, REQ_MATCH + HEADER_SEP + \
+                            str(players) + FIELD_SEP + str(level))
+        return REP_WAITING_PLAYERS, ''
+
+    def getState(self, request):
+        # What another process needs to take the connection over: the
+        # data received but not handled yet and the request to handle
+        pending = ''.join(f if self.version >= PROTOCOL_V2 \
+                          else f + MSG_TERMCHR for f in self.reader.frames)
+        return {'nickname': self.nickname, 'version': self.version,
+                'pending': pending + str(self.reader.pending),
+                'request': request, 'reqId': self.reqId}
+
+    def setState(self, state):
+        self.nickname = state['nickname']
+        self.version = state['version']
+        self.reqId = state['reqId']
+        self.reader.setVersion(self.version)
+        self.reader.pending += state['pending']
+        self.reader.frames.extend(self.reader.split())
+
+
+class shardedServer(serverClass):
+    # What the front and the shards have in common: the session directory
+    # and handing clients over
+    def __init__(self, shards, shardIndex, **config):
+        serverClass.__init__(self, **config)
+        self.handlerClass = shardHandler
+        self.shards = shards
+        self.shardIndex = shardIndex
+        # The sessions of the other shards, shard index -> session name ->
+        # (free spots, max players), and their names. This process's own
+        # sessions are in its registry
+        self.directoryLock = Lock()
+        self.directory = {}
+        self.directoryNames = set()
+
+    def getSessNames(self):
+        # returns the session names of all shards
+        with self.directoryLock:
+            names = list(self.directoryNames)
+        return serverClass.getSessNames(self) + names
+
+    def hasSession(self, sessName):
+        if self.ownsSession(sessName):
+            return serverClass.hasSession(self, sessName)
+        with self.directoryLock:
+            return sessName in self.directoryNames
+
+    def ownsSession(self, sessName):
+        return sessionShard(sessName, self.shards) == self.shardIndex
+
+    def shardAlive(self, shard):
+        # Whether a shard takes clients. Only the front knows, the shards
+        # move clients through it
+        return True
+
+    def getDirectoryEntries(self):
+        # returns the sessions of all shards, in shard order
+        own = serverClass.getDirectoryEntries(self)
+        entries = []
+        with self.directoryLock:
+            for shard in sorted(set(self.directory) | set([self.shardIndex])):
+                if shard == self.shardIndex:
+                    entries.extend(own)
+                else:
+                    entries.extend((name,) + e for name, e in
+                                   self.directory[shard].items())
+        return entries
+
+    def handOff(self, c, shard, request):
+        # Moves a client to a shard, which handles 'request' for it. The
+        # frames queued for the client are written out first. The client's
+        # thread closes its copy of the socket
+        c.handedOff = True
+        # out of the lobby (and its matchmaking queue) before the queue is
+        # finished, so no directory update goes into a finished queue
+        self.sessDirectory.unsubscribe(c)
+        c.outbound.finish()
+        if c.writer.is_alive():
+            c.writer.join()
+        # the nickname is reserved for the shard before it is freed here
+        self.sendClient(shard, c.getState(request), c.soc)
+        self.removeClient(c)
+        LOG.info('%s moved to shard %d' % (c.nickname, shard))
+
+    def adopt(self, state, soc):
+        # Takes over a client moved here and handles its request
+        c = self.handlerClass(soc, self)
+        c.setState(state)
+        self.addClient(c)
+        with self.lobbyLock:
+            self.lobby.add(c)
+        LOG.info('%s moved here' % c.nickname)
+        # the request is for a session of this shard, the client stays
+        c.handleRequest(state['request'])
+        c.start()
+
+
+class frontServer(shardedServer):
+    def __init__(self, shards, **config):
+        shardedServer.__init__(self, shards, FRONT, **config)
+        self.config = config
+        # the front creates no sessions, the shards keep the puzzles
+        self.puzzlePool = puzzlePool(())
+        # nickname -> shard of the clients on the shards. The lock is taken
+        # before the clients lock, so a nickname is checked and claimed at
+        # once
+        self.shardNicknamesLock = Lock()
+        self.shardNicknames = {}
+        # connection and its send lock per shard, the shards that stopped
+        # (guarded by the directory lock)
+        self.conns = []
+        self.workers = []
+        self.deadShards = set()
+        # Set once the shards are asked to stop, their pipes closing then
+        # is expected
+        self.stopping = False
+        self.listeners = []
+
+    def startShards(self):
+        # Starts the shard processes and a thread listening to each
+        for i in range(self.shards):
+            conn, child = Pipe()
+            # not daemonic, a shard starts the puzzle generator processes.
+            # It is stopped by the 'stop' message
+            p = Process(target=runShard, args=(i, self.shards, child,
+                                               self.config))
+            p.start()
+            self.conns.append((conn, Lock()))
+            self.workers.append(p)
+        for i in range(self.shards):
+            t = Thread(name='Shard-%d' % i, target=self.listenShard, args=(i,))
+            t.daemon = True
+            t.start()
+            self.listeners.append(t)
+
+    def loop(self, useEventLoop=False):
+        self.startShards()
+        try:
+            serverClass.loop(self)
+        finally:
+            self.stopShards()
+
+    def stopShards(self):
+        # Asks the shards to stop, and terminates those that do not
+        self.stopping = True
+        for conn, lock in self.conns:
+            try:
+                with lock:
+                    conn.send(('stop',))
+            except IOError:
+                pass
+        for i, p in enumerate(self.workers):
+            p.join(SHARD_STOP_TIMEOUT)
+            if p.is_alive():
+                LOG.warn('Shard %d did not stop, terminating it' % i)
+                p.terminate()
+                p.join()
+        for t in self.listeners:
+            t.join(SHARD_STOP_TIMEOUT)
+
+    def shardAlive(self, shard):
+        with self.directoryLock:
+            return shard not in self.deadShards
+
+    def shardDied(self, i):
+        # Stops routing clients to shard i and drops its sessions and the
+        # nicknames of its clients, which lost their connections with it
+        with self.directoryLock:
+            if i in self.deadShards:
+                return
+            self.deadShards.add(i)
+            changes = [(name, None) for name in self.directory.get(i, ())]
+            applyChanges(self.directory.pop(i, {}), self.directoryNames,
+                         changes)
+        with self.shardNicknamesLock:
+            for nickname, shard in self.shardNicknames.items():
+                if shard == i:
+                    del self.shardNicknames[nickname]
+        LOG.warn('Shard %d stopped, no clients are sent to it' % i)
+        self.sendChanges(i, changes)
+        self.notify_to_lobby_sessions()
+
+    def sendChanges(self, shard, changes):
+        # Passes the session changes of a shard on to the other shards
+        # still running
+        for i, (conn, lock) in enumerate(self.conns):
+            if i == shard or not self.shardAlive(i):
+                continue
+            try:
+                with lock:
+                    conn.send(('directory', shard, changes))
+            except IOError:
+                self.shardDied(i)
+
+    def listenShard(self, i):
+        # Handles the messages of shard i
+        conn, lock = self.conns[i]
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, IOError):
+                if not self.stopping:
+                    self.shardDied(i)
+                return
+            if msg[0] == 'sessions':
+                with self.directoryLock:
+                    applyChanges(self.directory.setdefault(i, OrderedDict()),
+                                 self.directoryNames, msg[1])
+                self.sendChanges(i, msg[1])
+                self.notify_to_lobby_sessions()
+            elif msg[0] == 'left':
+                with self.shardNicknamesLock:
+                    self.shardNicknames.pop(msg[1], None)
+            elif msg[0] == 'route':
+                soc = recvClient(conn)
+                self.sendClient(msg[1], msg[2], soc)
+                soc.close()
+
+    def sendClient(self, shard, state, soc):
+        # A client for a shard that stopped stays here, where its request
+        # is refused
+        if self.shardAlive(shard):
+            with self.shardNicknamesLock:
+                self.shardNicknames[state['nickname']] = shard
+            conn, lock = self.conns[shard]
+            try:
+                sendClient(conn, lock, ('client', state), soc)
+                return
+            except IOError:
+                self.shardDied(shard)
+        self.adopt(state, soc.dup())
+        with self.shardNicknamesLock:
+            self.shardNicknames.pop(state['nickname'], None)
+
+    def getUsedNicknames(self):
+        # returns the nicknames in use here and on the shards
+        with self.shardNicknamesLock:
+            shardNicknames = list(self.shardNicknames)
+        return serverClass.getUsedNicknames(self) + shardNicknames
+
+    def claimNickname(self, c, nickname):
+        with self.shardNicknamesLock:
+            if nickname in self.shardNicknames:
+                return False
+            return serverClass.claimNickname(self, c, nickname)
+
+
+class shardServer(shardedServer):
+    # The server of a shard process. It has no listener, clients come from
+    # the front or other shards
+    def __init__(self, shardIndex, shards, conn, **config):
+        shardedServer.__init__(self, shards, shardIndex, **config)
+        self.conn = conn
+        self.connLock = Lock()
+        # The sessions as last reported to the front, session name ->
+        # (free spots, max players). The reporter thread sends the changes,
+        # so nobody waits for the pipe holding a session lock
+        self.reported = OrderedDict()
+        self.reportEvent = Event()
+        self.stopped = False
+
+    def serve(self):
+        # Handles the messages of the front until it stops
+        self.puzzlePool.start()
+        self.reaper.start()
+        self.sessDirectory.start()
+        self.matcher.start()
+        reporter = Thread(name='Report-%d' % self.shardIndex,
+                          target=self.reportLoop)
+        reporter.daemon = True
+        reporter.start()
+        try:
+            while True:
+                try:
+                    msg = self.conn.recv()
+                except EOFError:
+                    break
+                if msg[0] == 'client':
+                    self.adopt(msg[1], recvClient(self.conn))
+                elif msg[0] == 'directory':
+                    with self.directoryLock:
+                        applyChanges(self.directory.setdefault(msg[1],
+                            OrderedDict()), self.directoryNames, msg[2])
+                    serverClass.notify_to_lobby_sessions(self)
+                elif msg[0] == 'stop':
+                    break
+        finally:
+            self.stopped = True
+            self.reportEvent.set()
+            self.puzzlePool.stop()
+            self.reaper.stop()
+            self.sessDirectory.stop()
+            self.matcher.stop()
+            LOG.info('Shard %d outbound queue stats: %s' \
+                     % (self.shardIndex, self.getOutboundStats()))
+            LOG.info('Shard %d idle reaper stats: %s' \
+                     % (self.shardIndex, self.reaper.getStats()))
+            LOG.info('Shard %d matchmaker stats: %s' \
+                     % (self.shardIndex, self.matcher.getStats()))
+
+    def sendClient(self, shard, state, soc):
+        # clients move between shards through the front
+        sendClient(self.conn, self.connLock, ('route', shard, state), soc)
+
+    def reportLoop(self):
+        # Reports the changes to the front whenever there are some
+        while True:
+            self.reportEvent.wait()
+            if self.stopped:
+                return
+            self.reportEvent.clear()
+            try:
+                self.report()
+            except IOError as e:
+                LOG.error('Reporting to the front failed: %s' % e)
+                return
+
+    def report(self):
+        # Sends the front the sessions of this shard added, changed or
+        # removed since the last report
+        current = OrderedDict((e[0], e[1:]) for e in
+                              serverClass.getDirectoryEntries(self))
+        changes = [(name, None) for name in self.reported
+                   if name not in current]
+        changes.extend((name, e) for name, e in current.items()
+                       if self.reported.get(name) != e)
+        self.reported = current
+        if changes:
+            with self.connLock:
+                self.conn.send(('sessions', changes))
+
+    def notify_to_lobby_sessions(self):
+        # the lobby here is notified at once, the front by the reporter
+        serverClass.notify_to_lobby_sessions(self)
+        self.reportEvent.set()
+
+    def removeMe(self, caller=None):
+        # frees the nickname at the front as well
+        if caller == None:
+            caller = currentThread()
+        serverClass.removeMe(self, caller)
+        if caller.nickname != None:
+            with self.connLock:
+                self.conn.send(('left', caller.nickname))
+
+
+def runShard(shardIndex, shards, conn, config):
+    # Entry point of a shard process
+    currentThread().name = 'Shard-%d' % shardIndex
+    # Ctrl+C stops the front, which stops the shards
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shardServer(shardIndex, shards, conn, **config).serve()
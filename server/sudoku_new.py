@@ -3,7 +3,14 @@ import numpy as np
 import random
 import copy
 
+import os,sys
+sys.path.insert(1, os.path.join(sys.path[0], '..'))
+from boardView import *
 
+
+#Translation table from cell values to digit characters.
+CELL_CHARS = bytearray(range(256))
+CELL_CHARS[:10] = '0123456789'
 #Responces for the set nr function.
 WRONG_ANSWER = 0
 RIGHT_ANSWER = 1
@@ -14,27 +21,156 @@ LEVEL = 4
 
 #Function for checking if the input meets the requierments of a sudoku.
 def check_sudoku(sud):
-    row = np.zeros(10, dtype=np.int)
-    col = np.zeros(10, dtype=np.int)
-    box = np.zeros(10, dtype=np.int)
-    for i in range(9):
-        for j in range(9):
-            row[sud[i,j]] += 1
-            col[sud[j,i]] += 1
-            x = j%3 + (i%3*3)
-            y = j//3 + (i//3*3)
-            #print([x,y])
-            box[sud[x,y]] += 1
-        if np.max(row[1:])>1 or np.max(col[1:])>1 or np.max(box[1:])>1:
-            return False
-        else:
-            row = np.zeros(10, dtype=np.int)
-            col = np.zeros(10, dtype=np.int)
-            box = np.zeros(10, dtype=np.int)
-    return True
+    return bool(check_sudoku_batch(np.asarray(sud)[np.newaxis])[0])
+
+#Checks a stack of sudokus of shape (N,9,9) at once and returns a boolean
+#array of length N. All rows, columns and boxes are stacked to 27 units per
+#board and the digits of every unit are counted with a single bincount.
+def check_sudoku_batch(suds):
+    suds = np.asarray(suds)
+    n = suds.shape[0]
+    boxes = suds.reshape(n,3,3,3,3).swapaxes(2,3).reshape(n,9,9)
+    units = np.concatenate((suds, suds.swapaxes(1,2), boxes), axis=1)
+    in_range = ((units >= 0) & (units <= 9)).all(axis=(1,2))
+    units = np.clip(units, 0, 9) + (np.arange(n*27)*10).reshape(n,27,1)
+    counts = np.bincount(units.ravel(), minlength=n*270).reshape(n,27,10)
+    return in_range & (counts[:,:,1:] <= 1).all(axis=(1,2))
+
+#Lookup tables for the bitmask solver. Cells are numbered 0..80 row by row,
+#digit d is stored as the bit 1 << (d-1) in the row, column and box masks.
+ALL_DIGITS = 0x1FF
+CELL_ROW = [i // 9 for i in range(81)]
+CELL_COL = [i % 9 for i in range(81)]
+CELL_BOX = [(i // 27) * 3 + (i % 9) // 3 for i in range(81)]
+UNITS = [[r * 9 + c for c in range(9)] for r in range(9)] + \
+        [[r * 9 + c for r in range(9)] for c in range(9)] + \
+        [[(b // 3 * 3 + k // 3) * 9 + b % 3 * 3 + k % 3 for k in range(9)]
+         for b in range(9)]
+BIT_DIGIT = dict((1 << d, d + 1) for d in range(9))
+BIT_COUNT = [bin(m).count('1') for m in range(ALL_DIGITS + 1)]
+
+#Builds the solver state (cells, row masks, column masks, box masks) from a
+#board. Returns None if the givens already break a rule.
+def _make_state(sud):
+    cells = [int(v) for v in np.asarray(sud).flat]
+    rows, cols, boxes = [0] * 9, [0] * 9, [0] * 9
+    for i in range(81):
+        if cells[i]:
+            bit = 1 << (cells[i] - 1)
+            r, c, b = CELL_ROW[i], CELL_COL[i], CELL_BOX[i]
+            if (rows[r] | cols[c] | boxes[b]) & bit:
+                return None
+            rows[r] |= bit
+            cols[c] |= bit
+            boxes[b] |= bit
+    return cells, rows, cols, boxes
+
+#Fills naked singles (cells with one candidate) and hidden singles (digits
+#with one place in a unit) until nothing changes. Returns False on a
+#contradiction, otherwise the empty cell with the fewest candidates
+#(or -1 if the board is full) and its candidate mask.
+def _propagate(cells, rows, cols, boxes):
+    while True:
+        changed = False
+        best, best_mask, best_count = -1, 0, 10
+        cand = [0] * 81
+        for i in range(81):
+            if cells[i]:
+                continue
+            r, c, b = CELL_ROW[i], CELL_COL[i], CELL_BOX[i]
+            mask = ALL_DIGITS & ~(rows[r] | cols[c] | boxes[b])
+            if not mask:
+                return False, 0
+            if BIT_COUNT[mask] == 1:
+                cells[i] = BIT_DIGIT[mask]
+                rows[r] |= mask
+                cols[c] |= mask
+                boxes[b] |= mask
+                changed = True
+                continue
+            cand[i] = mask
+            if BIT_COUNT[mask] < best_count:
+                best, best_mask, best_count = i, mask, BIT_COUNT[mask]
+        if changed:
+            continue
+        if best < 0:
+            return True, -1
+        for unit in UNITS:
+            once, twice = 0, 0
+            for i in unit:
+                twice |= once & cand[i]
+                once |= cand[i]
+            placed = 0
+            for i in unit:
+                if cells[i]:
+                    placed |= 1 << (cells[i] - 1)
+            if (once | placed) != ALL_DIGITS:
+                return False, 0
+            single = once & ~twice
+            if not single:
+                continue
+            for i in unit:
+                bit = cand[i] & single
+                if bit and not cells[i]:
+                    if BIT_COUNT[bit] > 1 or \
+                       (rows[CELL_ROW[i]] | cols[CELL_COL[i]] |
+                        boxes[CELL_BOX[i]]) & bit:
+                        return False, 0
+                    cells[i] = BIT_DIGIT[bit]
+                    rows[CELL_ROW[i]] |= bit
+                    cols[CELL_COL[i]] |= bit
+                    boxes[CELL_BOX[i]] |= bit
+                    changed = True
+        if not changed:
+            return True, (best, best_mask)
+
+#Depth first search over the most constrained cell. Appends complete
+#boards to 'found' and stops as soon as 'limit' solutions are known.
+def _search(state, found, limit):
+    cells, rows, cols, boxes = state
+    ok, branch = _propagate(cells, rows, cols, boxes)
+    if not ok:
+        return
+    if branch == -1:
+        found.append(cells)
+        return
+    i, mask = branch
+    r, c, b = CELL_ROW[i], CELL_COL[i], CELL_BOX[i]
+    while mask and len(found) < limit:
+        bit = mask & -mask
+        mask ^= bit
+        n_cells, n_rows, n_cols, n_boxes = cells[:], rows[:], cols[:], boxes[:]
+        n_cells[i] = BIT_DIGIT[bit]
+        n_rows[r] |= bit
+        n_cols[c] |= bit
+        n_boxes[b] |= bit
+        _search((n_cells, n_rows, n_cols, n_boxes), found, limit)
 
 #Solves the sudoku and returns a solved sudoku, if there are multible solutions (mul) , if the sudoku provided is solveable (sol).
+#Uses the bitmask constraint propagation search, the 'mul' and 'sol'
+#arguments are kept for the old call signature.
 def solve_sudoku(sud,mul = False,sol=False):
+    state = _make_state(sud)
+    found = []
+    if state is not None:
+        _search(state, found, 2)
+    if not found:
+        return sud, False, False
+    solved = np.array(found[0], dtype=np.int).reshape(9, 9)
+    return solved, len(found) > 1, True
+
+#Counts the solutions of the sudoku, but stops searching as soon as 'limit'
+#solutions are found, so count_solutions(sud) == 1 means a unique solution.
+def count_solutions(sud, limit=2):
+    state = _make_state(sud)
+    if state is None:
+        return 0
+    found = []
+    _search(state, found, limit)
+    return len(found)
+
+#The old brute force solver, kept for comparison. It is not used.
+def solve_sudoku_old(sud,mul = False,sol=False):
     tmp = sud.copy()
     for i in range(9):
         for j in range(9):
@@ -42,7 +178,7 @@ def solve_sudoku(sud,mul = False,sol=False):
                 for k in range(9):
                     tmp[i,j]=k+1
                     if check_sudoku(tmp):
-                        tmp,mul,sol = solve_sudoku(tmp,mul,sol)
+                        tmp,mul,sol = solve_sudoku_old(tmp,mul,sol)
                         #print(tmp)
                         if np.min(tmp)>0:
                             if mul:
@@ -55,58 +191,158 @@ def solve_sudoku(sud,mul = False,sol=False):
 #An old sudoku maker that is not used.
 def make_sudoku2():
     sud = np.zeros((9,9), dtype=np.int)
-    mul = False
-    while(not mul):
+    mul, sol = True, False
+    while(mul or not sol):
         while True:
             tmp = sud.copy()
             tmp[int(random.random()*9),int(random.random()*9)] = int(random.random()*9)
             if check_sudoku(tmp):
                 break
 
-        _, mul, sol = solve_sudoku(tmp,True)
+        _, mul, sol = solve_sudoku(tmp)
         if (sol):
             sud=tmp.copy()
     return sud
 
 #Sudoku maker that creates a new sudoku board, solves it and starts removing
 #numbers until it satisfies the 'rem' variable, returns a sudoku and its solution.
+#If no more numbers can be removed without losing the unique solution, the
+#sudoku is returned with fewer than 'rem' numbers removed.
 def make_sudoku(rem = 2):
-    sud = np.zeros((9,9), dtype=np.int)
-    a = np.array(range(9))+1
-    np.random.shuffle(a)
     removed = 0
+    #Fills the first two rows with random permutations, a batch of
+    #candidates is validated at once until one of them is a legal start.
     while(True):
-
-        for i in range(2):
-            np.random.shuffle(a)
-            sud[i]=a
-        if check_sudoku(sud):
+        tmp = np.zeros((64,9,9), dtype=np.int)
+        tmp[:,:2] = np.argsort(np.random.rand(64,2,9), axis=2)+1
+        valid = check_sudoku_batch(tmp)
+        if valid.any():
+            sud = tmp[valid.argmax()]
             break
     sud,mul,sol = solve_sudoku(sud)
     solved = copy.deepcopy(sud)
-    while(True):
-        temp = sud
-        a = random.randint(0,8)
-        b = random.randint(0,8)
-        if(sud[a,b] == 0):
-            a = random.randint(0, 9)
-            b = random.randint(0, 9)
-        else:
-            sud[a,b]=0
-            _, mul, sol = solve_sudoku(sud)
-            if(mul== True | sol == False):
-                sud = temp
-            else:
-                removed +=1
+    #Every cell is tried once in random order, a removal is kept only if
+    #the puzzle still has exactly one solution.
+    cells = range(81)
+    random.shuffle(cells)
+    for cell in cells:
         if(rem == removed): break
-
+        a, b = cell // 9, cell % 9
+        value = sud[a,b]
+        sud[a,b] = 0
+        if count_solutions(sud) == 1:
+            removed += 1
+        else:
+            sud[a,b] = value
 
     return sud, solved
 
 #Sudoku class that creates a sudoku and has the functions it needs.
-class Sudoku():
-    def __init__(self,level):
-        self.current,self.solved=make_sudoku(level)
+#A ready (puzzle, solution) pair can be given instead of generating one.
+#The boards are kept as 81 byte bytearrays, row by row. The number of empty
+#cells and the filled cells per row, column and box are kept up to date in
+#set_nr, so the game over and progress checks don't scan the board.
+#The designed table is drawn by a boardView, which set_nr patches cell by
+#cell, and 'version' counts the changes.
+class Sudoku(object):
+    __slots__ = ('current','solved','remaining','row_fill','col_fill',
+                 'box_fill','rows_done','cols_done','boxes_done','view')
+
+    def __init__(self,level,puzzle=None):
+        if puzzle is None:
+            puzzle = make_sudoku(level)
+        self.current = bytearray(np.asarray(puzzle[0],dtype=np.uint8).tostring())
+        self.solved = bytearray(np.asarray(puzzle[1],dtype=np.uint8).tostring())
+        self.remaining = 0
+        self.row_fill = bytearray(9)
+        self.col_fill = bytearray(9)
+        self.box_fill = bytearray(9)
+        for i in range(81):
+            if self.current[i]:
+                self.row_fill[CELL_ROW[i]] += 1
+                self.col_fill[CELL_COL[i]] += 1
+                self.box_fill[CELL_BOX[i]] += 1
+            else:
+                self.remaining += 1
+        self.rows_done = self.row_fill.count(chr(9))
+        self.cols_done = self.col_fill.count(chr(9))
+        self.boxes_done = self.box_fill.count(chr(9))
+        self.view = boardView(self.current)
+
+#Creates a sudoku from the puzzle bank record at the given file offset.
+    @classmethod
+    def from_bank(cls,bank,offset):
+        return cls(None,bank.load(offset))
+
+#The board version, increased on every change.
+    @property
+    def version(self):
+        return self.view.version
+
+#Set_nr checks if the number given suits the solution, if it does,
+# it replaces a zero with the right number, else it returns the corresponding.
+    def set_nr(self,a,b,c):
+        i = b*9+a
+        if self.current[i] == self.solved[i]:
+            return NUMBER_EXISTS
+
+        if self.solved[i] == c:
+            self.view.set_cell(i, c)
+            self.remaining -= 1
+            r, col, box = CELL_ROW[i], CELL_COL[i], CELL_BOX[i]
+            self.row_fill[r] += 1
+            self.col_fill[col] += 1
+            self.box_fill[box] += 1
+            self.rows_done += self.row_fill[r] == 9
+            self.cols_done += self.col_fill[col] == 9
+            self.boxes_done += self.box_fill[box] == 9
+            return RIGHT_ANSWER
+
+        return WRONG_ANSWER
+
+#Checks if the curent table has any zeros left, if not, the game must be over.
+    def is_game_over(self):
+        return self.remaining == 0
+
+#Returns how much of the board is filled, in percent.
+    def percent_filled(self):
+        return 100 * (81 - self.remaining) // 81
+
+#Returns the number of completed rows, columns and boxes.
+    def rows_completed(self):
+        return self.rows_done
+
+    def cols_completed(self):
+        return self.cols_done
+
+    def boxes_completed(self):
+        return self.boxes_done
+
+#Returns a short progress line for the players.
+    def progress_to_string(self):
+        return '%d%% filled, %d/9 rows, %d/9 columns and %d/9 boxes complete' \
+               % (self.percent_filled(), self.rows_done, self.cols_done,
+                  self.boxes_done)
+
+#Incorporates the design created in the 'Sudoku_design.txt'
+# returns the designed current game table.
+    def sudoku_to_string(self):
+        return self.view.render()
+
+    def sudoku_to_string_without_table(self):
+        return str(self.current.translate(CELL_CHARS))
+
+#The old numpy backed Sudoku class, kept for the memory benchmark.
+class SudokuNumpy():
+    def __init__(self,level,puzzle=None):
+        if puzzle is None:
+            puzzle = make_sudoku(level)
+        self.current,self.solved=puzzle
+
+#Creates a sudoku from the puzzle bank record at the given file offset.
+    @classmethod
+    def from_bank(cls,bank,offset):
+        return cls(None,bank.load(offset))
 
 #Set_nr checks if the number given suits the solution, if it does,
 # it replaces a zero with the right number, else it returns the corresponding.
@@ -127,21 +363,7 @@ class Sudoku():
 #Incorporates the design created in the 'Sudoku_design.txt'
 # returns the designed current game table.
     def sudoku_to_string(self):
-        design = """   X 1-2-3   4-5-6   7-8-9
-  Y╔═══════╦═══════╦═══════╗
-  1║ * * * ║ * * * ║ * * * ║
-  2║ * * * ║ * * * ║ * * * ║
-  3║ * * * ║ * * * ║ * * * ║
-   ╠═══════╬═══════╬═══════╣
-  4║ * * * ║ * * * ║ * * * ║
-  5║ * * * ║ * * * ║ * * * ║
-  6║ * * * ║ * * * ║ * * * ║
-   ╠═══════╬═══════╬═══════╣
-  7║ * * * ║ * * * ║ * * * ║
-  8║ * * * ║ * * * ║ * * * ║
-  9║ * * * ║ * * * ║ * * * ║
-   ╚═══════╩═══════╩═══════╝"""
-        design = list(design)
+        design = list(DESIGN)
 
         out_str = ''
         for i in self.current:
@@ -171,4 +393,4 @@ if __name__ == '__main__':
     while True:
         inp = raw_input("nr:" )
         inp = list(inp)
-        print sudokus.set_nr(inp[0],inp[1],inp[2])
+        print sudokus.set_nr(int(inp[0])-1,int(inp[1])-1,int(inp[2]))